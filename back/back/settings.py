@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -30,8 +31,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.middleware.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
+    'core.middleware.PrimaryPinningMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -69,9 +72,48 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # persistent connections, sqlite pragmas are set in core/db.py
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {'timeout': 20},
+        # file instead of in-memory db lets concurrency tests use several connections
+        'TEST': {'NAME': BASE_DIR / 'test_db.sqlite3'},
     }
 }
 
+# Read replica (another sqlite file when testing locally) is used for reads by core/routers.py
+if os.environ.get('DB_REPLICA_NAME'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['DB_REPLICA_NAME'],
+        'TEST': {'MIRROR': 'default'},
+    }
+
+DATABASE_REPLICAS = [alias for alias in DATABASES if alias != 'default']
+
+DATABASE_ROUTERS = ['core.routers.PrimaryReplicaRouter']
+
+# Cache shared by worker processes: the component catalog version (see core/catalog.py) lives there
+# so every worker notices catalog changes made by another one, files are shared by workers of one host,
+# set CACHE_REDIS_URL (requires the redis package) to share it between hosts
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.environ.get('CACHE_DIR', BASE_DIR / '.cache'),
+    }
+}
+
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.environ['CACHE_REDIS_URL'],
+    }
+
+# Reads of a client are pinned to the primary for this many seconds after its write
+
+REPLICA_PIN_SECONDS = 5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -114,6 +156,53 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# DRF renders json with orjson when it's installed (see core/renderers.py)
+
+REST_FRAMEWORK = {
+    'DEFAULT_RENDERER_CLASSES': [
+        'core.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+}
+
+# Write-behind counters of votes and reactions (see core/buffers.py)
+# buffered deltas are flushed after this many seconds or this many unflushed changes
+
+COUNTERS_FLUSH_INTERVAL = 1.0
+
+COUNTERS_MAX_PENDING = 1000
+
+# Buffered Stat.views counting (see core/viewcount.py)
+# views of the same customer are counted once per dedup window (seconds)
+
+STAT_VIEWS_FLUSH_INTERVAL = 5.0
+
+STAT_VIEWS_MAX_PENDING = 10000
+
+STAT_VIEWS_DEDUP_WINDOW = 60
+
+# In-process recipe leaderboards (see core/leaderboard.py)
+# are rebuilt from the db after this many seconds to catch up with other processes
+
+LEADERBOARD_REFRESH_INTERVAL = 60
+
+# In-process inverted index of recipes by components (see core/search.py)
+
+SEARCH_INDEX_REFRESH_INTERVAL = 60
+
+# Per-process LRU cache username -> customer id (see core/usernames.py)
+
+USERNAME_CACHE_SIZE = 10000
+
+USERNAME_CACHE_TTL = 60
+
+# Request instrumentation (see core/middleware.py): Server-Timing header
+# and logging of queries slower than PERF_SLOW_QUERY_MS with their stacks (off when None)
+
+PERF_SERVER_TIMING = True
+
+PERF_SLOW_QUERY_MS = float(os.environ['PERF_SLOW_QUERY_MS']) if os.environ.get('PERF_SLOW_QUERY_MS') else None
+
 # Adding CORS header
 if DEBUG:
     INSTALLED_APPS += ('corsheaders', )
@@ -0,0 +1,130 @@
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from rest_framework.exceptions import NotFound
+from rest_framework.utils.urls import replace_query_param, remove_query_param
+from rest_framework.views import exception_handler
+
+from .models import *
+from .catalog import catalog, conditional_json, make_etag
+from .discounts import discount_table, backfill_discounts
+from .paginators import LotsPg
+from .renderers import fast_renderer
+from .views import branch_page
+
+
+# async variants of read endpoints for ASGI servers (back/asgi.py), urls are prefixed with 'async/'
+# responses (errors included) are the same as responses of sync views, queries are made with the async ORM
+# and in-process caches (catalog, discounts) are always called via sync_to_async: every call checks
+# the shared version of the cache and may rebuild it with queries
+
+
+# the same json as rest_framework JSONRenderer produces
+def json_response(data, status=200):
+    return HttpResponse(fast_renderer.render(data), status=status, content_type='application/json')
+
+
+# renders exceptions like DRF does for sync views: {"detail": ...} json instead of django's html pages
+def api_errors(view):
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        try:
+            return await view(request, *args, **kwargs)
+        except Exception as exc:
+            error = exception_handler(exc, {'request': request})
+            if error is None:
+                raise
+            response = json_response(error.data, status=error.status_code)
+            for header, value in error.items():
+                if header != 'Content-Type':
+                    response[header] = value
+            return response
+    return wrapper
+
+
+@api_errors
+async def components(request):
+    snapshot = await sync_to_async(catalog.get)()
+    return conditional_json(request, snapshot.etag, snapshot.brief)
+
+
+@api_errors
+async def ownerships(request, pk):
+    return json_response([{'component': comp_id, 'qty': qty} async for comp_id, qty in
+                          ComponentOwnership.objects.filter(owner_id=pk).values_list('component_id', 'qty')])
+
+
+@api_errors
+async def available_components(request, pk):
+    comp_ids = sorted({comp_id async for comp_id in ComponentOwnership.objects.filter(owner_id=pk)
+                      .values_list('component_id', flat=True)})
+    snapshot = await sync_to_async(catalog.get)()
+    etag = make_etag(snapshot.version, comp_ids)
+    return conditional_json(request, etag, lambda: b'[' + b','.join(
+        snapshot.detail[comp_id] for comp_id in comp_ids if comp_id in snapshot.detail) + b']')
+
+
+@api_errors
+async def discounts(request, pk):
+    qty = {(pk, rarity): n async for rarity, n in
+           DiscountOwnership.objects.filter(owner_id=pk).values_list('rarity_id', 'qty')}
+    percents = await sync_to_async(discount_table.get)()
+    if len(qty) < len(percents):
+        qty.update(await sync_to_async(backfill_discounts)(qty, [pk]))
+    return json_response([{'rarity': rarity, 'percents': percents[rarity], 'qty': qty[pk, rarity]}
+                          for rarity in sorted(percents) if (pk, rarity) in qty])
+
+
+# the same page number pagination as LotsList
+@api_errors
+async def lots(request):
+    try:
+        page = int(request.GET.get('page', 1))
+    except ValueError:
+        raise NotFound(LotsPg.invalid_page_message)
+    size = LotsPg.page_size
+    open_lots = Lot.objects.filter(purchaser=None)
+    count = await open_lots.acount()
+    if page < 1 or (page - 1) * size >= max(count, 1):
+        raise NotFound(LotsPg.invalid_page_message)
+
+    page_lots = [lot async for lot in open_lots.values('id', 'price')[(page - 1) * size:page * size]]
+    items = {}
+    async for lot_id, comp_id, lot_qty in ComponentOwnership.objects.filter(
+            lot_id__in=[lot['id'] for lot in page_lots]).values_list('lot_id', 'component_id', 'lot_qty'):
+        items.setdefault(lot_id, []).append({'component': comp_id, 'lot_qty': lot_qty})
+
+    url = request.build_absolute_uri()
+    previous = None
+    if page > 1:
+        previous = remove_query_param(url, 'page') if page == 2 else replace_query_param(url, 'page', page - 1)
+    return json_response({
+        'count': count,
+        'next': replace_query_param(url, 'page', page + 1) if page * size < count else None,
+        'previous': previous,
+        'results': [{'price': lot['price'], 'consist_of': items.get(lot['id'], [])} for lot in page_lots],
+    })
+
+
+@api_errors
+async def lot_detail(request, pk):
+    try:
+        lot = await Lot.objects.values(
+            'purchaser', 'stat__views', 'stat__comments_count', 'upvotes_count', 'downvotes_count').aget(pk=pk)
+    except Lot.DoesNotExist:
+        raise NotFound()
+    return json_response({'purchaser': lot['purchaser'], 'views': lot['stat__views'],
+                          'comments_count': lot['stat__comments_count'],
+                          'upvotes_count': lot['upvotes_count'], 'downvotes_count': lot['downvotes_count']})
+
+
+# raw recursive query isn't supported by the async ORM so it's run in a thread
+@api_errors
+async def comment_branch(request, pk):
+    branch, next_url = await sync_to_async(branch_page)(request, pk)
+    response = json_response([{'id': c.id, 'author': c.author_id, 'text': c.text, 'reply_to': c.reply_to_id}
+                              for c in branch])
+    if next_url:
+        response['Link'] = '<{}>; rel="next"'.format(next_url)
+    return response
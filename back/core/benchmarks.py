@@ -0,0 +1,89 @@
+import re
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+
+# helpers for benchmark commands: latencies are in seconds, reports in milliseconds
+
+def percentile(latencies, p):
+    ordered = sorted(latencies)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def summarize(latencies, elapsed):
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 50) * 1000,
+        'p95': percentile(latencies, 95) * 1000,
+        'p99': percentile(latencies, 99) * 1000,
+    }
+
+
+# calls func() n times and returns its latencies
+def timed(func, n):
+    latencies = []
+    for _ in range(n):
+        start = perf_counter()
+        func()
+        latencies.append(perf_counter() - start)
+    return latencies
+
+
+# runs func() requests times by concurrency threads, returns summarize() of latencies
+# close_connection is called at the end of every thread to release its db connection
+def load(func, requests, concurrency=1, close_connection=None):
+    def worker(n):
+        try:
+            return timed(func, n)
+        finally:
+            if close_connection is not None:
+                close_connection()
+
+    per_worker = [requests // concurrency + (i < requests % concurrency) for i in range(concurrency)]
+    start = perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        latencies = [lat for lats in pool.map(worker, per_worker) for lat in lats]
+    return summarize(latencies, perf_counter() - start)
+
+
+# paths of GET endpoints of urlpatterns with route params replaced by samples {param: value}
+# or {(segment, param): value} for params meaning different things in different routes,
+# e.g. ('lot', 'pk') is used for the first route segment 'lot' of 'lot/<int:pk>' and 'async/lot/<int:pk>'
+# returns [(route, path)], routes with params without samples are skipped
+def endpoint_paths(urlpatterns, samples, queries=None):
+    paths = []
+    for pattern in urlpatterns:
+        route = str(pattern.pattern)
+        view = getattr(pattern.callback, 'view_class', None)
+        if view is not None and not hasattr(view, 'get'):
+            continue
+        path = route
+        for param in pattern.pattern.converters:
+            value = next((samples[segment, param] for segment in route.split('/')
+                          if (segment, param) in samples), samples.get(param))
+            if value is None:
+                break
+            path = re.sub(r'<(\w+:)?{}>'.format(param), str(value), path)
+        else:
+            paths.append((route, '/' + path + (queries or {}).get(route, '')))
+    return paths
+
+
+# results and baseline are {endpoint: {'queries', 'p95', ...}}
+# an endpoint regresses when it makes more queries than in the baseline
+# or, unless tolerance is None, its p95 latency grows more than tolerance times (and by more than min_ms
+# milliseconds): latencies depend on the machine and its load so they are compared only on request
+def regressions(results, baseline, tolerance=2.0, min_ms=2.0):
+    found = []
+    for endpoint, result in results.items():
+        base = baseline.get(endpoint)
+        if base is None:
+            continue
+        if result['queries'] > base['queries']:
+            found.append('{}: {} queries instead of {}'.format(endpoint, result['queries'], base['queries']))
+        if tolerance is not None and result['p95'] > base['p95'] * tolerance and result['p95'] - base['p95'] > min_ms:
+            found.append('{}: p95 {:.2f} ms instead of {:.2f} ms'.format(endpoint, result['p95'], base['p95']))
+    return found
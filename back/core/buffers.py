@@ -0,0 +1,83 @@
+import atexit
+from collections import defaultdict, Counter
+from threading import Lock
+from time import monotonic
+
+from django.core.signals import request_finished
+from django.db import close_old_connections, transaction
+from django.db.models import F, Case, When, Value
+
+
+# write-behind buffer of counter deltas: {key: Counter({field: delta})}
+# deltas are summed up in process memory and written by flush_func in batches
+# flush happens after `interval` seconds or `max_pending` added deltas
+# (checked on every add and after every request) and at exit
+class CounterBuffer:
+    def __init__(self, flush_func, interval=1.0, max_pending=1000):
+        self.flush_func = flush_func
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = Lock()
+        self._flush_lock = Lock()
+        self._pending = defaultdict(Counter)
+        self._added = 0
+        self._last_flush = monotonic()
+        request_finished.connect(self._on_request_finished, weak=False)
+        atexit.register(self._flush_at_exit)
+
+    def add(self, key, **deltas):
+        with self._lock:
+            self._pending[key].update(deltas)
+            self._added += 1
+            due = self._added >= self.max_pending
+        if due or self.is_due():
+            self.flush()
+
+    def is_due(self):
+        return bool(self._pending) and monotonic() - self._last_flush >= self.interval
+
+    def pending(self):
+        with self._lock:
+            return {key: Counter(deltas) for key, deltas in self._pending.items()}
+
+    def flush(self):
+        # only one flush at a time, concurrent callers just leave deltas to it or to the next one
+        if not self._flush_lock.acquire(blocking=False):
+            return
+        try:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(Counter)
+                self._added = 0
+                self._last_flush = monotonic()
+            pending = {key: deltas for key, deltas in pending.items() if any(deltas.values())}
+            if not pending:
+                return
+            try:
+                self.flush_func(pending)
+            except Exception:
+                # deltas are returned to the buffer to be written by the next flush
+                with self._lock:
+                    for key, deltas in pending.items():
+                        self._pending[key].update(deltas)
+                raise
+        finally:
+            self._flush_lock.release()
+
+    def _on_request_finished(self, **kwargs):
+        if self.is_due():
+            self.flush()
+
+    def _flush_at_exit(self):
+        close_old_connections()
+        self.flush()
+
+
+# one UPDATE for all buffered rows of model: counter = counter + CASE id WHEN ... THEN delta END
+def update_counters(model, pending):
+    fields = {field for deltas in pending.values() for field in deltas}
+    with transaction.atomic():
+        model.objects.filter(id__in=pending).update(**{
+            field: F(field) + Case(*[When(id=pk, then=Value(deltas[field]))
+                                     for pk, deltas in pending.items() if deltas[field]],
+                                   default=Value(0))
+            for field in fields})
@@ -0,0 +1,118 @@
+import csv
+import json
+from itertools import islice
+
+from django.apps import apps
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+
+# streaming of core tables in and out of JSONL/CSV files in chunks with constant memory
+# rows are dicts of column attnames (e.g. owner_id), many-to-many tables without an explicit
+# through model are included as their auto-created models (e.g. lot_upvotes)
+
+formats = ('jsonl', 'csv')
+
+
+def core_models():
+    return {model._meta.model_name: model
+            for model in apps.get_app_config('core').get_models(include_auto_created=True)}
+
+
+# models sorted so that every model goes after models it references (self references are ignored)
+def dependency_order(models):
+    ordered, seen = [], set()
+
+    def visit(model):
+        if model in seen:
+            return
+        seen.add(model)
+        for field in model._meta.concrete_fields:
+            if field.is_relation and field.related_model is not model and field.related_model in models:
+                visit(field.related_model)
+        ordered.append(model)
+
+    for model in models:
+        visit(model)
+    return ordered
+
+
+def columns(model):
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# rows of the table ordered by pk so that self references (Comment.reply_to) go after their targets
+def export_rows(model, chunk_size=2000):
+    names = columns(model)
+    for row in model.objects.order_by('pk').values_list(*names).iterator(chunk_size=chunk_size):
+        yield dict(zip(names, row))
+
+
+def write_rows(rows, fmt, stream, model):
+    if fmt == 'csv':
+        writer = csv.DictWriter(stream, columns(model))
+        writer.writeheader()
+    written = 0
+    for row in rows:
+        if fmt == 'csv':
+            writer.writerow(row)
+        else:
+            stream.write(json.dumps(row, ensure_ascii=False) + '\n')
+        written += 1
+    return written
+
+
+# csv values are strings: they are converted by model fields, empty strings of nullable fields are NULLs
+def read_rows(fmt, stream, model):
+    if fmt == 'jsonl':
+        return (json.loads(line) for line in stream if line.strip())
+    fields = {field.attname: field for field in model._meta.concrete_fields}
+
+    def convert(name, value):
+        field = fields[name]
+        if value == '' and field.null:
+            return None
+        return field.to_python(value)
+
+    return ({name: convert(name, value) for name, value in row.items()} for row in csv.DictReader(stream))
+
+
+# inserts objects in batches, each batch in its own transaction, returns number of saved objects
+# with update=True existing rows (by pk) are updated instead of failing on conflict
+def bulk_insert(model, objects, batch_size=2000, update=False):
+    fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+    count = 0
+    for batch in chunks(objects, batch_size):
+        with transaction.atomic():
+            new = batch
+            if update:
+                existing = set(model.objects.filter(pk__in=[obj.pk for obj in batch if obj.pk is not None])
+                               .values_list('pk', flat=True))
+                if existing and fields:
+                    model.objects.bulk_update([obj for obj in batch if obj.pk in existing], fields)
+                new = [obj for obj in batch if obj.pk not in existing]
+            model.objects.bulk_create(new)
+        count += len(batch)
+    return count
+
+
+def import_rows(model, rows, batch_size=2000, update=False):
+    return bulk_insert(model, (model(**row) for row in rows), batch_size, update)
+
+
+# explicit ids leave sequences behind on backends having them (no-op for sqlite)
+def reset_sequences(models):
+    statements = connection.ops.sequence_reset_sql(no_style(), models)
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
@@ -0,0 +1,96 @@
+from hashlib import blake2b
+from threading import Lock
+from uuid import uuid4
+
+from django.core.cache import cache
+from django.db import transaction
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.http import parse_etags, quote_etag
+from .models import Component
+from .renderers import fast_renderer
+from .serializers import brief_components, detail_components
+
+
+# version of the catalog shared by workers through the cache backend (see CACHES in settings.py)
+version_key = 'core:catalog:version'
+
+
+# version token shared by workers through the cache backend, in-process caches remember the token
+# they were built for and are rebuilt when it changes, so a change made by any worker reaches all of them
+class SharedVersion:
+    def __init__(self, key):
+        self.key = key
+
+    def bump(self):
+        cache.set(self.key, uuid4().hex, None)
+
+    def get(self):
+        version = cache.get(self.key)
+        if version is None:
+            version = uuid4().hex
+            if not cache.add(self.key, version, None):
+                version = cache.get(self.key)
+        return version
+
+
+# pre-rendered Component + ComponentType catalog
+# brief - whole 'components' response, detail - {component_id: rendered DetailComponentSr}
+class Snapshot:
+    def __init__(self, version, brief, detail):
+        self.version = version
+        self.etag = quote_etag(version)
+        self.brief = brief
+        self.detail = detail
+
+
+# in-process catalog snapshot rebuilt with one query after any change of Component or ComponentType
+class Catalog:
+    def __init__(self):
+        self._lock = Lock()
+        self._version = SharedVersion(version_key)
+        self._snapshot = None
+
+    def invalidate(self):
+        self._version.bump()
+
+    def version(self):
+        return self._version.get()
+
+    def _build(self, version):
+        components = Component.objects.order_by('id')
+        brief = fast_renderer.render(brief_components(components))
+        detail = {comp['id']: fast_renderer.render(comp) for comp in detail_components(components)}
+        return Snapshot(version, brief, detail)
+
+    def get(self):
+        version = self.version()
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None or snapshot.version != version:
+                    snapshot = self._snapshot = self._build(version)
+        return snapshot
+
+
+catalog = Catalog()
+
+
+def invalidate_catalog(**kwargs):
+    transaction.on_commit(catalog.invalidate)
+
+
+def make_etag(*parts):
+    return quote_etag(blake2b(repr(parts).encode(), digest_size=16).hexdigest())
+
+
+# returns 304 response if the client already has this etag otherwise response with given json bytes
+def conditional_json(request, etag, content):
+    etags = parse_etags(request.headers.get('If-None-Match', ''))
+    if '*' in etags or etag in etags or 'W/' + etag in etags:
+        response = HttpResponseNotModified()
+    else:
+        response = HttpResponse(content() if callable(content) else content,
+                                content_type='application/json')
+    response['ETag'] = etag
+    return response
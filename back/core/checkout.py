@@ -0,0 +1,58 @@
+from collections import Counter
+
+from django.db import transaction
+from django.db.models import F, Q
+from rest_framework.exceptions import ValidationError
+
+from .models import Customer, DiscountOwnership, Recipe, Order, OrderComposition
+from .discounts import discount_table
+
+
+# creates order of customer from basket [(recipe_id, qty)] with a fixed number of queries
+# discount is optional rarity of DiscountOwnership to consume one discount of
+# all writes are conditional updates so concurrent checkouts of the same customer can't
+# spend the same coins or discount twice, any failure rolls the whole checkout back
+def checkout(customer_id, basket, discount=None):
+    quantities = Counter()
+    for recipe_id, qty in basket:
+        if qty <= 0:
+            raise ValidationError('qty of recipe {} must be positive'.format(recipe_id))
+        quantities[recipe_id] += qty
+    if not quantities:
+        raise ValidationError('basket is empty')
+
+    # customer may order public recipes and own private ones
+    prices = dict(Recipe.objects.filter(Q(is_private=False) | Q(author_comm__author_id=customer_id),
+                                        id__in=quantities).order_by().values_list('id', 'price'))
+    missing = set(quantities) - set(prices)
+    if missing:
+        raise ValidationError('recipes {} are not available'.format(sorted(missing)))
+    price = sum(prices[recipe_id] * qty for recipe_id, qty in quantities.items())
+
+    if discount is not None:
+        percents = discount_table.get().get(discount)
+        if percents is None:
+            raise ValidationError('there is no discount of rarity {}'.format(discount))
+        price = price * (100 - percents) // 100
+
+    # the first statement is a write: sqlite upgrades a deferred transaction that has read something
+    # to a writer with 'database is locked' instead of waiting, and the customer row is locked
+    # before ownership rows like inventory.py does
+    with transaction.atomic():
+        # bumps inventory version for the consumed discount as well
+        if not Customer.objects.filter(id=customer_id, coins__gte=price).update(
+                coins=F('coins') - price, inventory_version=F('inventory_version') + 1):
+            raise ValidationError('not enough coins')
+
+        ownership_id = None
+        if discount is not None:
+            ownerships = DiscountOwnership.objects.filter(owner_id=customer_id, rarity_id=discount)
+            if not ownerships.filter(qty__gt=0).update(qty=F('qty') - 1):
+                raise ValidationError('there is no discount of rarity {}'.format(discount))
+            ownership_id = ownerships.values_list('id', flat=True).get()
+
+        order = Order.objects.create(customer_id=customer_id, price=price,
+                                     discount_id=ownership_id)
+        OrderComposition.objects.bulk_create([OrderComposition(order=order, recipe_id=recipe_id, qty=qty)
+                                              for recipe_id, qty in quantities.items()])
+    return order
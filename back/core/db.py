@@ -0,0 +1,46 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+
+from django.conf import settings
+
+
+# sqlite pragmas for every new connection: WAL lets readers work while a writer holds the lock,
+# synchronous=NORMAL is durable in WAL mode and skips an fsync per commit
+# replica connections are made read-only to catch writes routed to the wrong alias
+def configure_sqlite(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('PRAGMA journal_mode = WAL')
+        cursor.execute('PRAGMA synchronous = NORMAL')
+        if connection.alias in settings.DATABASE_REPLICAS:
+            cursor.execute('PRAGMA query_only = ON')
+
+
+# execute wrappers of the current request (see middleware.py)
+# they're looked up by one wrapper installed on every connection instead of being installed on
+# connections of the middleware's thread, so queries of async views made in threads of
+# sync_to_async (which copy the context) are seen as well
+request_wrappers = ContextVar('request_wrappers', default=())
+
+
+def run_request_wrappers(execute, sql, params, many, context):
+    for wrapper in reversed(request_wrappers.get()):
+        execute = partial(wrapper, execute)
+    return execute(sql, params, many, context)
+
+
+def install_request_wrappers(sender, connection, **kwargs):
+    if run_request_wrappers not in connection.execute_wrappers:
+        connection.execute_wrappers.append(run_request_wrappers)
+
+
+# adds wrapper to queries of the current request (or task) within the block
+@contextmanager
+def request_wrapper(wrapper):
+    token = request_wrappers.set(request_wrappers.get() + (wrapper,))
+    try:
+        yield
+    finally:
+        request_wrappers.reset(token)
@@ -0,0 +1,85 @@
+from threading import Lock
+
+from django.db import connection, transaction
+
+from .models import Discount, DiscountOwnership
+from .inventory import bump_inventory
+from .catalog import SharedVersion
+
+
+# version of the Discount table shared by workers like the catalog version
+version_key = 'core:discounts:version'
+
+
+# in-process copy of the small Discount table {rarity: percents}
+# loaded with one query and reloaded when the shared discounts version changes (see signals.py),
+# so every worker charges the current percents
+class DiscountTable:
+    def __init__(self):
+        self._lock = Lock()
+        self._version = SharedVersion(version_key)
+        self._table = None
+
+    def invalidate(self):
+        self._version.bump()
+
+    def get(self):
+        version = self._version.get()
+        table = self._table
+        if table is None or table[0] != version:
+            with self._lock:
+                table = self._table
+                if table is None or table[0] != version:
+                    table = self._table = version, dict(Discount.objects.values_list('rarity', 'percents'))
+        return table[1]
+
+
+discount_table = DiscountTable()
+
+
+def invalidate_discounts(**kwargs):
+    transaction.on_commit(discount_table.invalidate)
+
+
+# creates missing DiscountOwnership rows with qty=0 for given customers in one INSERT
+# returns {(owner_id, rarity): 0} for the rows that were missing
+def backfill_discounts(existing, owner_ids):
+    missing = {(owner_id, rarity): 0 for owner_id in owner_ids for rarity in discount_table.get()
+               if (owner_id, rarity) not in existing}
+    DiscountOwnership.objects.bulk_create(
+        [DiscountOwnership(owner_id=owner_id, rarity_id=rarity, qty=0) for owner_id, rarity in missing],
+        ignore_conflicts=True)
+    return missing
+
+
+# each new customer owns every discount with qty=0 from the very beginning
+def create_customer_discounts(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        backfill_discounts({}, [instance.id])
+
+
+# [{rarity, percents, qty}] of the customer sorted by rarity like DiscountSr does
+# one query while the customer already has all discounts
+def customer_discounts(owner_id):
+    qty = {(owner_id, rarity): n for rarity, n in
+           DiscountOwnership.objects.filter(owner_id=owner_id).values_list('rarity_id', 'qty')}
+    percents = discount_table.get()
+    if len(qty) < len(percents):
+        qty.update(backfill_discounts(qty, [owner_id]))
+    return [{'rarity': rarity, 'percents': percents[rarity], 'qty': qty[owner_id, rarity]}
+            for rarity in sorted(percents) if (owner_id, rarity) in qty]
+
+
+# increases qty of owner's discounts by deltas {rarity: qty} with one INSERT ... ON CONFLICT
+def add_discounts(owner_id, deltas):
+    rows = [(owner_id, rarity, qty) for rarity, qty in deltas.items() if qty > 0]
+    if not rows:
+        return
+    table = connection.ops.quote_name(DiscountOwnership._meta.db_table)
+    bump_inventory([owner_id])
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {t} (owner_id, rarity, qty) VALUES {values} '
+            'ON CONFLICT (owner_id, rarity) DO UPDATE SET qty = {t}.qty + excluded.qty'
+            .format(t=table, values=', '.join(['(%s, %s, %s)'] * len(rows))),
+            [param for row in rows for param in row])
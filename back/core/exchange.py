@@ -0,0 +1,34 @@
+from collections import Counter
+
+from django.db import transaction
+from rest_framework.exceptions import ValidationError
+
+from .models import Component
+from .inventory import take_components
+from .discounts import discount_table, add_discounts
+
+
+# exchanges owner's components {component_id: qty} for discounts:
+# each component gives one discount of its rarity
+# the whole exchange is one transaction with set-based statements whatever number of components:
+# one UPDATE (+ DELETE of emptied rows) of ownerships and one upsert of discounts
+def exchange(owner_id, components):
+    components = {comp_id: qty for comp_id, qty in components.items() if qty > 0}
+    if not components:
+        raise ValidationError('nothing to exchange')
+
+    rarities = dict(Component.objects.filter(id__in=components).values_list('id', 'rarity'))
+    missing = set(components) - set(rarities)
+    if missing:
+        raise ValidationError('there are no components {}'.format(sorted(missing)))
+    gained = Counter()
+    for comp_id, qty in components.items():
+        gained[rarities[comp_id]] += qty
+    unknown = set(gained) - set(discount_table.get())
+    if unknown:
+        raise ValidationError('there are no discounts for rarities {}'.format(sorted(unknown)))
+
+    with transaction.atomic():
+        take_components(owner_id, components)
+        add_discounts(owner_id, gained)
+    return dict(gained)
@@ -0,0 +1,134 @@
+from collections import Counter
+
+from django.db import connection, transaction
+from django.db.models import Q, F, Case, When
+from rest_framework.exceptions import ValidationError
+
+from .models import Customer, ComponentOwnership
+
+
+# the only place where ComponentOwnership.qty and lot_qty are changed:
+# roulette, lots and exchange go through these functions instead of get -> qty += n -> save()
+
+# changes version of inventory of given customers (ids or a subquery of ids) with one UPDATE
+# it's the first statement of every inventory transaction so customer rows are always locked
+# before ownership rows like buy_lot and checkout do, otherwise they could deadlock
+def bump_inventory(owner_ids):
+    Customer.objects.filter(id__in=owner_ids).update(inventory_version=F('inventory_version') + 1)
+
+
+# ownerships changed by save() or delete() (admin, shell) bump the version of their owner before
+# the change, so the customer row is locked first here too, the functions below change ownerships
+# with queries that send no signals and bump it themselves
+def bump_inventory_on_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        bump_inventory([instance.owner_id])
+
+
+# Customer.save() writes back inventory_version of the loaded instance which may be older than
+# the stored one, so the saved value itself is incremented by the database (coins may have changed)
+def bump_inventory_on_customer_save(sender, instance, raw=False, update_fields=None, **kwargs):
+    if raw or instance._state.adding:
+        return
+    if update_fields is None or 'inventory_version' in update_fields:
+        instance.inventory_version = F('inventory_version') + 1
+
+
+# save(update_fields=[..., 'coins']) doesn't write inventory_version, the version is bumped after it
+def bump_inventory_on_coins_update(sender, instance, raw=False, update_fields=None, **kwargs):
+    if not raw and update_fields is not None and 'coins' in update_fields \
+            and 'inventory_version' not in update_fields:
+        bump_inventory([instance.id])
+
+
+# deletes rows with one DELETE without sending pre_delete (see bump_inventory_on_change)
+def delete_ownerships(queryset):
+    queryset._raw_delete(queryset.db)
+
+
+# rows per one INSERT statement (3 params per row fits into the sqlite limit of 999 params)
+batch_size = 300
+
+
+# increases qty of (owner, component) rows by given deltas or creates missing rows
+# items is an iterable of (owner_id, component_id, qty), equal keys are summed up
+# every batch is one INSERT ... ON CONFLICT DO UPDATE so concurrent increments are never lost
+def add_components_bulk(items):
+    deltas = Counter()
+    for owner_id, comp_id, qty in items:
+        deltas[owner_id, comp_id] += qty
+    rows = [(owner_id, comp_id, qty) for (owner_id, comp_id), qty in deltas.items() if qty > 0]
+    if not rows:
+        return
+
+    qn = connection.ops.quote_name
+    table = qn(ComponentOwnership._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        bump_inventory({owner_id for owner_id, _, _ in rows})
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            cursor.execute(
+                'INSERT INTO {t} (owner_id, component_id, qty) VALUES {values} '
+                'ON CONFLICT (owner_id, component_id) DO UPDATE SET qty = {t}.qty + excluded.qty'
+                .format(t=table, values=', '.join(['(%s, %s, %s)'] * len(batch))),
+                [param for row in batch for param in row])
+
+
+# deltas is a mapping {component_id: qty}
+def add_components(owner_id, deltas):
+    add_components_bulk((owner_id, comp_id, qty) for comp_id, qty in deltas.items())
+
+
+# decreases qty of owner's components by given deltas with one UPDATE
+# either all components are taken or ValidationError is raised and nothing is changed
+# rows reaching zero qty are deleted unless they are a part of lot
+def take_components(owner_id, deltas):
+    deltas = {comp_id: qty for comp_id, qty in deltas.items() if qty > 0}
+    if not deltas:
+        return
+
+    enough = Q()
+    for comp_id, qty in deltas.items():
+        enough |= Q(component_id=comp_id, qty__gte=qty)
+    with transaction.atomic():
+        bump_inventory([owner_id])
+        updated = ComponentOwnership.objects.filter(enough, owner_id=owner_id).update(
+            qty=Case(*[When(component_id=comp_id, then=F('qty') - qty)
+                       for comp_id, qty in deltas.items()]))
+        if updated != len(deltas):
+            raise ValidationError('not enough components to take')
+        delete_ownerships(ComponentOwnership.objects.filter(owner_id=owner_id, component_id__in=deltas,
+                                                            qty=0, lot=None))
+
+
+# moves deltas {component_id: qty} of owner's components into the lot with one UPDATE:
+# qty is decreased and lot_qty is set, rows already in another lot can't be listed
+def reserve_for_lot(owner_id, lot_id, deltas):
+    deltas = {comp_id: qty for comp_id, qty in deltas.items() if qty > 0}
+    if not deltas:
+        raise ValidationError('lot must consist of some components')
+
+    enough = Q()
+    for comp_id, qty in deltas.items():
+        enough |= Q(component_id=comp_id, qty__gte=qty)
+    with transaction.atomic():
+        bump_inventory([owner_id])
+        updated = ComponentOwnership.objects.filter(enough, owner_id=owner_id, lot=None).update(
+            qty=Case(*[When(component_id=comp_id, then=F('qty') - qty)
+                       for comp_id, qty in deltas.items()]),
+            lot_qty=Case(*[When(component_id=comp_id, then=qty) for comp_id, qty in deltas.items()]),
+            lot_id=lot_id)
+        if updated != len(deltas):
+            raise ValidationError('not enough free components to list')
+
+
+# gives all components of the lot to the new owner (merged into the existing rows)
+# and detaches them from the seller's rows, deleting rows that have nothing left
+def transfer_lot(lot_id, new_owner_id):
+    with transaction.atomic():
+        items = ComponentOwnership.objects.filter(lot_id=lot_id)
+        bump_inventory(items.values('owner_id'))
+        add_components_bulk((new_owner_id, comp_id, qty) for comp_id, qty in
+                            items.values_list('component_id', 'lot_qty'))
+        delete_ownerships(items.filter(qty=0))
+        items.update(lot=None, lot_qty=None)
@@ -0,0 +1,177 @@
+from bisect import bisect_left, insort
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Recipe, Reaction, RecipeReactionsCount
+
+
+# ranking of public recipes by score (higher score - better rank, ties by id)
+# kept as a sorted list of (-score, recipe_id) so rank lookup is a binary search
+class Board:
+    def __init__(self, scores=()):
+        self.scores = dict(scores)
+        self.keys = sorted((-score, recipe_id) for recipe_id, score in self.scores.items())
+
+    def set(self, recipe_id, score):
+        self.remove(recipe_id)
+        self.scores[recipe_id] = score
+        insort(self.keys, (-score, recipe_id))
+
+    def add(self, recipe_id, delta):
+        self.set(recipe_id, self.scores.get(recipe_id, 0) + delta)
+
+    def remove(self, recipe_id):
+        score = self.scores.pop(recipe_id, None)
+        if score is not None:
+            del self.keys[bisect_left(self.keys, (-score, recipe_id))]
+
+    # [(recipe_id, score)] of n best recipes starting from offset
+    def top(self, n, offset=0):
+        return [(recipe_id, -score) for score, recipe_id in self.keys[offset:offset + n]]
+
+    # 1-based rank or None if the recipe isn't ranked
+    def rank(self, recipe_id):
+        score = self.scores.get(recipe_id)
+        if score is None:
+            return None
+        return bisect_left(self.keys, (-score, recipe_id)) + 1
+
+
+# in-process leaderboards of all public recipes: 'rating' by Recipe.rating and one per Reaction.taste
+# by reactions count (0 for recipes without reactions of the taste)
+# updated incrementally by writes of this process and rebuilt from the DB every refresh_interval
+# seconds to pick up writes of other processes
+class Leaderboards:
+    rating = 'rating'
+
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._lock = Lock()
+        self._build_lock = Lock()
+        self._version = 0
+        self._boards = None
+        self._tastes = None
+        self._built_at = None
+
+    def invalidate(self):
+        with self._lock:
+            self._drop()
+
+    # under the lock
+    def _drop(self):
+        self._version += 1
+        self._boards = None
+
+    def _build(self):
+        public = Recipe.objects.filter(is_private=False)
+        ratings = dict(public.values_list('id', 'rating'))
+        tastes = dict(Reaction.objects.values_list('id', 'taste'))
+        # every public recipe is on every taste board, with score 0 until it gets reactions of the taste
+        scores = {taste: dict.fromkeys(ratings, 0) for taste in tastes.values()}
+        counts = RecipeReactionsCount.objects.filter(recipe__in=public).values_list(
+            'reaction_id', 'recipe_id', 'qty')
+        for reaction_id, recipe_id, qty in counts.iterator():
+            if recipe_id in ratings:
+                scores[tastes[reaction_id]][recipe_id] = qty
+        boards = {taste: Board(taste_scores) for taste, taste_scores in scores.items()}
+        boards[self.rating] = Board(ratings)
+        return boards, tastes
+
+    # boards are rebuilt outside of the lock and swapped in so the queries don't block reads:
+    # while one thread rebuilds stale boards the others keep using them, only missing boards are waited for
+    def _refresh(self):
+        with self._lock:
+            if self._boards is not None and monotonic() - self._built_at < self.refresh_interval:
+                return
+            missing = self._boards is None
+        if not self._build_lock.acquire(blocking=missing):
+            return
+        try:
+            with self._lock:
+                if self._boards is not None and monotonic() - self._built_at < self.refresh_interval:
+                    return
+                version = self._version
+            boards, tastes = self._build()
+            with self._lock:
+                # boards invalidated during the build may miss the change
+                if version == self._version:
+                    self._boards, self._tastes, self._built_at = boards, tastes, monotonic()
+        finally:
+            self._build_lock.release()
+
+    # runs func(boards, tastes) under the lock with fresh enough boards
+    def _use(self, func):
+        self._refresh()
+        with self._lock:
+            if self._boards is not None:
+                return func(self._boards, self._tastes)
+        # invalidated while being built, boards are built once more for this call only
+        return func(*self._build())
+
+    # board is 'rating' or Reaction.taste, None is returned for unknown board
+    def top(self, board, n, offset=0):
+        return self._use(lambda boards, tastes: boards[board].top(n, offset) if board in boards else None)
+
+    # (rank, score) of the recipe, (None, None) if it isn't ranked and None for unknown board
+    def rank(self, board, recipe_id):
+        def rank(boards, tastes):
+            if board not in boards:
+                return None
+            return boards[board].rank(recipe_id), boards[board].scores.get(recipe_id)
+        return self._use(rank)
+
+    # incremental updates, skipped when boards aren't built yet since they'll be loaded from the DB
+
+    def react(self, recipe_id, reaction_id, delta):
+        def react(boards, tastes):
+            # only public (i.e. ranked by rating) recipes are on boards
+            if recipe_id in boards[self.rating].scores and reaction_id in tastes:
+                boards[tastes[reaction_id]].add(recipe_id, delta)
+        self._update(react)
+
+    def recipe_saved(self, recipe, created):
+        def saved(boards, tastes):
+            if recipe.is_private:
+                for board in boards.values():
+                    board.remove(recipe.id)
+            elif created or recipe.id in boards[self.rating].scores:
+                boards[self.rating].set(recipe.id, recipe.rating)
+                if created:
+                    # a new recipe has no reactions yet
+                    for taste in tastes.values():
+                        boards[taste].set(recipe.id, 0)
+            else:
+                # recipe became public: its reactions are in the DB only
+                self._drop()
+        self._update(saved)
+
+    def recipe_deleted(self, recipe_id):
+        def deleted(boards, tastes):
+            for board in boards.values():
+                board.remove(recipe_id)
+        self._update(deleted)
+
+    def _update(self, func):
+        with self._lock:
+            if self._boards is not None:
+                func(self._boards, self._tastes)
+
+
+leaderboards = Leaderboards(getattr(settings, 'LEADERBOARD_REFRESH_INTERVAL', 60))
+
+
+def update_on_recipe_save(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: leaderboards.recipe_saved(instance, created))
+
+
+def update_on_recipe_delete(sender, instance, **kwargs):
+    recipe_id = instance.id
+    transaction.on_commit(lambda: leaderboards.recipe_deleted(recipe_id))
+
+
+def invalidate_leaderboards(**kwargs):
+    transaction.on_commit(leaderboards.invalidate)
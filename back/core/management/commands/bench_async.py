@@ -0,0 +1,67 @@
+import asyncio
+from threading import local
+from time import perf_counter
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.test import Client, AsyncClient
+
+from core.models import Customer, Lot, Comment
+from core.benchmarks import summarize, load
+
+
+class Command(BaseCommand):
+    help = 'Compares requests/sec and latency of sync (WSGI) read endpoints and their async (ASGI) variants ' \
+           'under concurrent load. Both handlers run in this process against the configured database.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='requests per endpoint and mode')
+        parser.add_argument('--concurrency', type=int, default=64, help='requests in flight at once')
+        parser.add_argument('paths', nargs='*', help='paths without the async/ prefix, e.g. lots/')
+
+    def default_paths(self):
+        customer = Customer.objects.order_by('id').values_list('id', flat=True).first()
+        lot = Lot.objects.order_by('id').values_list('id', flat=True).first()
+        comment = Comment.objects.filter(reply_to=None).order_by('id').values_list('id', flat=True).first()
+        if None in (customer, lot, comment):
+            raise CommandError('there must be at least one customer, lot and comment (see seed command)')
+        return ['components', 'customer/owns/components/{}'.format(customer),
+                'customer/components/{}'.format(customer), 'customer/discounts/{}'.format(customer),
+                'lots/', 'lot/{}'.format(lot), 'comment/branch/{}'.format(comment)]
+
+    def bench_wsgi(self, path, requests, concurrency):
+        client = local()
+
+        def get():
+            if not hasattr(client, 'value'):
+                client.value = Client()
+            client.value.get(path)
+
+        return load(get, requests, concurrency, connections.close_all)
+
+    async def bench_asgi(self, path, requests, concurrency):
+        client = AsyncClient()
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                start = perf_counter()
+                await client.get(path)
+                latencies.append(perf_counter() - start)
+
+        start = perf_counter()
+        await asyncio.gather(*[one() for _ in range(requests)])
+        return summarize(latencies, perf_counter() - start)
+
+    def handle(self, *args, **options):
+        paths = options['paths'] or self.default_paths()
+        requests, concurrency = options['requests'], options['concurrency']
+
+        self.stdout.write('{:<40} {:>5} {:>10} {:>9} {:>9}'.format('path', 'mode', 'req/s', 'p50 ms', 'p99 ms'))
+        for path in paths:
+            path = '/' + path.lstrip('/')
+            for mode, result in (('wsgi', self.bench_wsgi(path, requests, concurrency)),
+                                 ('asgi', asyncio.run(self.bench_asgi('/async' + path, requests, concurrency)))):
+                self.stdout.write('{:<40} {:>5} {:>10.1f} {:>9.2f} {:>9.2f}'.format(
+                    path, mode, result['rps'], result['p50'], result['p99']))
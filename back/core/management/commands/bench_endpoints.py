@@ -0,0 +1,190 @@
+import json
+import os
+from itertools import cycle
+from pathlib import Path
+from threading import local
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.db.models import Count
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from core.models import *
+from core.benchmarks import endpoint_paths, load, regressions
+from core.catalog import catalog
+from core.discounts import discount_table, add_discounts
+from core.inventory import add_components, add_components_bulk
+from core.leaderboard import leaderboards
+from core.market import list_lot
+from core.roulette import sampler
+from core.search import recipe_index
+from core.usernames import usernames
+from core import urls, votes, viewcount
+
+
+# arguments of the seed command for each dataset size
+sizes = {
+    'small': {'customers': 1000, 'components': 100, 'ownerships': 10000, 'lots': 200, 'recipes': 200,
+              'replies': 2000},
+    'medium': {'customers': 10000, 'components': 300, 'ownerships': 100000, 'lots': 2000, 'recipes': 2000,
+               'replies': 20000},
+    'large': {'customers': 100000, 'components': 1000, 'ownerships': 1000000, 'lots': 20000, 'recipes': 20000,
+              'replies': 200000},
+}
+
+# requests are sent by threads with own clients and db connections
+def thread_client(clients):
+    if not hasattr(clients, 'client'):
+        clients.client = Client()
+    return clients.client
+
+
+default_baseline = Path(settings.BASE_DIR) / 'core' / 'bench_baseline.json'
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway test database of each given size and drives every GET endpoint of core.urls ' \
+           'and the POST endpoints with fixtures of their own through the test client, ' \
+           'reporting req/s, p50/p95/p99 latency and SQL queries per request. ' \
+           'Fails when an endpoint makes more queries than in the stored baseline, ' \
+           'with --check-latency also when it gets much slower'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', nargs='+', choices=sizes, default=['small'])
+        parser.add_argument('--requests', type=int, default=100, help='measured requests per endpoint')
+        parser.add_argument('--concurrency', type=int, default=1, help='threads sending requests')
+        parser.add_argument('--baseline', default=str(default_baseline))
+        parser.add_argument('--save-baseline', action='store_true', help='store results as the new baseline')
+        parser.add_argument('--check-latency', action='store_true',
+                            help='compare p95 latency with the baseline too, only meaningful on the machine '
+                                 'that recorded it and without other load')
+        parser.add_argument('--tolerance', type=float, default=2.0, help='allowed growth of p95 latency')
+        parser.add_argument('--min-ms', type=float, default=2.0,
+                            help='p95 growth in milliseconds ignored as noise of fast endpoints')
+
+    def endpoints(self):
+        comp_ids = Component.objects.order_by('id').values_list('id', flat=True)[:2]
+        samples = {
+            ('customer', 'pk'): ComponentOwnership.objects.order_by('owner_id')
+                                .values_list('owner_id', flat=True).first(),
+            ('lot', 'pk'): Lot.objects.filter(purchaser=None).order_by('id').values_list('id', flat=True).first(),
+            ('recipe', 'pk'): Recipe.objects.filter(is_private=False).order_by('id')
+                              .values_list('id', flat=True).first(),
+            # the biggest branch
+            ('comment', 'pk'): Comment.objects.filter(reply_to=None).annotate(n=Count('self_replies'))
+                               .order_by('-n', 'id').values_list('id', flat=True).first(),
+            'taste': 'swt',
+        }
+        samples['username'] = Customer.objects.get(id=samples['customer', 'pk']).username
+        queries = {'recipes/search': '?any={}'.format(','.join(map(str, comp_ids))), 'lots/': '?page=2'}
+        return endpoint_paths(urls.urlpatterns, samples, queries)
+
+    # ids of count new customers owning one comp_id each
+    def sellers(self, count, comp_id):
+        sellers = [seller.id for seller in Customer.objects.bulk_create([Customer() for _ in range(count)])]
+        add_components_bulk((seller, comp_id, 1) for seller in sellers)
+        return sellers
+
+    # POST endpoints with fixtures of their own so that every request does the same work
+    # returns [(route, next_request)] where next_request() gives (path, data) of the next request,
+    # count is the number of requests to make fixtures for (e.g. each lot can be bought once)
+    def post_endpoints(self, count):
+        percents = discount_table.get()
+        rarity = min(percents)
+        comp_id = Component.objects.filter(rarity__in=percents).order_by('id').values_list('id', flat=True).first()
+        recipe_id = Recipe.objects.filter(is_private=False).order_by('id').values_list('id', flat=True).first()
+        lot_id = Lot.objects.order_by('id').values_list('id', flat=True).first()
+        composition = [{'component': comp, 'qty': qty} for comp, qty in
+                       RecipeComposition.objects.filter(recipe_id=recipe_id).values_list('component_id', 'qty')]
+
+        customer = Customer.objects.create(username='bench_buyer', coins=10 ** 9).id
+        add_components(customer, {comp_id: 10 ** 6})
+        add_discounts(customer, {rarity: 10 ** 6})
+        # a component can be listed in one lot of the seller at a time, so every lot has its own seller
+        lots = iter([list_lot(seller, {comp_id: 1}, 1).id for seller in self.sellers(count, comp_id)])
+        new_lot_sellers = iter(self.sellers(count, comp_id))
+        # switching the vote and the reaction changes them on every request
+        lot_votes = cycle(['up', 'down'])
+        reactions = cycle(Reaction.objects.order_by('id').values_list('id', flat=True)[:2])
+
+        return [
+            ('customer/lot/<int:pk>', lambda: ('/customer/lot/{}'.format(next(new_lot_sellers)), {
+                'components': [{'component': comp_id, 'qty': 1}], 'price': 1})),
+            ('customer/checkout/<int:pk>', lambda: ('/customer/checkout/{}'.format(customer), {
+                'recipes': [{'recipe': recipe_id, 'qty': 1}], 'discount': rarity})),
+            ('lot/buy/<int:pk>', lambda: ('/lot/buy/{}'.format(next(lots)), {'customer': customer})),
+            ('customer/exchange/<int:pk>', lambda: ('/customer/exchange/{}'.format(customer), {
+                'components': [{'component': comp_id, 'qty': 1}]})),
+            ('lot/vote/<int:pk>', lambda: ('/lot/vote/{}'.format(lot_id), {
+                'customer': customer, 'vote': next(lot_votes)})),
+            ('recipe/react/<int:pk>', lambda: ('/recipe/react/{}'.format(recipe_id), {
+                'customer': customer, 'reaction': next(reactions)})),
+            ('recipe/validate', lambda: ('/recipe/validate', {'composition': composition})),
+        ]
+
+    def bench(self, size, options):
+        with open(os.devnull, 'w') as devnull:
+            call_command('seed', stdout=devnull, **sizes[size])
+        for cache in (catalog, sampler, discount_table, leaderboards, recipe_index):
+            cache.invalidate()
+        usernames.clear()
+
+        # (endpoint, shown path, request(client))
+        scenarios = [(route, path, lambda client, path=path: client.get(path)) for route, path in self.endpoints()]
+        # fixtures of POST endpoints are made after GET endpoints are measured so they don't change their data,
+        # every request is made once to fill caches and once to count queries
+        posts = self.post_endpoints(options['requests'] + 2)
+        scenarios += [('POST ' + route, 'POST /' + route, lambda client, next_request=next_request: client.post(
+            *next_request(), content_type='application/json')) for route, next_request in posts]
+
+        client, clients = Client(), local()
+        results = {}
+        for endpoint, path, request in scenarios:
+            # the first request fills in-process caches, the second one is counted
+            request(client)
+            with CaptureQueriesContext(connection) as queries:
+                status = request(client).status_code
+            if status >= 400:
+                self.stderr.write('{} responded {}, skipped'.format(path, status))
+                continue
+            result = load(lambda: request(thread_client(clients)), options['requests'], options['concurrency'],
+                          connections.close_all)
+            result['queries'] = len(queries)
+            results['{} x{} {}'.format(size, options['concurrency'], endpoint)] = result
+            self.stdout.write('{:<48} {:>9.1f} {:>8.2f} {:>8.2f} {:>8.2f} {:>8}'.format(
+                '{} {}'.format(size, path), result['rps'], result['p50'], result['p95'], result['p99'],
+                result['queries']))
+        # buffered counters are written to this database, not to the one restored after the run
+        votes.flush()
+        viewcount.views.flush()
+        return results
+
+    def handle(self, *args, **options):
+        self.stdout.write('{:<48} {:>9} {:>8} {:>8} {:>8} {:>8}'.format(
+            'endpoint', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+        results = {}
+        for size in options['sizes']:
+            self.stderr.write('Seeding {} dataset...'.format(size))
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                results.update(self.bench(size, options))
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        baseline_path = Path(options['baseline'])
+        baseline = json.loads(baseline_path.read_text()) if baseline_path.exists() else {}
+        if options['save_baseline']:
+            baseline.update({endpoint: {key: round(value, 3) for key, value in result.items()}
+                             for endpoint, result in results.items()})
+            baseline_path.write_text(json.dumps(baseline, indent=2, sort_keys=True) + '\n')
+            self.stdout.write('Baseline saved to {}'.format(baseline_path))
+            return
+
+        found = regressions(results, baseline, options['tolerance'] if options['check_latency'] else None,
+                            options['min_ms'])
+        if found:
+            raise CommandError('regressions against {}:\n{}'.format(baseline_path, '\n'.join(found)))
+        self.stdout.write('No regressions against {}'.format(baseline_path))
@@ -0,0 +1,67 @@
+import os
+from time import perf_counter
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+
+from core.models import *
+from core.renderers import fast_renderer, orjson
+from core.serializers import *
+
+
+class Command(BaseCommand):
+    help = 'Seeds a throwaway test database and compares rows/sec of rendering components, ownerships ' \
+           'and lots with DRF serializers + JSONRenderer against values() rows + FastJSONRenderer. ' \
+           'Fails if the outputs differ by a single byte'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='rows of each kind')
+        parser.add_argument('--repeat', type=int, default=5, help='the best of this many runs is reported')
+
+    def best(self, func, repeat):
+        times = []
+        for _ in range(repeat):
+            start = perf_counter()
+            result = func()
+            times.append(perf_counter() - start)
+        return min(times), result
+
+    def handle(self, *args, **options):
+        rows, repeat = options['rows'], options['repeat']
+        renderer = JSONRenderer()
+        components = Component.objects.order_by('id')
+        lots = Lot.objects.filter(purchaser=None).order_by('id')
+        cases = (
+            ('components',
+             lambda: renderer.render(BriefComponentSr(components.select_related('type'), many=True).data),
+             lambda: fast_renderer.render(brief_components(components))),
+            ('ownerships',
+             lambda: renderer.render(ComponentOwnershipSr(
+                 ComponentOwnership.objects.order_by('id').only('component_id', 'qty'), many=True).data),
+             lambda: fast_renderer.render(component_ownerships(ComponentOwnership.objects.order_by('id')))),
+            ('lots',
+             lambda: renderer.render(BriefLotSr(lots.prefetch_related(Prefetch(
+                 'consist_of', ComponentOwnership.objects.only('lot_id', 'component_id', 'lot_qty'))),
+                 many=True).data),
+             lambda: fast_renderer.render(brief_lots(list(lots.only('id', 'price'))))),
+        )
+
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with open(os.devnull, 'w') as devnull:
+                call_command('seed', stdout=devnull, customers=rows, components=rows, ownerships=rows, lots=rows,
+                             recipes=0, reactions=0, replies=0)
+            self.stdout.write('orjson {}'.format('is used' if orjson is not None else 'isn\'t installed'))
+            self.stdout.write('{:<12} {:>14} {:>14} {:>8}'.format('rows', 'serializer/s', 'values/s', 'gain'))
+            for name, slow, fast in cases:
+                slow_time, slow_json = self.best(slow, repeat)
+                fast_time, fast_json = self.best(fast, repeat)
+                if slow_json != fast_json:
+                    raise CommandError('{}: fast path output differs from serializers'.format(name))
+                self.stdout.write('{:<12} {:>14.0f} {:>14.0f} {:>7.1f}x'.format(
+                    name, rows / slow_time, rows / fast_time, slow_time / fast_time))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -0,0 +1,44 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.bulk import core_models, dependency_order, export_rows, write_rows, formats
+
+
+class Command(BaseCommand):
+    help = 'Streams core tables out as JSONL or CSV. One table is written to --output (stdout by default), ' \
+           'several tables (all when none are given) are written into --dir as <table>.<format>'
+
+    def add_arguments(self, parser):
+        parser.add_argument('tables', nargs='*', help='e.g. customer componentownership lot_upvotes')
+        parser.add_argument('--format', choices=formats, default='jsonl')
+        parser.add_argument('--output', default='-', help='file of a single table, - for stdout')
+        parser.add_argument('--dir', help='directory for several tables')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='rows fetched from the db at once')
+
+    def handle(self, *args, **options):
+        models = core_models()
+        unknown = set(options['tables']) - set(models)
+        if unknown:
+            raise CommandError('unknown tables {}, available: {}'.format(sorted(unknown), ', '.join(sorted(models))))
+        tables = options['tables'] or [model._meta.model_name for model in dependency_order(list(models.values()))]
+        if len(tables) > 1 and not options['dir']:
+            raise CommandError('--dir is required to export several tables')
+
+        fmt = options['format']
+        for name in tables:
+            if options['dir']:
+                path = Path(options['dir']) / '{}.{}'.format(name, fmt)
+                path.parent.mkdir(parents=True, exist_ok=True)
+                stream = open(path, 'w', newline='', encoding='utf-8')
+            elif options['output'] == '-':
+                stream = sys.stdout
+            else:
+                stream = open(options['output'], 'w', newline='', encoding='utf-8')
+            try:
+                count = write_rows(export_rows(models[name], options['chunk_size']), fmt, stream, models[name])
+            finally:
+                if stream is not sys.stdout:
+                    stream.close()
+            self.stderr.write('Exported {} rows of {}'.format(count, name))
@@ -0,0 +1,45 @@
+import sys
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.bulk import core_models, dependency_order, read_rows, import_rows, reset_sequences, formats
+from core.catalog import catalog
+
+
+class Command(BaseCommand):
+    help = 'Streams JSONL or CSV rows into core tables with bulk_create in batched transactions. ' \
+           'Either one table is read from --input (stdin by default) or every <table>.<format> file of --dir ' \
+           'is imported in the order of foreign keys. Signals aren\'t sent: run reprice_recipes and ' \
+           'reconcile_counters after importing recipes, components or votes written by other tools'
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', nargs='?', help='table of --input, e.g. customer')
+        parser.add_argument('--format', choices=formats, default='jsonl')
+        parser.add_argument('--input', default='-', help='file of the table, - for stdin')
+        parser.add_argument('--dir', help='directory with <table>.<format> files')
+        parser.add_argument('--batch-size', type=int, default=2000, help='rows per INSERT transaction')
+        parser.add_argument('--update', action='store_true', help='update existing rows by pk instead of failing')
+
+    def handle(self, *args, **options):
+        models = core_models()
+        fmt = options['format']
+        if options['dir']:
+            files = {model: Path(options['dir']) / '{}.{}'.format(model._meta.model_name, fmt)
+                     for model in dependency_order(list(models.values()))}
+            files = {model: path for model, path in files.items() if path.exists()}
+        elif options['table'] in models:
+            files = {models[options['table']]: options['input']}
+        else:
+            raise CommandError('either --dir or one of tables is required: {}'.format(', '.join(sorted(models))))
+
+        for model, path in files.items():
+            stream = sys.stdin if path == '-' else open(path, newline='', encoding='utf-8')
+            try:
+                count = import_rows(model, read_rows(fmt, stream, model), options['batch_size'], options['update'])
+            finally:
+                if stream is not sys.stdin:
+                    stream.close()
+            self.stdout.write('Imported {} rows of {}'.format(count, model._meta.model_name))
+        reset_sequences(list(files))
+        catalog.invalidate()
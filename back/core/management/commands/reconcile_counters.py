@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Count, Value, F
+from django.db.models.functions import Coalesce
+
+from core.models import Lot, CustomersReactToRecipes, RecipeReactionsCount
+from core.votes import upvotes, downvotes, flush
+
+
+def count_of(relation, field):
+    return Coalesce(Subquery(
+        relation.objects.filter(**{field: OuterRef('pk')})
+        .values(field).annotate(n=Count('*')).values('n')), Value(0))
+
+
+class Command(BaseCommand):
+    help = 'Recomputes vote and reaction counters from upvotes, downvotes and CustomersReactToRecipes. ' \
+           'Run it while the workers are stopped: deltas still buffered by a running worker (see votes.py) ' \
+           'would be added on top of the recomputed counters'
+
+    def handle(self, *args, **options):
+        # only deltas buffered by this process (e.g. when called by seed or tests),
+        # buffers of other processes can't be reached from here
+        flush()
+        with transaction.atomic():
+            lots = Lot.objects.update(upvotes_count=count_of(upvotes, 'lot_id'),
+                                      downvotes_count=count_of(downvotes, 'lot_id'))
+            Lot.objects.update(rating=F('upvotes_count') - F('downvotes_count'))
+
+            counts = CustomersReactToRecipes.objects.values('recipe_id', 'reaction_id') \
+                .annotate(n=Count('*')).values_list('recipe_id', 'reaction_id', 'n')
+            RecipeReactionsCount.objects.bulk_create(
+                [RecipeReactionsCount(recipe_id=recipe_id, reaction_id=reaction_id, qty=n)
+                 for recipe_id, reaction_id, n in counts.iterator()],
+                batch_size=500, update_conflicts=True,
+                unique_fields=['recipe', 'reaction'], update_fields=['qty'])
+            reactions = RecipeReactionsCount.objects.update(qty=Coalesce(Subquery(
+                CustomersReactToRecipes.objects
+                .filter(recipe_id=OuterRef('recipe_id'), reaction_id=OuterRef('reaction_id'))
+                .values('recipe_id').annotate(n=Count('*')).values('n')), Value(0)))
+        self.stdout.write('Reconciled {} lots and {} reaction counters'.format(lots, reactions))
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from core.pricing import reprice
+
+
+class Command(BaseCommand):
+    help = 'Recomputes prices of all recipes from their composition and component costs'
+
+    def handle(self, *args, **options):
+        self.stdout.write('Repriced {} recipes'.format(reprice()))
@@ -0,0 +1,120 @@
+import random
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from core.models import *
+from core.bulk import bulk_insert, reset_sequences
+from core.catalog import catalog
+from core.pricing import reprice
+
+
+types = ('wrp', 'tpp', 'sau', 'dcr', 'bvr', 'dpn')
+tastes = ('dsg', 'ins', 'swt', 'slt', 'btr', 'sor', 'ppr')
+# rarity: percents of its discount
+discounts = {1: 50, 2: 35, 3: 25, 4: 15, 5: 10, 6: 5}
+
+
+# first free id of the model, synthetic rows get consecutive explicit ids
+# so that rows referencing them are generated without reading ids back
+def next_id(model):
+    return (model.objects.aggregate(last=Max('pk'))['last'] or 0) + 1
+
+
+class Command(BaseCommand):
+    help = 'Generates a synthetic dataset of the given size for load testing. Rows are generated lazily ' \
+           'and inserted in batched transactions so memory doesn\'t depend on the size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--components', type=int, default=100)
+        parser.add_argument('--ownerships', type=int, default=10000,
+                            help='ComponentOwnership rows, at most customers * components')
+        parser.add_argument('--lots', type=int, default=100, help='at most customers')
+        parser.add_argument('--recipes', type=int, default=100)
+        parser.add_argument('--reactions', type=int, default=1000, help='at most customers * recipes')
+        parser.add_argument('--replies', type=int, default=1000, help='replies to comments of lots, recipes and replies')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--seed', type=int, default=0, help='seed of the random generator')
+
+    def insert(self, model, objects):
+        count = bulk_insert(model, objects, self.batch_size)
+        self.stdout.write('Created {} rows of {}'.format(count, model._meta.model_name))
+
+    def handle(self, *args, **options):
+        customers, components = options['customers'], options['components']
+        ownerships, lots, recipes = options['ownerships'], options['lots'], options['recipes']
+        if ownerships > customers * components or lots > customers or (recipes and not customers) \
+                or options['reactions'] > customers * recipes:
+            raise CommandError('ownerships must be at most customers * components, lots at most customers, '
+                               'reactions at most customers * recipes and recipes need customers')
+        if options['replies'] and not lots + recipes:
+            raise CommandError('replies need comments of lots or recipes')
+        if recipes and components < 3:
+            raise CommandError('recipes consist of 3 components, there must be at least 3 of them')
+        rnd = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+
+        # reference tables are created once
+        if not ComponentType.objects.exists():
+            self.insert(ComponentType, (ComponentType(name=name, measure='q' if name == 'dcr' else 'g')
+                                        for name in types))
+        if not Discount.objects.exists():
+            self.insert(Discount, (Discount(rarity=rarity, percents=percents)
+                                   for rarity, percents in discounts.items()))
+        if not Reaction.objects.exists():
+            self.insert(Reaction, (Reaction(taste=taste) for taste in tastes))
+        type_ids = list(ComponentType.objects.values_list('id', flat=True))
+
+        comp0 = next_id(Component)
+        self.insert(Component, (Component(
+            id=comp0 + i, type_id=rnd.choice(type_ids), rarity=rnd.choices(range(1, 7), (1, 2, 4, 8, 16, 32))[0],
+            cost=rnd.randint(10, 1000), min_qty=10, max_qty=rnd.randrange(50, 500, 10), qty_step=10,
+            name='comp{}'.format(comp0 + i), name_in_with='comp{}'.format(comp0 + i))
+            for i in range(components)))
+
+        cust0 = next_id(Customer)
+        self.insert(Customer, (Customer(id=cust0 + i, username='customer{}'.format(cust0 + i),
+                                        coins=rnd.randint(0, 10000)) for i in range(customers)))
+
+        # customer i sells lot i, comments and stats of lots go before the ones of recipes
+        comm0, stat0, lot0 = next_id(Comment), next_id(Stat), next_id(Lot)
+        self.insert(Comment, (Comment(id=comm0 + i, author_id=cust0 + i % customers, text='seed {}'.format(i))
+                              for i in range(lots + recipes)))
+        self.insert(Stat, (Stat(id=stat0 + i, views=rnd.randint(0, 1000)) for i in range(lots + recipes)))
+        self.insert(Lot, (Lot(id=lot0 + i, seller_comm_id=comm0 + i, stat_id=stat0 + i,
+                              price=rnd.randint(1, 1000), rating=rnd.randint(-50, 50)) for i in range(lots)))
+
+        # row i belongs to customer i % customers and component i // customers, so pairs are unique
+        # and the first component of the first customers is listed in their lots
+        self.insert(ComponentOwnership, (ComponentOwnership(
+            owner_id=cust0 + i % customers, component_id=comp0 + i // customers, qty=rnd.randint(0, 20),
+            lot_id=lot0 + i if i < lots else None, lot_qty=1 if i < lots else None)
+            for i in range(ownerships)))
+
+        recipe0 = next_id(Recipe)
+        self.insert(Recipe, (Recipe(id=recipe0 + i, author_comm_id=comm0 + lots + i, stat_id=stat0 + lots + i,
+                                    is_private=rnd.random() < 0.3, rating=rnd.randint(-50, 50))
+                             for i in range(recipes)))
+        self.insert(RecipeComposition, (
+            RecipeComposition(recipe_id=recipe0 + i, component_id=comp_id, qty=rnd.randrange(10, 50, 10))
+            for i in range(recipes) for comp_id in rnd.sample(range(comp0, comp0 + components), 3)))
+
+        # like ownerships, reaction i is given to recipe i % recipes by customer i // recipes
+        reaction_ids = list(Reaction.objects.values_list('id', flat=True))
+        self.insert(CustomersReactToRecipes, (CustomersReactToRecipes(
+            recipe_id=recipe0 + i % recipes, customer_id=cust0 + i // recipes, reaction_id=rnd.choice(reaction_ids))
+            for i in range(options['reactions'])))
+
+        # reply j answers any of comments created before it, forming branches of random depth
+        comments = lots + recipes
+        self.insert(Comment, (Comment(id=comm0 + comments + j, author_id=cust0 + rnd.randrange(customers),
+                                      reply_to_id=rnd.randrange(comm0, comm0 + comments + j),
+                                      text='reply {}'.format(j))
+                              for j in range(options['replies'])))
+
+        reset_sequences([Component, Customer, Comment, Stat, Lot, Recipe])
+        reprice()
+        call_command('reconcile_counters', stdout=self.stdout)
+        catalog.invalidate()
@@ -0,0 +1,56 @@
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F
+from rest_framework.exceptions import APIException, ValidationError
+
+from .models import Customer, Comment, Stat, Lot
+from .inventory import reserve_for_lot, transfer_lot
+
+
+class LotUnavailable(APIException):
+    status_code = 409
+    default_detail = 'lot is already sold or being bought by another customer'
+    default_code = 'lot_unavailable'
+
+
+# creates lot of seller's components {component_id: qty} in one transaction,
+# listed qty moves from ComponentOwnership.qty into lot_qty of the same rows
+def list_lot(seller_id, components, price, text=''):
+    with transaction.atomic():
+        comment = Comment.objects.create(author_id=seller_id, text=text)
+        lot = Lot.objects.create(seller_comm=comment, stat=Stat.objects.create(), price=price)
+        reserve_for_lot(seller_id, lot.id, components)
+    return lot
+
+
+# buys lot in one short transaction: purchaser is set, coins are moved from buyer to seller
+# and components are moved to the buyer's ownerships
+# the lot is claimed first by conditional update of purchaser so exactly one of racing buyers wins,
+# where the DB supports NOWAIT the lot row is locked before without waiting so the others
+# get LotUnavailable at once instead of waiting for the winner's commit,
+# customers rows are updated in order of id so two purchases can't deadlock
+def buy_lot(lot_id, buyer_id):
+    lots = Lot.objects.filter(id=lot_id)
+    with transaction.atomic():
+        if connection.features.has_select_for_update_nowait:
+            try:
+                list(lots.select_for_update(nowait=True).values_list('id'))
+            except DatabaseError:
+                raise LotUnavailable()
+        if not lots.filter(purchaser=None).update(purchaser_id=buyer_id):
+            if not lots.exists():
+                raise ValidationError('there is no lot {}'.format(lot_id))
+            raise LotUnavailable()
+
+        price, seller_id = lots.values_list('price', 'seller_comm__author_id').get()
+        if seller_id == buyer_id:
+            raise ValidationError('customer can not buy own lot')
+        for customer_id in sorted((buyer_id, seller_id)):
+            if customer_id == buyer_id:
+                if not Customer.objects.filter(id=buyer_id, coins__gte=price).update(
+                        coins=F('coins') - price, inventory_version=F('inventory_version') + 1):
+                    raise ValidationError('not enough coins')
+            else:
+                Customer.objects.filter(id=seller_id).update(
+                    coins=F('coins') + price, inventory_version=F('inventory_version') + 1)
+
+        transfer_lot(lot_id, buyer_id)
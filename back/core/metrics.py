@@ -0,0 +1,136 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from threading import Lock
+from time import perf_counter
+
+
+# in-process request metrics exported in Prometheus text format (see PerformanceMiddleware)
+# every worker process has its own registry, the scraper sums them up by instance
+
+# upper bounds of histogram buckets in seconds
+buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(buckets, value)] += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        total = 0
+        for bound, count in zip(buckets + ('+Inf',), self.counts):
+            total += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, total)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, total)
+
+
+# serialization time of the current request, None outside of requests measured by PerformanceMiddleware
+# the timer is shared with threads of sync_to_async (they copy the context, not the timer)
+serialization = ContextVar('serialization', default=None)
+
+
+class SerializationTimer:
+    def __init__(self):
+        self.time = 0.0
+        self.depth = 0
+
+
+@contextmanager
+def serialization_timer():
+    timer = SerializationTimer()
+    token = serialization.set(timer)
+    try:
+        yield timer
+    finally:
+        serialization.reset(token)
+
+
+# adds time of func calls to serialization time of the request, only the outermost call is measured
+# so nested serializers aren't counted twice (queries made while serializing are counted as db time too)
+def timed_serialization(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        timer = serialization.get()
+        if timer is None or timer.depth:
+            return func(*args, **kwargs)
+        timer.depth += 1
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            timer.time += perf_counter() - start
+            timer.depth -= 1
+    return wrapper
+
+
+class ViewMetrics:
+    def __init__(self):
+        self.duration = Histogram()
+        self.db_duration = Histogram()
+        self.serializer_duration = Histogram()
+        self.render_duration = Histogram()
+        self.queries = 0
+        self.responses = {}
+
+
+class Registry:
+    histograms = (
+        ('duration', 'core_request_duration_seconds', 'Total time of requests'),
+        ('db_duration', 'core_request_db_duration_seconds', 'Time of SQL queries per request'),
+        ('serializer_duration', 'core_request_serializer_duration_seconds', 'Time of serializing data per request'),
+        ('render_duration', 'core_request_render_duration_seconds', 'Time of rendering responses'),
+    )
+
+    def __init__(self):
+        self._lock = Lock()
+        self._views = {}
+
+    def observe(self, view, status, total, db_time, queries, serializer_time, render_time):
+        with self._lock:
+            metrics = self._views.get(view)
+            if metrics is None:
+                metrics = self._views[view] = ViewMetrics()
+            metrics.duration.observe(total)
+            metrics.db_duration.observe(db_time)
+            metrics.serializer_duration.observe(serializer_time)
+            metrics.render_duration.observe(render_time)
+            metrics.queries += queries
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._views = {}
+
+    def render(self):
+        lines = []
+        with self._lock:
+            views = sorted(self._views.items())
+            for attr, name, help_text in self.histograms:
+                lines += ['# HELP {} {}'.format(name, help_text), '# TYPE {} histogram'.format(name)]
+                for view, metrics in views:
+                    lines += getattr(metrics, attr).lines(name, 'view="{}"'.format(escape(view)))
+
+            lines += ['# HELP core_db_queries_total SQL queries made by requests',
+                      '# TYPE core_db_queries_total counter']
+            lines += ['core_db_queries_total{{view="{}"}} {}'.format(escape(view), metrics.queries)
+                      for view, metrics in views]
+
+            lines += ['# HELP core_responses_total Responses by status code',
+                      '# TYPE core_responses_total counter']
+            lines += ['core_responses_total{{view="{}",status="{}"}} {}'.format(escape(view), status, count)
+                      for view, metrics in views for status, count in sorted(metrics.responses.items())]
+        return '\n'.join(lines) + '\n'
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+registry = Registry()
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import traceback
+from time import perf_counter
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from .db import request_wrapper
+from .metrics import registry, serialization_timer
+from .routers import primary_pinned
+
+
+safe_methods = ('GET', 'HEAD', 'OPTIONS')
+
+slow_queries = logging.getLogger('core.slow_queries')
+
+
+# middleware working in both modes like django's MiddlewareMixin: while the rest of the chain is async
+# (ASGI with async views) __call__ returns the coroutine of __acall__, so neither the middleware
+# nor the async views behind it are run in a thread of sync_to_async
+class SyncAndAsyncMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = asyncio.iscoroutinefunction(get_response)
+        if self.is_async:
+            # makes the handler see the instance as a coroutine function
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+
+# remembers whether the request has written to the primary, reads made after the first write
+# of the request are routed to the primary as well
+class PrimaryWrites:
+    statements = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+    def __init__(self):
+        self.seen = False
+
+    def __call__(self, execute, sql, params, many, context):
+        if not self.seen and context['connection'].alias == DEFAULT_DB_ALIAS \
+                and sql.lstrip().upper().startswith(self.statements):
+            self.seen = True
+            primary_pinned.set(True)
+        return execute(sql, params, many, context)
+
+
+# reads of unsafe requests, reads following a write and reads of requests made shortly after
+# a request that has written to the primary (whatever its method, e.g. GET of roulette writes ownerships)
+# are routed to the primary so a customer always sees own changes despite the replication lag
+class PrimaryPinningMiddleware(SyncAndAsyncMiddleware):
+    cookie = 'pin_primary'
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        writes, token = self.start(request)
+        try:
+            with request_wrapper(writes):
+                response = self.get_response(request)
+        finally:
+            primary_pinned.reset(token)
+        return self.finish(response, writes)
+
+    async def __acall__(self, request):
+        writes, token = self.start(request)
+        try:
+            with request_wrapper(writes):
+                response = await self.get_response(request)
+        finally:
+            primary_pinned.reset(token)
+        return self.finish(response, writes)
+
+    def start(self, request):
+        pinned = request.method not in safe_methods or self.cookie in request.COOKIES
+        return PrimaryWrites(), primary_pinned.set(pinned)
+
+    def finish(self, response, writes):
+        if writes.seen and settings.DATABASE_REPLICAS:
+            response.set_cookie(self.cookie, '1', max_age=settings.REPLICA_PIN_SECONDS,
+                                httponly=True, samesite='Lax')
+        return response
+
+
+# counts queries and their time of one request, logs queries slower than slow_query_ms if it's set
+class QueryStats:
+    def __init__(self, slow_query_ms=None):
+        self.slow_query_ms = slow_query_ms
+        self.queries = 0
+        self.time = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = perf_counter() - start
+            self.queries += 1
+            self.time += duration
+            if self.slow_query_ms is not None and duration * 1000 >= self.slow_query_ms:
+                # only frames of the project, django and drf frames are the same for every query
+                stack = [frame for frame in traceback.extract_stack()[:-1]
+                         if frame.filename.startswith(str(settings.BASE_DIR))]
+                slow_queries.warning('slow query %.1f ms on %s: %s\n%s', duration * 1000,
+                                     context['connection'].alias, sql, ''.join(traceback.format_list(stack)))
+
+
+# records total, db, serializer and render time and the number of queries of every request by the matched
+# route into metrics.registry (exported by the metrics endpoint) and the Server-Timing header
+# serializer time is time of serializers and their serializer-free equivalents (see serializers.py)
+# it's placed first in MIDDLEWARE so that the total includes other middleware
+class PerformanceMiddleware(SyncAndAsyncMiddleware):
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.server_timing = getattr(settings, 'PERF_SERVER_TIMING', True)
+        self.slow_query_ms = getattr(settings, 'PERF_SLOW_QUERY_MS', None)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        stats, start = self.start(request)
+        with request_wrapper(stats), serialization_timer() as serialization:
+            response = self.get_response(request)
+        return self.finish(request, response, stats, serialization, start)
+
+    async def __acall__(self, request):
+        stats, start = self.start(request)
+        with request_wrapper(stats), serialization_timer() as serialization:
+            response = await self.get_response(request)
+        return self.finish(request, response, stats, serialization, start)
+
+    def start(self, request):
+        request._perf_view_end = None
+        return QueryStats(self.slow_query_ms), perf_counter()
+
+    def finish(self, request, response, stats, serialization, start):
+        end = perf_counter()
+        # DRF responses are rendered after the view returns (see process_template_response)
+        view_end = request._perf_view_end
+        render_time = end - view_end if view_end is not None else 0.0
+        match = request.resolver_match
+        registry.observe(match.route if match is not None else 'unmatched', response.status_code,
+                         end - start, stats.time, stats.queries, serialization.time, render_time)
+        if self.server_timing:
+            response['Server-Timing'] = 'db;dur={:.2f};desc="{} queries", serializer;dur={:.2f}, ' \
+                                        'render;dur={:.2f}, total;dur={:.2f}'.format(
+                stats.time * 1000, stats.queries, serialization.time * 1000, render_time * 1000,
+                (end - start) * 1000)
+        return response
+
+    def process_template_response(self, request, response):
+        request._perf_view_end = perf_counter()
+        return response
@@ -1,6 +1,6 @@
 from django.db.models import Model, CASCADE, SET_NULL, SET_DEFAULT, RESTRICT, \
     IntegerField, PositiveIntegerField, PositiveSmallIntegerField, CharField, TextField, \
-    BooleanField, ForeignKey, ManyToManyField
+    BooleanField, ForeignKey, ManyToManyField, UniqueConstraint, Index, Q
 
 # general types of components, classified by using in the same way
 class ComponentType(Model):
@@ -44,6 +44,11 @@ class Component(Model):
     # related fields
     # owned_by, contained_in
 
+    class Meta:
+        # for filters by rarity (e.g. bench fixtures); the roulette and exchange don't query by it:
+        # the sampler loads all (id, rarity) pairs once per catalog version and exchange looks up by id
+        indexes = [Index(fields=['rarity'], name='component_rarity_idx')]
+
     def __str__(self):
         return 'Компонент {}'.format(self.name)
 
@@ -66,11 +71,18 @@ class Discount(Model):
 
 # TODO: add AbstractUser with authorization
 class Customer(Model):
+    # unique index, resolved to id by usernames.py in <str:username> routes
+    # routes with <int:pk> go first so usernames consisting of digits only are unreachable by urls
+    username = CharField(max_length=150, unique=True, null=True, blank=True, default=None)
     components = ManyToManyField('Component', related_name='owned_by',
                                         through='ComponentOwnership')
     discounts = ManyToManyField('Discount', related_name='owned_by',
                                        through='DiscountOwnership')
     coins = PositiveIntegerField(default=0)
+    # incremented by every change of customer's components, discounts or coins: by inventory.py,
+    # discounts.py, checkout.py and market.py and by signals on save() and delete() of customers and
+    # their ownerships (see signals.py), used as etag of the inventory snapshot
+    inventory_version = PositiveIntegerField(default=0)
 
     # related fields
     # bought_lots, written_comments, upvote_for, downvote_for, react_with, created_orders
@@ -90,6 +102,10 @@ class ComponentOwnership(Model):
                             null=True, on_delete=SET_NULL, default=None)
     lot_qty = PositiveSmallIntegerField(null=True, default=None)
 
+    class Meta:
+        # each customer has at most one row per component, qty is changed via inventory.py
+        constraints = [UniqueConstraint(fields=['owner', 'component'], name='unique_component_ownership')]
+
     def __str__(self):
         return '{} владеет компонентом {} в количестве {} шт' \
             .format(str(self.owner), self.component.name, str(self.qty))
@@ -103,6 +119,9 @@ class DiscountOwnership(Model):
     # related fields
     # applied_to
 
+    class Meta:
+        constraints = [UniqueConstraint(fields=['owner', 'rarity'], name='unique_discount_ownership')]
+
     def __str__(self):
         return '{} владеет скидкой на {}% в количестве {}' \
             .format(str(self.owner), str(self.rarity.percents), str(self.qty))
@@ -128,6 +147,7 @@ class Comment(Model):
 # common stat for Lot and Recipe
 class Stat(Model):
     # lets count requests from backend from authorized customers
+    # incremented in batches by viewcount.py
     views = PositiveIntegerField(default=0)
     # updated in views.py before creating comment
     comments_count = PositiveIntegerField(default=0)
@@ -169,7 +189,7 @@ class Lot(Model):
     upvotes = ManyToManyField('Customer', related_name='upvote_for')
     downvotes = ManyToManyField('Customer', related_name='downvote_for')
     # for fast estimation of how many up/down votes were given at specific lot
-    # updated in views.py before updating the vote from one frontend
+    # updated in batches by votes.py after the vote is saved, rating = upvotes - downvotes
     upvotes_count = PositiveIntegerField(default=0)
     downvotes_count = PositiveIntegerField(default=0)
 
@@ -177,7 +197,11 @@ class Lot(Model):
     # consist_of
 
     class Meta:
-        ordering = ['rating']
+        # id breaks ties of equal ratings so the order is stable for paginators
+        ordering = ['rating', 'id']
+        # open lots by rating for paginators, bought lots of a customer by rating
+        indexes = [Index(fields=['rating', 'id'], condition=Q(purchaser=None), name='open_lots_idx'),
+                   Index(fields=['purchaser', 'rating'], name='bought_lots_idx')]
 
     def __str__(self):
         return '{} предлагает че-то купить за {}' \
@@ -191,6 +215,7 @@ class Recipe(Model):
                                     on_delete=RESTRICT)
     composition = ManyToManyField('Component', related_name='contained_in',
                                          through='RecipeComposition')
+    # derived from composition and component costs by pricing.py
     price = PositiveIntegerField(default=0)
     is_private = BooleanField(default=True)
     # fast estimation for ordering
@@ -202,7 +227,7 @@ class Recipe(Model):
     reactions = ManyToManyField('Customer', related_name='react_with',
                                 through='CustomersReactToRecipes')
     # for fast estimation of how many reactions of each type at specific recipe were given
-    # updated in views.py before updating the reaction from each frontend
+    # updated in batches by votes.py after the reaction is saved
     reactions_count = ManyToManyField('Reaction', related_name='times_reacted',
                                       through='RecipeReactionsCount')
 
@@ -211,6 +236,8 @@ class Recipe(Model):
 
     class Meta:
         ordering = ['rating']
+        # private recipes never get into leaderboards and search (see leaderboard.py, search.py)
+        indexes = [Index(fields=['is_private', 'rating'], name='recipe_visibility_idx')]
 
     def __str__(self):
         return 'Рецепт {} от {}' \
@@ -236,6 +263,10 @@ class CustomersReactToRecipes(Model):
     customer = ForeignKey('Customer', on_delete=CASCADE)
     reaction = ForeignKey('Reaction', related_name='reacted_to', on_delete=CASCADE)
 
+    class Meta:
+        # one reaction per customer, changed via votes.py
+        constraints = [UniqueConstraint(fields=['recipe', 'customer'], name='unique_recipe_reaction')]
+
     def __str__(self):
         return '{} отреагировал: {}'.format(str(self.customer), str(self.reaction))
 
@@ -247,6 +278,9 @@ class RecipeReactionsCount(Model):
     reaction = ForeignKey('Reaction', on_delete=CASCADE)
     qty = PositiveIntegerField(default=0)
 
+    class Meta:
+        constraints = [UniqueConstraint(fields=['recipe', 'reaction'], name='unique_reactions_count')]
+
     def __str__(self):
         return '{} реакций {} на {}'.format(str(self.qty), str(self.reaction), str(self.recipe))
 
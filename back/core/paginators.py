@@ -1,5 +1,80 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import b64decode, b64encode
+from urllib.parse import parse_qs, urlencode
+
+from django.db.models import Q
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import PageNumberPagination, BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 
 
 class LotsPg(PageNumberPagination):
     page_size = 20
+
+
+# keyset pagination by (rating, id): neither COUNT(*) nor OFFSET, every page is an index range scan
+# cursor is an opaque token with the key of the boundary row and the direction of moving
+class LotsCursorPg(BasePagination):
+    page_size = 20
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded is None:
+            return None
+        try:
+            tokens = parse_qs(b64decode(encoded.encode('ascii')).decode('ascii'), strict_parsing=True)
+            return int(tokens['r'][0]), int(tokens['i'][0]), tokens['d'][0] == 'p'
+        except (TypeError, ValueError, KeyError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, obj, reverse):
+        query = urlencode({'r': obj.rating, 'i': obj.id, 'd': 'p' if reverse else 'n'})
+        encoded = b64encode(query.encode('ascii')).decode('ascii')
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.base_url = request.build_absolute_uri()
+        cursor = self.decode_cursor(request)
+
+        if cursor is None:
+            reverse = False
+            page = list(queryset.order_by('rating', 'id')[:self.page_size + 1])
+        else:
+            rating, pk, reverse = cursor
+            if reverse:
+                page = list(queryset.filter(Q(rating__lt=rating) | Q(rating=rating, id__lt=pk))
+                            .order_by('-rating', '-id')[:self.page_size + 1])
+            else:
+                page = list(queryset.filter(Q(rating__gt=rating) | Q(rating=rating, id__gt=pk))
+                            .order_by('rating', 'id')[:self.page_size + 1])
+
+        has_more = len(page) > self.page_size
+        page = page[:self.page_size]
+        if reverse:
+            page.reverse()
+
+        # moving forward we came from some page before, moving backward - from some page after
+        has_next = has_more if not reverse else True
+        has_previous = has_more if reverse else cursor is not None
+        self.next = self.encode_cursor(page[-1], False) if has_next and page else None
+        self.previous = self.encode_cursor(page[0], True) if has_previous and page else None
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.next,
+            'previous': self.previous,
+            'results': data,
+        })
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            'type': 'object',
+            'properties': {
+                'next': {'type': 'string', 'nullable': True},
+                'previous': {'type': 'string', 'nullable': True},
+                'results': schema,
+            },
+        }
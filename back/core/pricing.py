@@ -0,0 +1,48 @@
+from django.db import transaction
+from django.db.models import OuterRef, Subquery, Sum, F, Case, When, Value, BigIntegerField
+from django.db.models.functions import Coalesce, Cast
+
+from .models import Recipe, RecipeComposition
+
+
+# Recipe.price = sum of RecipeComposition.qty * Component.cost over the recipe, where
+# cost is given for 1 kilo/liter (measure g/m) or for 1 piece (measure q), rounded to the nearest coin
+# prices are computed by the DB for all affected recipes at once in one UPDATE
+
+
+def price_subquery():
+    # qty and cost are smallint columns, their product (e.g. 250 g * 200) overflows smallint on postgres
+    qty_cost = Cast('qty', BigIntegerField()) * Cast('component__cost', BigIntegerField())
+    cost = Case(When(component__type__measure='q', then=qty_cost * 1000), default=qty_cost)
+    # price in thousandths of coin
+    total = RecipeComposition.objects.filter(recipe_id=OuterRef('pk')) \
+        .values('recipe_id').annotate(total=Sum(cost)).values('total')
+    return (Coalesce(Subquery(total), Value(0)) + 500) / 1000
+
+
+# reprices given recipes (all if None), returns number of repriced recipes
+def reprice(recipe_ids=None):
+    recipes = Recipe.objects.all() if recipe_ids is None else Recipe.objects.filter(id__in=recipe_ids)
+    return recipes.update(price=price_subquery())
+
+
+# reprices recipes containing any of given components
+# the index of RecipeComposition.component works as the reverse index component -> recipes
+def reprice_components(component_ids):
+    return reprice(RecipeComposition.objects.filter(component_id__in=component_ids).values('recipe_id'))
+
+
+def reprice_on_component_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: reprice_components([instance.id]))
+
+
+def reprice_on_type_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        transaction.on_commit(lambda: reprice_components(instance.type_instances.values('id')))
+
+
+def reprice_on_composition_change(sender, instance, raw=False, **kwargs):
+    if not raw:
+        recipe_id = instance.recipe_id
+        transaction.on_commit(lambda: reprice([recipe_id]))
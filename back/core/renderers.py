@@ -0,0 +1,28 @@
+from rest_framework.renderers import JSONRenderer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# JSONRenderer producing the same bytes several times faster with orjson when it's installed
+# orjson output matches compact non-ascii json of JSONRenderer for dicts with str keys, lists, str, int,
+# bool and None (floats differ only in the exponent format, e.g. 1e16 vs 1e+16, so they aren't used in responses),
+# anything else (indent, ascii output, Decimal, int keys, ...) is rendered by JSONRenderer
+class FastJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None or orjson is None or self.ensure_ascii or not self.compact \
+                or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = orjson.dumps(data)
+        except orjson.JSONEncodeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        # the same escaping of line separators as JSONRenderer does for javascript
+        if b'\xe2\x80' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+fast_renderer = FastJSONRenderer()
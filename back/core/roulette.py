@@ -0,0 +1,88 @@
+from random import random, randrange
+from threading import Lock
+
+from .models import Component
+from .catalog import catalog
+
+
+# chances of dropping each rarity in percents (see Component.rarity)
+# 1 - [0,0] legendary  2 - [1,5] mythical  3 - [6,25] epic  4 - [26,55] especial  5 - [56,99] rare
+prob = [0, 1, 6, 26, 56, 100]
+
+# max number of spins made with one request
+max_spins = 100
+
+
+def rarity_weights():
+    return {rarity: prob[rarity] - prob[rarity - 1] for rarity in range(1, len(prob))}
+
+
+# Vose's alias method: O(n) building, O(1) sampling from discrete distribution
+# returns (accept, alias) tables for weights of outcomes 0..n-1
+def build_alias(weights):
+    n = len(weights)
+    total = sum(weights)
+    scaled = [w * n / total for w in weights]
+    accept, alias = [1.0] * n, list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        accept[s], alias[s] = scaled[s], l
+        scaled[l] -= 1 - scaled[s]
+        (small if scaled[l] < 1 else large).append(l)
+    return accept, alias
+
+
+# in-process sampler of components grouped by rarity
+# built lazily with one query and rebuilt when the catalog version changes (see catalog.py),
+# the version is shared by workers so none of them keeps picking deleted components
+class ComponentSampler:
+    def __init__(self):
+        self._lock = Lock()
+        self._tables = None
+
+    def invalidate(self):
+        self._tables = None
+
+    def _build(self, version):
+        by_rarity = {}
+        for comp_id, rarity in Component.objects.values_list('id', 'rarity').order_by('id'):
+            by_rarity.setdefault(rarity, []).append(comp_id)
+
+        weights = rarity_weights()
+        rarities = [r for r in by_rarity if weights.get(r, 0) > 0]
+        if not rarities:
+            # there are no components of weighted rarities (e.g. only common ones) - all are equal
+            rarities = list(by_rarity)
+            weights = {r: len(by_rarity[r]) for r in rarities}
+        if not rarities:
+            return version, None
+        return version, (rarities, [by_rarity[r] for r in rarities], *build_alias([weights[r] for r in rarities]))
+
+    def _get(self):
+        version = catalog.version()
+        tables = self._tables
+        if tables is None or tables[0] != version:
+            with self._lock:
+                tables = self._tables
+                if tables is None or tables[0] != version:
+                    tables = self._tables = self._build(version)
+        return tables[1]
+
+    # returns list of k randomly picked component ids (empty list if there are no components)
+    def pick(self, k=1):
+        tables = self._get()
+        if tables is None:
+            return []
+        rarities, ids, accept, alias = tables
+        picked = []
+        for _ in range(k):
+            i = randrange(len(rarities))
+            if random() >= accept[i]:
+                i = alias[i]
+            picked.append(ids[i][randrange(len(ids[i]))])
+        return picked
+
+
+sampler = ComponentSampler()
@@ -0,0 +1,26 @@
+import random
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# set for the current request (see middleware.py) to read own writes from the primary
+primary_pinned = ContextVar('primary_pinned', default=False)
+
+
+# writes go to the primary (default) database, reads go to one of settings.DATABASE_REPLICAS
+# unless there are no replicas, reads are pinned or they're made inside a transaction of the primary
+class PrimaryReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = settings.DATABASE_REPLICAS
+        if not replicas or primary_pinned.get() or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    # all aliases are copies of the same database
+    def allow_relation(self, obj1, obj2, **hints):
+        return True
@@ -0,0 +1,186 @@
+from collections import Counter
+from heapq import nsmallest
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Recipe, RecipeComposition
+
+
+# inverted index of public recipes: {component_id: {recipe_id}}
+# updated incrementally by composition and recipe signals of this process and rebuilt from the DB
+# every refresh_interval seconds to pick up writes of other processes
+class RecipeIndex:
+    def __init__(self, refresh_interval):
+        self.refresh_interval = refresh_interval
+        self._lock = Lock()
+        self._build_lock = Lock()
+        self._version = 0
+        self._built_at = None
+        self.postings = None
+        # {recipe_id: rating} of all public recipes, {recipe_id: {component_id}}
+        self.ratings = None
+        self.compositions = None
+
+    def invalidate(self):
+        with self._lock:
+            self._drop()
+
+    # under the lock
+    def _drop(self):
+        self._version += 1
+        self.postings = None
+
+    # (ratings, postings, compositions) read from the DB
+    def _build(self):
+        ratings = dict(Recipe.objects.filter(is_private=False).values_list('id', 'rating'))
+        postings, compositions = {}, {}
+        pairs = RecipeComposition.objects.filter(recipe__is_private=False) \
+            .values_list('recipe_id', 'component_id')
+        for recipe_id, comp_id in pairs.iterator():
+            postings.setdefault(comp_id, set()).add(recipe_id)
+            compositions.setdefault(recipe_id, set()).add(comp_id)
+        return ratings, postings, compositions
+
+    # under the lock
+    def _stale(self):
+        return self.postings is None or monotonic() - self._built_at >= self.refresh_interval
+
+    # the index is rebuilt outside of the lock and swapped in like leaderboards (see leaderboard.py)
+    def _refresh(self):
+        with self._lock:
+            if not self._stale():
+                return
+            missing = self.postings is None
+        if not self._build_lock.acquire(blocking=missing):
+            return
+        try:
+            with self._lock:
+                if not self._stale():
+                    return
+                version = self._version
+            index = self._build()
+            with self._lock:
+                # an index invalidated during the build may miss the change
+                if version == self._version:
+                    self.ratings, self.postings, self.compositions = index
+                    self._built_at = monotonic()
+        finally:
+            self._build_lock.release()
+
+    # runs func(ratings, postings, compositions) under the lock with fresh enough index
+    def _use(self, func):
+        self._refresh()
+        with self._lock:
+            if self.postings is not None:
+                return func(self.ratings, self.postings, self.compositions)
+        # invalidated while being built, the index is built once more for this call only
+        return func(*self._build())
+
+    def _add(self, recipe_id, comp_id):
+        self.postings.setdefault(comp_id, set()).add(recipe_id)
+        self.compositions.setdefault(recipe_id, set()).add(comp_id)
+
+    def _remove(self, recipe_id, comp_id=None):
+        comp_ids = [comp_id] if comp_id is not None else list(self.compositions.get(recipe_id, ()))
+        for comp_id in comp_ids:
+            self.postings.get(comp_id, set()).discard(recipe_id)
+            self.compositions.get(recipe_id, set()).discard(comp_id)
+
+    # recipes containing every component of all_of, at least one of any_of and none of none_of
+    # returns [(recipe_id, rating)] sorted by rating desc, id asc, starting after (rating, id)
+    def search(self, all_of=(), any_of=(), none_of=(), after=None, limit=20):
+        def search(ratings, postings, compositions):
+            if all_of:
+                matching = sorted((postings.get(c, set()) for c in all_of), key=len)
+                found = set(matching[0]).intersection(*matching[1:])
+            else:
+                found = set(ratings)
+            if any_of:
+                found &= set().union(*(postings.get(c, set()) for c in any_of))
+            found -= set().union(*(postings.get(c, set()) for c in none_of))
+            keys = ((-ratings[r], r) for r in found if r in ratings)
+            if after is not None:
+                bound = (-after[0], after[1])
+                keys = (key for key in keys if key > bound)
+            # a page is a partial sort of the keys after the cursor: O(n log limit) instead of sorting all matches
+            return nsmallest(limit, keys)
+        return [(recipe_id, -rating) for rating, recipe_id in self._use(search)]
+
+    # public recipes having most components in common with the recipe
+    # returns [(recipe_id, common components count)]
+    def similar(self, recipe_id, limit=20):
+        def similar(ratings, postings, compositions, comp_ids=None):
+            comp_ids = compositions.get(recipe_id, comp_ids)
+            if comp_ids is None:
+                return None
+            common = Counter()
+            for comp_id in comp_ids:
+                common.update(postings.get(comp_id, ()))
+            common.pop(recipe_id, None)
+            return sorted(common.items(), key=lambda item: (-item[1], -ratings[item[0]], item[0]))[:limit]
+
+        ranked = self._use(similar)
+        if ranked is None:
+            # private recipes aren't indexed, their composition is read outside of the lock
+            comp_ids = list(RecipeComposition.objects.filter(recipe_id=recipe_id)
+                            .values_list('component_id', flat=True))
+            ranked = self._use(lambda *index: similar(*index, comp_ids))
+        return ranked
+
+    # incremental updates, skipped when the index isn't built yet since it'll be loaded from the DB
+
+    def composition_saved(self, recipe_id, comp_id):
+        with self._lock:
+            if self.postings is not None and recipe_id in self.ratings:
+                self._add(recipe_id, comp_id)
+
+    def composition_deleted(self, recipe_id, comp_id):
+        with self._lock:
+            if self.postings is not None:
+                self._remove(recipe_id, comp_id)
+
+    def recipe_saved(self, recipe_id, is_private, rating, created=False):
+        with self._lock:
+            if self.postings is None:
+                return
+            if is_private:
+                self._remove(recipe_id)
+                self.ratings.pop(recipe_id, None)
+                self.compositions.pop(recipe_id, None)
+            elif created or recipe_id in self.ratings:
+                # compositions of a new recipe are saved after it and added by composition_saved
+                self.ratings[recipe_id] = rating
+            else:
+                # recipe became public: its composition is in the DB only
+                self._drop()
+
+    def recipe_deleted(self, recipe_id):
+        self.recipe_saved(recipe_id, True, None)
+
+
+recipe_index = RecipeIndex(getattr(settings, 'SEARCH_INDEX_REFRESH_INTERVAL', 60))
+
+
+def index_composition_save(sender, instance, raw=False, **kwargs):
+    if not raw:
+        recipe_id, comp_id = instance.recipe_id, instance.component_id
+        transaction.on_commit(lambda: recipe_index.composition_saved(recipe_id, comp_id))
+
+
+def index_composition_delete(sender, instance, **kwargs):
+    recipe_id, comp_id = instance.recipe_id, instance.component_id
+    transaction.on_commit(lambda: recipe_index.composition_deleted(recipe_id, comp_id))
+
+
+def index_recipe_save(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        recipe_id, is_private, rating = instance.id, instance.is_private, instance.rating
+        transaction.on_commit(lambda: recipe_index.recipe_saved(recipe_id, is_private, rating, created))
+
+
+def index_recipe_delete(sender, instance, **kwargs):
+    recipe_id = instance.id
+    transaction.on_commit(lambda: recipe_index.recipe_deleted(recipe_id))
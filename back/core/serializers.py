@@ -1,9 +1,17 @@
 from rest_framework import serializers as sr
 from .models import *
+from .metrics import timed_serialization
+
+
+# base of serializers below: their time is measured as serializer time of the request (see metrics.py)
+class ModelSr(sr.ModelSerializer):
+    @timed_serialization
+    def to_representation(self, instance):
+        return super().to_representation(instance)
 
 
 # used in url 'components'
-class BriefComponentSr(sr.ModelSerializer):
+class BriefComponentSr(ModelSr):
     type_name = sr.CharField(max_length=3, source='type.name')
 
     class Meta:
@@ -12,7 +20,7 @@ class BriefComponentSr(sr.ModelSerializer):
 
 
 # used in url 'customer/components/'
-class DetailComponentSr(sr.ModelSerializer):
+class DetailComponentSr(ModelSr):
     type_measure = sr.CharField(max_length=1, source='type.measure')
 
     class Meta:
@@ -21,14 +29,14 @@ class DetailComponentSr(sr.ModelSerializer):
 
 
 # used in url 'customer/owns/components/'
-class ComponentOwnershipSr(sr.ModelSerializer):
+class ComponentOwnershipSr(ModelSr):
     class Meta:
         model = ComponentOwnership
         fields = ('component', 'qty')
 
 
 # used in url 'discounts'
-class DiscountSr(sr.ModelSerializer):
+class DiscountSr(ModelSr):
     rarity = sr.IntegerField(source='rarity.rarity')
     percents = sr.IntegerField(source='rarity.percents')
 
@@ -37,13 +45,53 @@ class DiscountSr(sr.ModelSerializer):
         fields = ('rarity', 'percents', 'qty')
 
 
-class LotItemSr(sr.ModelSerializer):
+# serializer-free equivalents of BriefComponentSr, DetailComponentSr, ComponentOwnershipSr and BriefLotSr
+# for hot list endpoints: rows are built from values() tuples into dicts with the same keys in the same order
+# so the rendered json is byte-for-byte the same (components without type get null instead of an error)
+
+@timed_serialization
+def brief_components(components):
+    return [{'id': id, 'type_name': type_name, 'rarity': rarity, 'name': name, 'desc': desc}
+            for id, type_name, rarity, name, desc in
+            components.values_list('id', 'type__name', 'rarity', 'name', 'desc')]
+
+
+@timed_serialization
+def detail_components(components):
+    return [{'id': id, 'type_measure': type_measure, 'cost': cost, 'min_qty': min_qty, 'max_qty': max_qty,
+             'qty_step': qty_step, 'name_in_with': name_in_with}
+            for id, type_measure, cost, min_qty, max_qty, qty_step, name_in_with in
+            components.values_list('id', 'type__measure', 'cost', 'min_qty', 'max_qty', 'qty_step', 'name_in_with')]
+
+
+@timed_serialization
+def component_ownerships(ownerships):
+    return [{'component': component, 'qty': qty} for component, qty in
+            ownerships.values_list('component_id', 'qty')]
+
+
+# {lot_id: consist_of} of given lots with one query, in the order of the consist_of prefetch
+def lot_items(lot_ids):
+    items = {}
+    for lot_id, component, lot_qty in ComponentOwnership.objects.filter(lot_id__in=lot_ids) \
+            .values_list('lot_id', 'component_id', 'lot_qty'):
+        items.setdefault(lot_id, []).append({'component': component, 'lot_qty': lot_qty})
+    return items
+
+
+@timed_serialization
+def brief_lots(lots):
+    items = lot_items([lot.id for lot in lots])
+    return [{'price': lot.price, 'consist_of': items.get(lot.id, [])} for lot in lots]
+
+
+class LotItemSr(ModelSr):
     class Meta:
         model = ComponentOwnership
         fields = ('component', 'lot_qty')
 
 
-class BriefLotSr(sr.ModelSerializer):
+class BriefLotSr(ModelSr):
     consist_of = LotItemSr(many=True, read_only=True)
 
     class Meta:
@@ -51,7 +99,7 @@ class BriefLotSr(sr.ModelSerializer):
         fields = ('price', 'consist_of')
 
 
-class DetailLotSr(sr.ModelSerializer):
+class DetailLotSr(ModelSr):
     views = sr.IntegerField(source='stat.views')
     comments_count = sr.IntegerField(source='stat.comments_count')
 
@@ -61,9 +109,9 @@ class DetailLotSr(sr.ModelSerializer):
                   'comments_count', 'upvotes_count', 'downvotes_count')
 
 
-class CommentSr(sr.ModelSerializer):
+class CommentSr(ModelSr):
     # todo: alter src to author.username when ready
-    author = sr.IntegerField(source='author.id')
+    author = sr.IntegerField(source='author_id')
 
     class Meta:
         model = Comment
@@ -0,0 +1,58 @@
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, pre_delete, post_delete, m2m_changed
+
+from .models import *
+from .db import configure_sqlite, install_request_wrappers
+from .catalog import invalidate_catalog
+from .discounts import invalidate_discounts, create_customer_discounts
+from .inventory import bump_inventory_on_change, bump_inventory_on_customer_save, bump_inventory_on_coins_update
+from .pricing import reprice_on_component_save, reprice_on_type_save, reprice_on_composition_change
+from .search import index_composition_save, index_composition_delete, index_recipe_save, \
+    index_recipe_delete
+from .usernames import forget_username
+from .leaderboard import update_on_recipe_save, update_on_recipe_delete, invalidate_leaderboards
+
+
+# in-process caches built from the catalog are dropped whenever the catalog is changed,
+# recipe prices, leaderboards and search index follow recipes, rows every customer must have are created
+# with the customer, cached usernames are dropped on changes of customers and changes of inventories
+# made with save() and delete() bump inventory versions
+def connect():
+    connection_created.connect(configure_sqlite, dispatch_uid='sqlite_pragmas')
+    connection_created.connect(install_request_wrappers, dispatch_uid='request_wrappers')
+
+    for model in (Component, ComponentType):
+        post_save.connect(invalidate_catalog, sender=model, dispatch_uid='catalog_save')
+        post_delete.connect(invalidate_catalog, sender=model, dispatch_uid='catalog_delete')
+    m2m_changed.connect(invalidate_catalog, sender=ComponentType.compability.through,
+                        dispatch_uid='catalog_compability')
+
+    post_save.connect(invalidate_discounts, sender=Discount, dispatch_uid='discounts_save')
+    post_delete.connect(invalidate_discounts, sender=Discount, dispatch_uid='discounts_delete')
+    post_save.connect(create_customer_discounts, sender=Customer, dispatch_uid='customer_discounts')
+    post_save.connect(forget_username, sender=Customer, dispatch_uid='username_save')
+    post_delete.connect(forget_username, sender=Customer, dispatch_uid='username_delete')
+
+    for model in (ComponentOwnership, DiscountOwnership):
+        pre_save.connect(bump_inventory_on_change, sender=model, dispatch_uid='inventory_save')
+        pre_delete.connect(bump_inventory_on_change, sender=model, dispatch_uid='inventory_delete')
+    pre_save.connect(bump_inventory_on_customer_save, sender=Customer, dispatch_uid='inventory_customer_save')
+    post_save.connect(bump_inventory_on_coins_update, sender=Customer, dispatch_uid='inventory_coins_update')
+
+    post_save.connect(update_on_recipe_save, sender=Recipe, dispatch_uid='leaderboard_save')
+    post_delete.connect(update_on_recipe_delete, sender=Recipe, dispatch_uid='leaderboard_delete')
+    post_save.connect(invalidate_leaderboards, sender=Reaction, dispatch_uid='leaderboard_reaction_save')
+    post_delete.connect(invalidate_leaderboards, sender=Reaction, dispatch_uid='leaderboard_reaction_delete')
+
+    post_save.connect(reprice_on_component_save, sender=Component, dispatch_uid='pricing_component')
+    post_save.connect(reprice_on_type_save, sender=ComponentType, dispatch_uid='pricing_type')
+    post_save.connect(reprice_on_composition_change, sender=RecipeComposition,
+                      dispatch_uid='pricing_composition_save')
+    post_delete.connect(reprice_on_composition_change, sender=RecipeComposition,
+                        dispatch_uid='pricing_composition_delete')
+
+    post_save.connect(index_composition_save, sender=RecipeComposition, dispatch_uid='search_composition_save')
+    post_delete.connect(index_composition_delete, sender=RecipeComposition,
+                        dispatch_uid='search_composition_delete')
+    post_save.connect(index_recipe_save, sender=Recipe, dispatch_uid='search_recipe_save')
+    post_delete.connect(index_recipe_delete, sender=Recipe, dispatch_uid='search_recipe_delete')
@@ -1,3 +1,1416 @@
-from django.test import TestCase
+import asyncio
+import re
+from base64 import b64encode
+import tempfile
+from collections import Counter
+from decimal import Decimal
+from io import StringIO
+from pathlib import Path
+from random import seed
+from threading import Thread, Event
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.core.management import call_command
+from django.db import connection, transaction, DatabaseError
+from django.http import HttpResponse
+from django.test import TestCase, TransactionTestCase, RequestFactory, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db.models import Sum, Prefetch
+from rest_framework.renderers import JSONRenderer
+from rest_framework.exceptions import ValidationError
+
+from .models import *
+from .inventory import add_components, add_components_bulk, take_components
+from .catalog import catalog, Catalog
+from .roulette import sampler, max_spins, build_alias, rarity_weights, ComponentSampler
+from .discounts import discount_table, DiscountTable
+from .leaderboard import leaderboards, Leaderboards, Board
+from .search import recipe_index, RecipeIndex
+from .views import RecipesSearch
+from .market import list_lot, buy_lot, LotUnavailable
+from .exchange import exchange
+from .checkout import checkout
+from .pricing import price_subquery
+from .routers import PrimaryReplicaRouter
+from .middleware import PrimaryPinningMiddleware, PerformanceMiddleware
+from .benchmarks import endpoint_paths, regressions, percentile
+from .metrics import registry, serialization_timer
+from .renderers import fast_renderer
+from .serializers import *
+from .usernames import usernames, UsernameResolver
+from . import urls
+from . import votes, viewcount
+
+
+# in-process caches are invalidated on commit which never happens inside TestCase
+def reset_caches():
+    catalog.invalidate()
+    sampler.invalidate()
+    discount_table.invalidate()
+    usernames.clear()
+
+
+def create_component(rarity=6, name='comp', type=None):
+    return Component.objects.create(type=type, rarity=rarity, cost=100, min_qty=10, max_qty=100,
+                                    qty_step=10, name=name, name_in_with=name)
+
+
+class InventoryTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.customer = Customer.objects.create()
+        self.comps = [create_component(name='comp{}'.format(i)) for i in range(3)]
+
+    def owned(self):
+        return dict(ComponentOwnership.objects.filter(owner=self.customer)
+                    .values_list('component_id', 'qty'))
+
+    def test_add_creates_and_increments(self):
+        a, b, c = self.comps
+        add_components(self.customer.id, {a.id: 2, b.id: 1})
+        add_components_bulk([(self.customer.id, a.id, 3), (self.customer.id, c.id, 1),
+                             (self.customer.id, c.id, 1)])
+        self.assertEqual(self.owned(), {a.id: 5, b.id: 1, c.id: 2})
+
+    def test_take_is_all_or_nothing(self):
+        a, b, _ = self.comps
+        add_components(self.customer.id, {a.id: 2, b.id: 1})
+        with self.assertRaises(ValidationError):
+            take_components(self.customer.id, {a.id: 1, b.id: 2})
+        self.assertEqual(self.owned(), {a.id: 2, b.id: 1})
+
+        take_components(self.customer.id, {a.id: 1, b.id: 1})
+        self.assertEqual(self.owned(), {a.id: 1})
+
+
+class InventoryConcurrencyTest(TransactionTestCase):
+    threads = 8
+    increments = 25
+
+    def setUp(self):
+        reset_caches()
+
+    def test_no_lost_increments(self):
+        customer = Customer.objects.create()
+        comp = create_component()
+
+        errors = []
+
+        def spin():
+            try:
+                for _ in range(self.increments):
+                    add_components(customer.id, {comp.id: 1})
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [Thread(target=spin) for _ in range(self.threads)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        self.assertEqual(errors, [])
+        ownership = ComponentOwnership.objects.get(owner=customer, component=comp)
+        self.assertEqual(ownership.qty, self.threads * self.increments)
+
+
+class RouletteTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.customer = Customer.objects.create()
+        wrap = ComponentType.objects.create(name='wrp')
+        self.comps = {rarity: create_component(rarity=rarity, name='comp{}'.format(rarity), type=wrap)
+                      for rarity in (2, 5, 6)}
+
+    def test_alias_tables(self):
+        weights = [1, 5, 20, 30, 44]
+        accept, alias = build_alias(weights)
+        n = len(weights)
+        # probability of outcome i is its own share of column i plus shares of columns aliased to it
+        probs = [accept[i] / n + sum(1 - accept[j] for j in range(n) if alias[j] == i) / n for i in range(n)]
+        for prob, weight in zip(probs, weights):
+            self.assertAlmostEqual(prob, weight / sum(weights))
+
+    def test_distribution(self):
+        seed(1)
+        picked = Counter(sampler.pick(20000))
+        weights = rarity_weights()
+        # common components have no weight while there are components of weighted rarities
+        self.assertNotIn(self.comps[6].id, picked)
+        for rarity in (2, 5):
+            share = picked[self.comps[rarity].id] / 20000
+            self.assertAlmostEqual(share, weights[rarity] / (weights[2] + weights[5]), delta=0.01)
+
+    def test_spins(self):
+        url = '/customer/roulette/{}'.format(self.customer.id)
+        picked = self.client.get(url).json()['id']
+        self.assertEqual(ComponentOwnership.objects.get(owner=self.customer).component_id, picked)
+        response = self.client.get(url + '?n=7')
+        self.assertEqual(len(response.json()), 7)
+        self.assertEqual(ComponentOwnership.objects.filter(owner=self.customer).aggregate(n=Sum('qty'))['n'], 8)
+        for n in (0, max_spins + 1, 'x'):
+            self.assertEqual(self.client.get(url + '?n={}'.format(n)).status_code, 400)
+
+    def test_catalog_changes_reach_every_worker(self):
+        worker = ComponentSampler()
+        self.assertIn(self.comps[2].id, worker.pick(1000))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.comps[2].delete()
+        self.assertEqual(set(worker.pick(1000)), {self.comps[5].id})
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        Discount.objects.bulk_create([Discount(rarity=r, percents=r) for r in range(1, 7)])
+        self.customer = Customer.objects.create()
+        self.type = ComponentType.objects.create(name='wrp')
+        self.root = Comment.objects.create(author=self.customer, text='root')
+        self.stat = Stat.objects.create()
+
+    # fails if the number of queries made by GET url grows with the number of rows created by seed
+    # seed(n) adds n more rows of each kind the endpoint returns
+    def assert_constant_queries(self, url, seed, sizes=(1, 5, 20)):
+        counts = []
+        for n in sizes:
+            seed(n)
+            # in-process caches are rebuilt in every measurement since seeding invalidated them
+            reset_caches()
+            path = url() if callable(url) else url
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path)
+            self.assertEqual(response.status_code, 200, path)
+            counts.append(len(queries))
+        self.assertEqual(len(set(counts)), 1, '{}: queries {} for sizes {}'.format(path, counts, sizes))
+
+    def seed_components(self, n):
+        for _ in range(n):
+            comp = create_component(name='comp', type=self.type)
+            add_components(self.customer.id, {comp.id: 2})
+
+    def seed_lots(self, n):
+        for _ in range(n):
+            seller = Customer.objects.create()
+            comm = Comment.objects.create(author=seller)
+            lot = Lot.objects.create(seller_comm=comm, stat=self.stat)
+            for _ in range(2):
+                comp = create_component(name='comp', type=self.type)
+                ComponentOwnership.objects.create(owner=seller, component=comp, qty=0,
+                                                  lot=lot, lot_qty=1)
+
+    def seed_comments(self, n):
+        parent = self.root
+        for _ in range(n):
+            author = Customer.objects.create()
+            parent = Comment.objects.create(author=author, reply_to=parent)
+            Comment.objects.create(author=author, reply_to=self.root)
+
+    def test_components(self):
+        self.assert_constant_queries('/components', self.seed_components)
+
+    def test_ownerships(self):
+        self.assert_constant_queries(lambda: '/customer/owns/components/{}'.format(self.customer.id),
+                                     self.seed_components)
+
+    def test_available_components(self):
+        self.assert_constant_queries(lambda: '/customer/components/{}'.format(self.customer.id),
+                                     self.seed_components)
+
+    def test_roulette(self):
+        self.seed_components(1)
+        self.assert_constant_queries(lambda: '/customer/roulette/{}?n=10'.format(self.customer.id),
+                                     self.seed_components)
+
+    def test_discounts(self):
+        url = '/customer/discounts/{}'.format(self.customer.id)
+        # missing rows are created once
+        DiscountOwnership.objects.filter(owner=self.customer, rarity__in=[2, 3]).delete()
+        self.assertEqual([d['qty'] for d in self.client.get(url).json()], [0] * 6)
+        with self.assertNumQueries(1):
+            self.client.get(url)
+
+        customer = Customer.objects.create()
+        self.assertEqual(DiscountOwnership.objects.filter(owner=customer).count(), 6)
+
+    def test_lots(self):
+        self.assert_constant_queries('/lots/', self.seed_lots)
+        self.assert_constant_queries('/lots/cursor', self.seed_lots)
+
+    def test_lot_detail(self):
+        self.seed_lots(1)
+        lot = Lot.objects.first()
+        self.assert_constant_queries('/lot/{}'.format(lot.id), lambda n: None)
+
+    def test_comment_branch(self):
+        self.assert_constant_queries(lambda: '/comment/branch/{}'.format(self.root.id),
+                                     self.seed_comments)
+
+
+class VotesTest(TestCase):
+    def setUp(self):
+        self.customers = [Customer.objects.create() for _ in range(3)]
+        comm = Comment.objects.create(author=self.customers[0])
+        self.stat = Stat.objects.create()
+        self.lot = Lot.objects.create(seller_comm=comm, stat=self.stat)
+        self.recipe = Recipe.objects.create(author_comm=comm, stat=self.stat)
+        self.sweet, self.salty = Reaction.objects.create(taste='swt'), Reaction.objects.create(taste='slt')
+
+    def vote(self, customer, vote):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/lot/vote/{}'.format(self.lot.id),
+                             {'customer': customer.id, 'vote': vote}, content_type='application/json')
+
+    def react(self, customer, reaction):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/recipe/react/{}'.format(self.recipe.id),
+                             {'customer': customer.id, 'reaction': reaction and reaction.id},
+                             content_type='application/json')
+
+    def test_lot_votes(self):
+        a, b, c = self.customers
+        self.vote(a, 'up')
+        self.vote(a, 'up')
+        self.vote(b, 'up')
+        self.vote(c, 'down')
+        self.vote(b, 'down')
+        self.vote(c, None)
+        votes.flush()
+
+        self.lot.refresh_from_db()
+        self.assertEqual((self.lot.upvotes_count, self.lot.downvotes_count, self.lot.rating), (1, 1, 0))
+        self.assertEqual(list(self.lot.upvotes.all()), [a])
+        self.assertEqual(list(self.lot.downvotes.all()), [b])
+
+    def test_recipe_reactions(self):
+        a, b, c = self.customers
+        self.react(a, self.sweet)
+        self.react(a, self.sweet)
+        self.react(b, self.sweet)
+        self.react(b, self.salty)
+        self.react(c, self.salty)
+        self.react(c, None)
+        votes.flush()
+
+        counts = dict(RecipeReactionsCount.objects.values_list('reaction__taste', 'qty'))
+        self.assertEqual(counts, {'swt': 1, 'slt': 1})
+
+    def test_invalid_bodies(self):
+        customer = self.customers[0].id
+        for path, bodies in (('/lot/vote/{}'.format(self.lot.id),
+                              ([1], 'up', {}, {'customer': 'x'}, {'customer': customer, 'vote': 'sideways'})),
+                             ('/recipe/react/{}'.format(self.recipe.id),
+                              ([1], 'x', {}, {'customer': customer, 'reaction': 'x'}))):
+            for body in bodies:
+                response = self.client.post(path, body, content_type='application/json')
+                self.assertEqual(response.status_code, 400, (path, body))
+
+    def test_reactions_taken_back_after_flush(self):
+        a, b, _ = self.customers
+        self.react(a, self.sweet)
+        self.react(b, self.sweet)
+        votes.flush()
+        self.react(a, self.salty)
+        self.react(b, None)
+        votes.flush()
+
+        counts = dict(RecipeReactionsCount.objects.values_list('reaction__taste', 'qty'))
+        self.assertEqual(counts, {'swt': 0, 'slt': 1})
+
+    def test_reconcile(self):
+        a, b, _ = self.customers
+        self.lot.upvotes.add(a, b)
+        RecipeReactionsCount.objects.create(recipe=self.recipe, reaction=self.salty, qty=5)
+        CustomersReactToRecipes.objects.create(recipe=self.recipe, customer=a, reaction=self.sweet)
+
+        call_command('reconcile_counters', stdout=StringIO())
+        self.lot.refresh_from_db()
+        self.assertEqual((self.lot.upvotes_count, self.lot.downvotes_count, self.lot.rating), (2, 0, 2))
+        counts = dict(RecipeReactionsCount.objects.values_list('reaction__taste', 'qty'))
+        self.assertEqual(counts, {'swt': 1, 'slt': 0})
+
+
+class CommentBranchTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        author = Customer.objects.create()
+
+        def reply(to, text):
+            return Comment.objects.create(author=author, text=text, reply_to=to)
+        # root
+        # ├── a          (replies are created out of order)
+        # │   ├── a1
+        # │   └── a2
+        # │       └── a21
+        # └── b
+        #     └── b1
+        self.root = reply(None, 'root')
+        a = reply(self.root, 'a')
+        b = reply(self.root, 'b')
+        b1 = reply(b, 'b1')
+        a1 = reply(a, 'a1')
+        a2 = reply(a, 'a2')
+        reply(a2, 'a21')
+        reply(Comment.objects.create(author=author, text='other'), 'other reply')
+
+    def texts(self, query=''):
+        response = self.client.get('/comment/branch/{}{}'.format(self.root.id, query))
+        self.assertEqual(response.status_code, 200)
+        return [comm['text'] for comm in response.json()]
+
+    def test_depth_first_order(self):
+        self.assertEqual(self.texts(), ['root', 'a', 'a1', 'a2', 'a21', 'b', 'b1'])
+
+    def test_depth(self):
+        self.assertEqual(self.texts('?depth=0'), ['root'])
+        self.assertEqual(self.texts('?depth=1'), ['root', 'a', 'b'])
+        self.assertEqual(self.texts('?depth=2'), ['root', 'a', 'a1', 'a2', 'b', 'b1'])
+
+    def test_limit(self):
+        self.assertEqual(self.texts('?limit=1'), ['root'])
+        self.assertEqual(self.texts('?limit=4'), ['root', 'a', 'a1', 'a2'])
+        self.assertEqual(self.texts('?depth=1&limit=2'), ['root', 'a'])
+        self.assertEqual(self.texts('?limit=100'), ['root', 'a', 'a1', 'a2', 'a21', 'b', 'b1'])
+
+    def test_pages(self):
+        for prefix in ('', '/async'):
+            for query, texts in (('?limit=2', ['root', 'a', 'a1', 'a2', 'a21', 'b', 'b1']),
+                                 ('?limit=3&depth=1', ['root', 'a', 'b']),
+                                 ('?limit=1&depth=2', ['root', 'a', 'a1', 'a2', 'b', 'b1'])):
+                pages = []
+                url = '{}/comment/branch/{}{}'.format(prefix, self.root.id, query)
+                while url:
+                    response = self.client.get(url)
+                    pages.append([comm['text'] for comm in response.json()])
+                    link = re.fullmatch(r'<http://testserver(.+)>; rel="next"', response.get('Link', ''))
+                    url = link and link.group(1)
+                limit = int(re.search(r'limit=(\d+)', query).group(1))
+                self.assertEqual(sum(pages, []), texts, prefix + query)
+                self.assertEqual([len(page) for page in pages[:-1]], [limit] * (len(pages) - 1))
+                self.assertTrue(pages[-1])
+
+    def test_invalid_params(self):
+        for query in ('?limit=0', '?limit=-2', '?depth=-1', '?depth=x', '?after=x', '?after=123'):
+            for prefix in ('', '/async'):
+                response = self.client.get('{}/comment/branch/{}{}'.format(prefix, self.root.id, query))
+                self.assertEqual(response.status_code, 400, prefix + query)
+        self.assertEqual(self.client.get('/comment/branch/0').status_code, 404)
+
+
+class ReactionConcurrencyTest(TransactionTestCase):
+    def test_reactions_are_counted_once(self):
+        reset_caches()
+        customers = [Customer.objects.create() for _ in range(2)]
+        comm, stat = Comment.objects.create(author=customers[0]), Stat.objects.create()
+        recipe = Recipe.objects.create(author_comm=comm, stat=stat)
+        reactions = [Reaction.objects.create(taste=taste) for taste in ('swt', 'slt')] + [None]
+
+        errors = []
+
+        def react(i):
+            try:
+                for j in range(10):
+                    reaction = reactions[(i + j) % 3]
+                    votes.react_to_recipe(recipe.id, customers[i % 2].id, reaction and reaction.id)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        workers = [Thread(target=react, args=(i,)) for i in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        votes.flush()
+
+        self.assertEqual(errors, [])
+        counts = dict(RecipeReactionsCount.objects.filter(qty__gt=0).values_list('reaction_id', 'qty'))
+        reacted = CustomersReactToRecipes.objects.filter(recipe=recipe).values_list('reaction_id', flat=True)
+        self.assertEqual(counts, dict(Counter(reacted)))
+
+
+class ViewCountTest(TestCase):
+    def test_views_are_buffered_and_deduplicated(self):
+        customers = [Customer.objects.create() for _ in range(2)]
+        stat = Stat.objects.create()
+        lot = Lot.objects.create(seller_comm=Comment.objects.create(author=customers[0]), stat=stat)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for customer in customers + customers:
+                self.client.get('/lot/{}?customer={}'.format(lot.id, customer.id))
+        self.assertEqual(viewcount.views.pending(), {stat.id: {'views': 2}})
+
+        viewcount.views.flush()
+        stat.refresh_from_db()
+        self.assertEqual(stat.views, 2)
+
+
+class LeaderboardTest(TestCase):
+    def setUp(self):
+        leaderboards.invalidate()
+        self.customers = [Customer.objects.create() for _ in range(3)]
+        comm = Comment.objects.create(author=self.customers[0])
+        stat = Stat.objects.create()
+        self.sweet = Reaction.objects.create(taste='swt')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipes = [Recipe.objects.create(author_comm=comm, stat=stat, is_private=False, rating=r)
+                            for r in (5, 1, 3)]
+            self.private = Recipe.objects.create(author_comm=comm, stat=stat, rating=10)
+
+    def test_rating_board(self):
+        a, b, c = self.recipes
+        self.assertEqual([r['id'] for r in self.client.get('/recipes/top').json()], [a.id, c.id, b.id])
+
+        b.rating = 7
+        with self.captureOnCommitCallbacks(execute=True):
+            b.save()
+        self.assertEqual([r['id'] for r in self.client.get('/recipes/top?n=2').json()], [b.id, a.id])
+        self.assertEqual(self.client.get('/recipe/rank/{}'.format(c.id)).json()['rank'], 3)
+        self.assertEqual(self.client.get('/recipe/rank/{}'.format(self.private.id)).status_code, 404)
+
+    def test_taste_board(self):
+        a, b, c = self.recipes
+        self.client.get('/recipes/top/swt')
+        for customer, recipe in zip(self.customers, (c, c, b)):
+            with self.captureOnCommitCallbacks(execute=True):
+                votes.react_to_recipe(recipe.id, customer.id, self.sweet.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            votes.react_to_recipe(self.private.id, self.customers[0].id, self.sweet.id)
+        votes.flush()
+
+        top = self.client.get('/recipes/top/swt').json()
+        self.assertEqual(top, [{'id': c.id, 'score': 2}, {'id': b.id, 'score': 1}, {'id': a.id, 'score': 0}])
+        self.assertEqual(self.client.get('/recipe/rank/{}/swt'.format(b.id)).json()['rank'], 2)
+        self.assertEqual(self.client.get('/recipes/top/xxx').status_code, 404)
+
+    def test_recipes_without_reactions_are_ranked(self):
+        a, b, c = self.recipes
+        with self.captureOnCommitCallbacks(execute=True):
+            sour = Reaction.objects.create(taste='sor')
+        with self.captureOnCommitCallbacks(execute=True):
+            votes.react_to_recipe(b.id, self.customers[0].id, self.sweet.id)
+        votes.flush()
+        # the reaction is taken back, its count stays in the DB as 0
+        with self.captureOnCommitCallbacks(execute=True):
+            votes.react_to_recipe(b.id, self.customers[0].id, None)
+        votes.flush()
+        self.client.get('/recipes/top/sor')
+        # the new recipe is added to the built boards in place
+        with self.captureOnCommitCallbacks(execute=True):
+            d = Recipe.objects.create(author_comm=a.author_comm, stat=a.stat, is_private=False)
+
+        # boards updated in place and boards built from the DB give the same answers
+        for boards in (leaderboards, Leaderboards(refresh_interval=60)):
+            for recipe in (a, b, c, d):
+                for taste in (sour.taste, self.sweet.taste):
+                    self.assertEqual(boards.rank(taste, recipe.id)[1], 0, (taste, recipe.id))
+            self.assertEqual([recipe_id for recipe_id, _ in boards.top(sour.taste, 10)], [a.id, b.id, c.id, d.id])
+        response = self.client.get('/recipe/rank/{}/sor'.format(c.id))
+        self.assertEqual(response.json(), {'id': c.id, 'rank': 3, 'score': 0})
+        self.assertEqual(self.client.get('/recipe/rank/{}/sor'.format(self.private.id)).status_code, 404)
+
+    def test_reads_during_rebuild(self):
+        a, b, c = self.recipes
+        boards = Leaderboards(refresh_interval=0)
+        self.assertEqual(boards.top('rating', 1), [(a.id, 5)])
+
+        started, release = Event(), Event()
+
+        def slow_build():
+            started.set()
+            release.wait(5)
+            return {'rating': Board({b.id: 9})}, {}
+
+        with patch.object(boards, '_build', slow_build):
+            rebuild = Thread(target=boards.top, args=('rating', 1))
+            rebuild.start()
+            started.wait(5)
+            # stale boards are read while another thread rebuilds them
+            self.assertEqual(boards.top('rating', 1), [(a.id, 5)])
+            release.set()
+            rebuild.join()
+        self.assertEqual(boards._boards['rating'].top(1), [(b.id, 9)])
+
+
+class PricingTest(TestCase):
+    def test_recipes_are_repriced(self):
+        customer = Customer.objects.create()
+        comm, stat = Comment.objects.create(author=customer), Stat.objects.create()
+        grams = ComponentType.objects.create(name='tpp')
+        pieces = ComponentType.objects.create(name='dcr', measure='q')
+        meat = create_component(name='meat', type=grams)
+        olive = create_component(name='olive', type=pieces)
+        a, b = [Recipe.objects.create(author_comm=comm, stat=stat) for _ in range(2)]
+
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeComposition.objects.create(recipe=a, component=meat, qty=250)
+            RecipeComposition.objects.create(recipe=a, component=olive, qty=3)
+            RecipeComposition.objects.create(recipe=b, component=meat, qty=120)
+        a.refresh_from_db()
+        b.refresh_from_db()
+        self.assertEqual((a.price, b.price), (25 + 300, 12))
+
+        meat.cost = 200
+        with self.captureOnCommitCallbacks(execute=True):
+            meat.save()
+        a.refresh_from_db()
+        b.refresh_from_db()
+        self.assertEqual((a.price, b.price), (50 + 300, 24))
+
+        Recipe.objects.update(price=0)
+        call_command('reprice_recipes', stdout=StringIO())
+        self.assertEqual(sorted(Recipe.objects.values_list('price', flat=True)), [24, 350])
+
+    def test_products_are_bigint(self):
+        # smallint * smallint is smallint on postgres and overflows for ordinary compositions
+        sql = str(Recipe.objects.annotate(total=price_subquery()).query)
+        self.assertRegex(sql, r'CAST\(\w+\."qty" AS bigint\) \* CAST\(\w+\."cost" AS bigint\)')
+        self.assertNotRegex(sql, r'\w+\."qty" \*')
+
+
+class RecipeValidationTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        wrapper, sauce, beverage = [ComponentType.objects.create(name=n) for n in ('wrp', 'sau', 'bvr')]
+        wrapper.compability.add(sauce)
+        self.lavash = create_component(name='lavash', type=wrapper)
+        self.garlic = create_component(name='garlic', type=sauce)
+        self.cola = create_component(name='cola', type=beverage)
+
+    def validate(self, data):
+        return self.client.post('/recipe/validate', data, content_type='application/json').json()
+
+    def test_validation(self):
+        ok = {'composition': [{'component': self.lavash.id, 'qty': 50},
+                              {'component': self.garlic.id, 'qty': 10}]}
+        self.assertEqual(self.validate(ok), {'valid': True, 'errors': []})
+
+        results = self.validate([
+            ok,
+            {'composition': [{'component': self.lavash.id, 'qty': 55}]},
+            {'composition': [{'component': self.garlic.id, 'qty': 200}]},
+            {'composition': [{'component': self.lavash.id, 'qty': 50},
+                             {'component': self.cola.id, 'qty': 50}]},
+        ])
+        self.assertEqual([r['valid'] for r in results], [True, False, False, False])
+
+        with self.assertNumQueries(0):
+            self.validate(ok)
+
+
+class RecipeSearchTest(TestCase):
+    def setUp(self):
+        recipe_index.invalidate()
+        customer = Customer.objects.create()
+        comm, stat = Comment.objects.create(author=customer), Stat.objects.create()
+        self.chicken, self.garlic, self.pickles = [create_component(name=n)
+                                                   for n in ('chicken', 'garlic', 'pickles')]
+        self.recipes = {}
+        with self.captureOnCommitCallbacks(execute=True):
+            for name, rating, private, comps in (('a', 1, False, [self.chicken, self.garlic]),
+                                                 ('b', 5, False, [self.chicken, self.garlic, self.pickles]),
+                                                 ('c', 3, False, [self.chicken]),
+                                                 ('d', 9, True, [self.chicken, self.garlic])):
+                recipe = Recipe.objects.create(author_comm=comm, stat=stat, rating=rating,
+                                               is_private=private)
+                for comp in comps:
+                    RecipeComposition.objects.create(recipe=recipe, component=comp, qty=10)
+                self.recipes[name] = recipe.id
+
+    def search(self, query):
+        return [r['id'] for r in self.client.get('/recipes/search?' + query).json()['results']]
+
+    def test_search(self):
+        a, b, c = self.recipes['a'], self.recipes['b'], self.recipes['c']
+        self.assertEqual(self.search('all={},{}'.format(self.chicken.id, self.garlic.id)), [b, a])
+        self.assertEqual(self.search('all={}&none={}'.format(self.garlic.id, self.pickles.id)), [a])
+        self.assertEqual(self.search('any={},{}'.format(self.pickles.id, self.garlic.id)), [b, a])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            RecipeComposition.objects.create(recipe_id=c, component=self.garlic, qty=10)
+        self.assertEqual(self.search('all={}&none={}'.format(self.garlic.id, self.pickles.id)), [c, a])
+
+    def test_cursor(self):
+        with patch.object(RecipesSearch, 'page_size', 1):
+            page = self.client.get('/recipes/search?all={}'.format(self.chicken.id)).json()
+            ids = [r['id'] for r in page['results']]
+            while page['next']:
+                page = self.client.get(page['next']).json()
+                ids += [r['id'] for r in page['results']]
+        self.assertEqual(ids, [self.recipes[n] for n in 'bca'])
+
+    def test_similar(self):
+        similar = self.client.get('/recipe/similar/{}'.format(self.recipes['a'])).json()
+        self.assertEqual(similar, [{'id': self.recipes['b'], 'common': 2},
+                                   {'id': self.recipes['c'], 'common': 1}])
+
+    def test_recipe_becomes_public(self):
+        a, d = self.recipes['a'], self.recipes['d']
+        self.assertEqual(self.search('all={}'.format(self.garlic.id)), [self.recipes['b'], a])
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe = Recipe.objects.get(id=d)
+            recipe.is_private = False
+            recipe.save()
+        self.assertEqual(self.search('all={}'.format(self.garlic.id)), [d, self.recipes['b'], a])
+
+    def test_reads_during_rebuild(self):
+        a, b = self.recipes['a'], self.recipes['b']
+        index = RecipeIndex(refresh_interval=0)
+        self.assertEqual(index.search([self.garlic.id], limit=1), [(b, 5)])
+
+        started, release = Event(), Event()
+
+        def slow_build():
+            started.set()
+            release.wait(5)
+            return {a: 1}, {self.garlic.id: {a}}, {a: {self.garlic.id}}
+
+        with patch.object(index, '_build', slow_build):
+            rebuild = Thread(target=index.search, args=([self.garlic.id],))
+            rebuild.start()
+            started.wait(5)
+            # the stale index is searched while another thread rebuilds it
+            self.assertEqual(index.search([self.garlic.id], limit=1), [(b, 5)])
+            release.set()
+            rebuild.join()
+        self.assertEqual(index.postings, {self.garlic.id: {a}})
+
+    def test_failed_build(self):
+        index = RecipeIndex(refresh_interval=60)
+        with patch.object(RecipeComposition.objects, 'filter', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                index.search([self.garlic.id])
+        self.assertEqual(index.search([self.garlic.id]), [(self.recipes['b'], 5), (self.recipes['a'], 1)])
+
+
+class CheckoutTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        Discount.objects.create(rarity=3, percents=20)
+        self.customer = Customer.objects.create(coins=1000)
+        comm, stat = Comment.objects.create(author=self.customer), Stat.objects.create()
+        self.shawa = Recipe.objects.create(author_comm=comm, stat=stat, price=150, is_private=False)
+        self.tea = Recipe.objects.create(author_comm=comm, stat=stat, price=50, is_private=False)
+        DiscountOwnership.objects.filter(owner=self.customer, rarity=3).update(qty=1)
+
+    def checkout(self, recipes, discount=None):
+        return self.client.post('/customer/checkout/{}'.format(self.customer.id),
+                                {'recipes': recipes, 'discount': discount}, content_type='application/json')
+
+    def test_checkout(self):
+        with self.assertNumQueries(8):
+            response = self.checkout([{'recipe': self.shawa.id, 'qty': 2}, {'recipe': self.tea.id}], 3)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.json()['price'], 280)
+
+        order = Order.objects.get()
+        self.assertEqual(order.discount.qty, 0)
+        self.assertEqual(sorted(order.ordercomposition_set.values_list('recipe_id', 'qty')),
+                         [(self.shawa.id, 2), (self.tea.id, 1)])
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.coins, 720)
+
+    def test_failed_checkout_changes_nothing(self):
+        self.assertEqual(self.checkout([{'recipe': self.shawa.id, 'qty': 10}], 3).status_code, 400)
+        self.assertEqual(self.checkout([{'recipe': self.shawa.id}], 5).status_code, 400)
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.coins, 1000)
+        self.assertEqual(DiscountOwnership.objects.get(owner=self.customer, rarity=3).qty, 1)
+        self.assertFalse(Order.objects.exists())
+
+    def test_discount_changes_reach_every_worker(self):
+        worker = DiscountTable()
+        self.assertEqual(worker.get()[3], 20)
+        with self.captureOnCommitCallbacks(execute=True):
+            discount = Discount.objects.get(rarity=3)
+            discount.percents = 50
+            discount.save()
+        self.assertEqual(worker.get()[3], 50)
+        self.assertEqual(self.checkout([{'recipe': self.shawa.id}], 3).json()['price'], 75)
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    def test_discount_is_consumed_once(self):
+        reset_caches()
+        Discount.objects.create(rarity=3, percents=20)
+        customer = Customer.objects.create(coins=10000)
+        comm, stat = Comment.objects.create(author=customer), Stat.objects.create()
+        recipe = Recipe.objects.create(author_comm=comm, stat=stat, price=100, is_private=False)
+        DiscountOwnership.objects.filter(owner=customer, rarity=3).update(qty=20)
+
+        results = []
+
+        def buy():
+            try:
+                for _ in range(5):
+                    try:
+                        checkout(customer.id, [(recipe.id, 1)], 3)
+                        results.append('bought')
+                    except ValidationError:
+                        results.append('rejected')
+            except Exception as e:
+                results.append(e)
+            finally:
+                connection.close()
+
+        workers = [Thread(target=buy) for _ in range(8)]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        self.assertEqual(sorted(results, key=str), ['bought'] * 20 + ['rejected'] * 20)
+        self.assertEqual(Order.objects.count(), 20)
+        self.assertEqual(DiscountOwnership.objects.get(owner=customer, rarity=3).qty, 0)
+        self.assertEqual(Customer.objects.get(id=customer.id).coins, 10000 - 20 * 80)
+
+
+class MarketTest(TestCase):
+    def setUp(self):
+        self.seller = Customer.objects.create(coins=0)
+        self.buyer = Customer.objects.create(coins=100)
+        self.meat, self.garlic = create_component(name='meat'), create_component(name='garlic')
+        add_components(self.seller.id, {self.meat.id: 5, self.garlic.id: 1})
+        add_components(self.buyer.id, {self.meat.id: 1})
+
+    def owned(self, customer):
+        return dict(ComponentOwnership.objects.filter(owner=customer).values_list('component_id', 'qty'))
+
+    def list_lot(self, components, price=60):
+        return self.client.post('/customer/lot/{}'.format(self.seller.id),
+                                {'components': [{'component': c.id, 'qty': q} for c, q in components],
+                                 'price': price}, content_type='application/json')
+
+    def buy(self, lot_id, customer):
+        return self.client.post('/lot/buy/{}'.format(lot_id), {'customer': customer.id},
+                                content_type='application/json')
+
+    def test_list_and_buy(self):
+        response = self.list_lot([(self.meat, 3), (self.garlic, 1)])
+        self.assertEqual(response.status_code, 201)
+        lot_id = response.json()['lot']
+        self.assertEqual(self.owned(self.seller), {self.meat.id: 2, self.garlic.id: 0})
+        self.assertEqual(self.list_lot([(self.meat, 1)]).status_code, 400)
+
+        self.assertEqual(self.buy(lot_id, self.buyer).status_code, 200)
+        self.assertEqual(self.owned(self.seller), {self.meat.id: 2})
+        self.assertEqual(self.owned(self.buyer), {self.meat.id: 4, self.garlic.id: 1})
+        self.assertEqual(list(Customer.objects.order_by('id').values_list('coins', flat=True)), [60, 40])
+        self.assertEqual(Lot.objects.get(id=lot_id).purchaser_id, self.buyer.id)
+
+        self.assertEqual(self.buy(lot_id, self.buyer).status_code, 409)
+
+    def test_buyer_without_coins(self):
+        lot_id = self.list_lot([(self.meat, 1)], price=500).json()['lot']
+        self.assertEqual(self.buy(lot_id, self.buyer).status_code, 400)
+        self.assertIsNone(Lot.objects.get(id=lot_id).purchaser)
+        self.assertEqual(self.owned(self.buyer), {self.meat.id: 1})
+
+
+class LotsCursorTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        seller = Customer.objects.create()
+        comm, stat = Comment.objects.create(author=seller), Stat.objects.create()
+        # lots are identified by price, ratings repeat so ids break the ties
+        Lot.objects.bulk_create([Lot(seller_comm=comm, stat=stat, price=i, rating=(i * 7) % 4 - 1)
+                                 for i in range(46)])
+        Lot.objects.filter(price=45).update(purchaser=seller)
+        self.expected = [price for _, _, price in sorted(
+            Lot.objects.filter(purchaser=None).values_list('rating', 'id', 'price'))]
+
+    def pages(self, url, direction):
+        pages = []
+        while url:
+            page = self.client.get(url).json()
+            pages.append([lot['price'] for lot in page['results']])
+            url = page[direction]
+        return pages, page
+
+    def test_forward_and_backward(self):
+        forward, last = self.pages('/lots/cursor', 'next')
+        self.assertEqual([len(page) for page in forward], [20, 20, 5])
+        self.assertEqual(sum(forward, []), self.expected)
+
+        backward, first = self.pages(last['previous'], 'previous')
+        self.assertEqual(backward, forward[-2::-1])
+        self.assertIsNone(first['previous'])
+        # the first page reached backward leads forward again
+        self.assertEqual(self.pages(first['next'], 'next')[0], forward[1:])
+
+    def test_invalid_cursor(self):
+        for cursor in ('garbage', 'cj0x', b64encode(b'r=x&i=1&d=n').decode(), b64encode(b'i=1&d=n').decode(),
+                       '%FF'):
+            self.assertEqual(self.client.get('/lots/cursor?cursor=' + cursor).status_code, 404, cursor)
+
+
+class MarketConcurrencyTest(TransactionTestCase):
+    def test_exactly_one_buyer_wins(self):
+        reset_caches()
+        seller = Customer.objects.create()
+        buyers = [Customer.objects.create(coins=10) for _ in range(8)]
+        comp = create_component()
+        add_components(seller.id, {comp.id: 1})
+        lot = list_lot(seller.id, {comp.id: 1}, 10)
+
+        results = []
+
+        def buy(buyer):
+            try:
+                buy_lot(lot.id, buyer.id)
+                results.append('won')
+            except LotUnavailable:
+                results.append('lost')
+            except Exception as e:
+                results.append(e)
+            finally:
+                connection.close()
+
+        workers = [Thread(target=buy, args=(buyer,)) for buyer in buyers]
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+
+        self.assertEqual(sorted(results, key=str), ['lost'] * 7 + ['won'])
+        winner = Lot.objects.get(id=lot.id).purchaser_id
+        self.assertEqual(ComponentOwnership.objects.get(component=comp, owner_id=winner).qty, 1)
+        self.assertEqual(Customer.objects.get(id=seller.id).coins, 10)
+        self.assertEqual(sum(Customer.objects.filter(id__in=[b.id for b in buyers])
+                             .values_list('coins', flat=True)), 70)
+
+
+class ExchangeTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        Discount.objects.bulk_create([Discount(rarity=r, percents=r * 5) for r in (5, 6)])
+        self.customer = Customer.objects.create()
+        self.rare = create_component(rarity=5, name='rare')
+        self.common = [create_component(rarity=6, name='common{}'.format(i)) for i in range(2)]
+        add_components(self.customer.id, {self.rare.id: 2, self.common[0].id: 3, self.common[1].id: 1})
+
+    def exchange(self, components):
+        return self.client.post('/customer/exchange/{}'.format(self.customer.id),
+                                {'components': [{'component': c.id, 'qty': q} for c, q in components]},
+                                content_type='application/json')
+
+    def test_exchange(self):
+        response = self.exchange([(self.rare, 1), (self.common[0], 3), (self.common[1], 1)])
+        self.assertEqual(response.json(), [{'rarity': 5, 'qty': 1}, {'rarity': 6, 'qty': 4}])
+        self.assertEqual(dict(ComponentOwnership.objects.filter(owner=self.customer)
+                              .values_list('component_id', 'qty')), {self.rare.id: 1})
+        self.assertEqual(dict(DiscountOwnership.objects.filter(owner=self.customer)
+                              .values_list('rarity', 'qty')), {5: 1, 6: 4})
+
+        self.assertEqual(self.exchange([(self.rare, 5)]).status_code, 400)
+        self.assertEqual(DiscountOwnership.objects.get(owner=self.customer, rarity=5).qty, 1)
+
+
+class AsyncViewsTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        Discount.objects.bulk_create([Discount(rarity=r, percents=r) for r in (5, 6)])
+        self.customer = Customer.objects.create()
+        comps = [create_component(name='компонент{}'.format(i), type=ComponentType.objects.create(name='wrp'))
+                 for i in range(3)]
+        add_components(self.customer.id, {comps[0].id: 2, comps[1].id: 1})
+        root = Comment.objects.create(author=self.customer, text='корень')
+        Comment.objects.create(author=self.customer, text='ответ', reply_to=root)
+        stat = Stat.objects.create(views=3)
+        for i in range(25):
+            lot = Lot.objects.create(seller_comm=root, stat=stat, price=i)
+            ComponentOwnership.objects.create(owner=Customer.objects.create(), component=comps[2],
+                                              lot=lot, lot_qty=1, qty=0)
+        self.paths = ['components', 'customer/owns/components/{}'.format(self.customer.id),
+                      'customer/components/{}'.format(self.customer.id),
+                      'customer/discounts/{}'.format(self.customer.id),
+                      'lots/', 'lots/?page=2', 'lot/{}'.format(lot.id),
+                      'comment/branch/{}'.format(root.id), 'comment/branch/{}?depth=0'.format(root.id),
+                      'comment/branch/{}?limit=1'.format(root.id), 'comment/branch/{}?limit=0'.format(root.id),
+                      # errors are DRF json as well
+                      'lot/0', 'lots/?page=9', 'lots/?page=x', 'comment/branch/0']
+
+    async def test_same_responses(self):
+        for path in self.paths:
+            expected = await sync_to_async(self.client.get)('/' + path)
+            response = await self.async_client.get('/async/' + path)
+            self.assertEqual(response.status_code, expected.status_code, path)
+            # links of paginated responses point to async urls
+            self.assertEqual(response.content.replace(b'/async/', b'/'), expected.content, path)
+
+
+# TransactionTestCase since reads inside transactions are never routed to replicas
+@override_settings(DATABASE_REPLICAS=['replica'])
+class RoutingTest(TransactionTestCase):
+    def setUp(self):
+        self.router = PrimaryReplicaRouter()
+
+    def read_db(self, request, write=False):
+        def view(request):
+            if write:
+                Stat.objects.create()
+            return HttpResponse(self.router.db_for_read(Lot))
+        return PrimaryPinningMiddleware(view)(request)
+
+    def test_pinning_after_write(self):
+        factory = RequestFactory()
+        response = self.read_db(factory.get('/lots/'))
+        self.assertEqual(response.content, b'replica')
+        self.assertNotIn('pin_primary', response.cookies)
+
+        # unsafe requests read from the primary, only actual writes pin next requests
+        response = self.read_db(factory.post('/lot/buy/1'))
+        self.assertEqual(response.content, b'default')
+        self.assertNotIn('pin_primary', response.cookies)
+
+        response = self.read_db(factory.get('/customer/roulette/1'), write=True)
+        self.assertEqual(response.content, b'default')
+        self.assertEqual(response.cookies['pin_primary']['max-age'], 5)
+
+        request = factory.get('/lots/')
+        request.COOKIES['pin_primary'] = '1'
+        self.assertEqual(self.read_db(request).content, b'default')
+        self.assertEqual(self.router.db_for_read(Lot), 'replica')
+
+    async def test_async_pinning(self):
+        async def view(request):
+            await Stat.objects.acreate()
+            return HttpResponse(self.router.db_for_read(Lot))
+        middleware = PrimaryPinningMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+
+        response = await middleware(RequestFactory().get('/customer/roulette/1'))
+        self.assertEqual(response.content, b'default')
+        self.assertIn('pin_primary', response.cookies)
+        self.assertEqual(self.router.db_for_read(Lot), 'replica')
+
+    def test_sqlite_pragmas(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode')
+            self.assertEqual(cursor.fetchone()[0], 'wal')
+            cursor.execute('PRAGMA synchronous')
+            self.assertEqual(cursor.fetchone()[0], 1)
+
+
+class BulkDataTest(TestCase):
+    def call(self, *args, **kwargs):
+        call_command(*args, stdout=StringIO(), stderr=StringIO(), **kwargs)
+
+    def test_seed_export_import(self):
+        self.call('seed', customers=20, components=5, ownerships=60, lots=4, recipes=6, reactions=30,
+                  replies=10, batch_size=7)
+        self.assertEqual(Customer.objects.count(), 20)
+        self.assertEqual(ComponentOwnership.objects.count(), 60)
+        self.assertEqual(ComponentOwnership.objects.exclude(lot=None).count(), 4)
+        self.assertEqual(RecipeComposition.objects.count(), 18)
+        self.assertFalse(Recipe.objects.filter(price=0).exists())
+        self.assertEqual(RecipeReactionsCount.objects.aggregate(n=Sum('qty'))['n'], 30)
+        self.assertEqual(Comment.objects.exclude(reply_to=None).count(), 10)
+
+        rows = lambda model: list(model.objects.order_by('pk').values_list())
+        ownerships, lots = rows(ComponentOwnership), rows(Lot)
+        with tempfile.TemporaryDirectory() as tmp:
+            for fmt in ('jsonl', 'csv'):
+                self.call('export_data', 'lot', 'componentownership', dir=tmp, format=fmt, chunk_size=7)
+                ComponentOwnership.objects.all().delete()
+                self.call('import_data', dir=tmp, format=fmt, batch_size=9, update=True)
+                self.assertEqual(rows(ComponentOwnership), ownerships)
+                self.assertEqual(rows(Lot), lots)
+
+            Lot.objects.update(price=0)
+            self.call('import_data', 'lot', input=str(Path(tmp) / 'lot.csv'), format='csv', update=True)
+            self.assertEqual(rows(Lot), lots)
+
+
+class BenchmarkHelpersTest(TestCase):
+    def test_endpoint_paths(self):
+        paths = dict(endpoint_paths(urls.urlpatterns, {('lot', 'pk'): 3, ('customer', 'pk'): 5, 'taste': 'swt'},
+                                    {'lots/': '?page=2'}))
+        self.assertEqual(paths['lot/<int:pk>'], '/lot/3')
+        self.assertEqual(paths['async/lot/<int:pk>'], '/async/lot/3')
+        self.assertEqual(paths['customer/discounts/<int:pk>'], '/customer/discounts/5')
+        self.assertEqual(paths['lots/'], '/lots/?page=2')
+        # POST only views and routes without samples are skipped
+        self.assertNotIn('lot/buy/<int:pk>', paths)
+        self.assertNotIn('recipe/rank/<int:pk>/<str:taste>', paths)
+
+    def test_regressions(self):
+        baseline = {'a': {'queries': 2, 'p95': 10.0}, 'b': {'queries': 1, 'p95': 1.0}}
+        self.assertEqual(regressions({'a': {'queries': 2, 'p95': 15.0}, 'b': {'queries': 1, 'p95': 2.5},
+                                      'new': {'queries': 9, 'p95': 99.0}}, baseline), [])
+        found = regressions({'a': {'queries': 3, 'p95': 25.0}, 'b': {'queries': 1, 'p95': 3.5}}, baseline)
+        self.assertEqual(len(found), 3)
+        # latencies are compared only on request
+        self.assertEqual(regressions({'a': {'queries': 3, 'p95': 25.0}}, baseline, tolerance=None),
+                         ['a: 3 queries instead of 2'])
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 50), 3)
+
+
+class PerformanceMiddlewareTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        registry.reset()
+        self.root = Comment.objects.create(author=Customer.objects.create(), text='root')
+
+    def test_server_timing_and_metrics(self):
+        response = self.client.get('/comment/branch/{}'.format(self.root.id))
+        timing = re.fullmatch(r'db;dur=[\d.]+;desc="1 queries", serializer;dur=([\d.]+), '
+                              r'render;dur=[\d.]+, total;dur=[\d.]+', response['Server-Timing'])
+        self.assertGreater(float(timing.group(1)), 0)
+        self.client.get('/comment/branch/{}'.format(self.root.id))
+        self.client.get('/comment/branch/0')
+
+        metrics = self.client.get('/metrics').content.decode()
+        self.assertIn('core_request_duration_seconds_count{view="comment/branch/<int:pk>"} 3', metrics)
+        self.assertIn('core_request_duration_seconds_bucket{view="comment/branch/<int:pk>",le="+Inf"} 3', metrics)
+        self.assertIn('core_db_queries_total{view="comment/branch/<int:pk>"} 3', metrics)
+        self.assertIn('core_request_serializer_duration_seconds_count{view="comment/branch/<int:pk>"} 3', metrics)
+        self.assertIn('core_responses_total{view="comment/branch/<int:pk>",status="404"} 1', metrics)
+
+    def test_serializer_time(self):
+        lot = Lot.objects.create(seller_comm=self.root, stat=Stat.objects.create(), price=1)
+        ComponentOwnership.objects.create(owner=self.root.author, component=create_component(), lot=lot, lot_qty=1)
+        with serialization_timer() as timer:
+            with patch('core.metrics.perf_counter', side_effect=[1.0, 3.0]):
+                # nested LotItemSr is a part of the outermost call, more calls of perf_counter would fail
+                self.assertEqual(len(BriefLotSr(Lot.objects.all(), many=True).data[0]['consist_of']), 1)
+        self.assertEqual(timer.time, 2.0)
+        self.assertEqual(timer.depth, 0)
+        # outside of measured requests serializers aren't timed
+        with patch('core.metrics.perf_counter', side_effect=AssertionError):
+            CommentSr(self.root).data
+
+    async def test_async_requests(self):
+        async def view(request):
+            return HttpResponse()
+        self.assertTrue(asyncio.iscoroutinefunction(PerformanceMiddleware(view)))
+        self.assertFalse(asyncio.iscoroutinefunction(PerformanceMiddleware(lambda request: HttpResponse())))
+
+        # queries of async views are made in threads of sync_to_async
+        response = await self.async_client.get('/async/comment/branch/{}'.format(self.root.id))
+        self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+    @override_settings(PERF_SLOW_QUERY_MS=0)
+    def test_slow_query_log(self):
+        with self.assertLogs('core.slow_queries', 'WARNING') as logs:
+            self.client.get('/comment/branch/{}'.format(self.root.id))
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('WITH RECURSIVE', logs.output[0])
+        self.assertIn('in load_branch', logs.output[0])
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.type = ComponentType.objects.create(name='wrp')
+        self.comps = [create_component(name='comp{}'.format(i), type=self.type) for i in range(2)]
+        self.customer = Customer.objects.create()
+        add_components(self.customer.id, {self.comps[0].id: 1})
+
+    def get(self, path, etag=None):
+        return self.client.get(path, **({'HTTP_IF_NONE_MATCH': etag} if etag else {}))
+
+    def test_not_modified(self):
+        for path in ('/components', '/customer/components/{}'.format(self.customer.id),
+                     '/async/components', '/async/customer/components/{}'.format(self.customer.id)):
+            response = self.get(path)
+            etag = response['ETag']
+            for header in (etag, 'W/' + etag, '"other", ' + etag, '*'):
+                not_modified = self.get(path, header)
+                self.assertEqual(not_modified.status_code, 304, path)
+                self.assertEqual(not_modified.content, b'')
+                self.assertEqual(not_modified['ETag'], etag)
+            self.assertEqual(self.get(path, '"other"').content, response.content)
+
+    def test_etag_changes(self):
+        components = self.get('/components')['ETag']
+        available = self.get('/customer/components/{}'.format(self.customer.id))['ETag']
+
+        # own components change only the customer's etag
+        add_components(self.customer.id, {self.comps[1].id: 1})
+        self.assertEqual(self.get('/components', components).status_code, 304)
+        response = self.get('/customer/components/{}'.format(self.customer.id), available)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.comps[1].name = 'renamed'
+            self.comps[1].save()
+        response = self.get('/components', components)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('renamed', [comp['name'] for comp in response.json()])
+
+    def test_version_is_shared_by_workers(self):
+        worker = Catalog()
+        version = worker.get().version
+        self.assertEqual(catalog.get().version, version)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.comps[0].delete()
+        self.assertNotEqual(worker.get().version, version)
+        self.assertEqual(len(worker.get().detail), 1)
+
+
+class FastPathTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.type = ComponentType.objects.create(name='sau', measure='m')
+        self.comps = [create_component(name='соус\u2028{}'.format(i), type=self.type) for i in range(3)]
+        Component.objects.filter(id=self.comps[0].id).update(desc='"ёж" \\ \u2029')
+        self.customer = Customer.objects.create()
+        add_components(self.customer.id, {comp.id: 3 for comp in self.comps})
+        self.lot = list_lot(self.customer.id, {self.comps[0].id: 1, self.comps[2].id: 2}, 10, 'lot')
+
+    def assert_same_json(self, slow, fast):
+        self.assertEqual(JSONRenderer().render(slow), fast_renderer.render(fast))
+
+    def test_same_bytes_as_serializers(self):
+        components = Component.objects.order_by('id')
+        self.assert_same_json(BriefComponentSr(components, many=True).data, brief_components(components))
+        self.assert_same_json(DetailComponentSr(components, many=True).data, detail_components(components))
+        ownerships = ComponentOwnership.objects.filter(owner=self.customer)
+        self.assert_same_json(ComponentOwnershipSr(ownerships, many=True).data, component_ownerships(ownerships))
+        lots = Lot.objects.prefetch_related(Prefetch('consist_of', ComponentOwnership.objects.all()))
+        self.assert_same_json(BriefLotSr(lots, many=True).data, brief_lots(list(Lot.objects.all())))
+
+    def test_renderer_fallback(self):
+        for data in ({1: 'int key'}, [Decimal('1.5')], None):
+            self.assertEqual(fast_renderer.render(data), JSONRenderer().render(data))
+        self.assertEqual(fast_renderer.render({'a': [1, 'б']}, 'application/json; indent=2'),
+                         JSONRenderer().render({'a': [1, 'б']}, 'application/json; indent=2'))
+
+    def test_views(self):
+        response = self.client.get('/customer/owns/components/{}'.format(self.customer.id))
+        self.assertEqual(response.json(), [{'component': comp.id, 'qty': qty}
+                                           for comp, qty in zip(self.comps, (2, 3, 1))])
+        self.assertEqual(self.client.get('/lots/').json()['results'],
+                         [{'price': 10, 'consist_of': [{'component': self.comps[0].id, 'lot_qty': 1},
+                                                       {'component': self.comps[2].id, 'lot_qty': 2}]}])
+
+
+class UsernameTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        self.customer = Customer.objects.create(username='alice')
+        add_components(self.customer.id, {create_component().id: 10})
+
+    def test_username_routes(self):
+        url = '/customer/owns/components/alice'
+        self.assertEqual(self.client.get(url).json(), self.client.get(
+            '/customer/owns/components/{}'.format(self.customer.id)).json())
+        # username is resolved from the cache
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(url).status_code, 200)
+        self.assertEqual(self.client.get('/customer/discounts/alice').status_code, 200)
+        self.assertEqual(self.client.get('/customer/owns/components/bob').status_code, 404)
+
+    def test_rename_and_delete(self):
+        self.assertEqual(usernames.resolve('alice'), self.customer.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.customer.username = 'bob'
+            self.customer.save()
+        self.assertEqual(self.client.get('/customer/owns/components/alice').status_code, 404)
+        self.assertEqual(usernames.resolve('bob'), self.customer.id)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Customer.objects.create(username='alice')
+            self.customer.delete()
+        self.assertNotEqual(usernames.resolve('alice'), self.customer.id)
+        self.assertEqual(self.client.get('/customer/components/bob').status_code, 404)
+
+    def test_lru(self):
+        resolver = UsernameResolver(maxsize=2, ttl=60)
+        ids = {name: Customer.objects.create(username=name).id for name in ('a', 'b', 'c')}
+        resolver.resolve('a')
+        resolver.resolve('b')
+        resolver.resolve('a')
+        resolver.resolve('c')
+        with self.assertNumQueries(0):
+            self.assertEqual(resolver.resolve('a'), ids['a'])
+            self.assertEqual(resolver.resolve('c'), ids['c'])
+        with self.assertNumQueries(1):
+            self.assertEqual(resolver.resolve('b'), ids['b'])
+
+
+class InventorySnapshotTest(TestCase):
+    def setUp(self):
+        reset_caches()
+        Discount.objects.bulk_create([Discount(rarity=r, percents=r * 5) for r in range(1, 7)])
+        self.customer = Customer.objects.create(username='alice', coins=500)
+        self.other = Customer.objects.create(coins=500)
+        self.comps = [create_component(rarity=r, name='comp{}'.format(r), type=ComponentType.objects.create(name='wrp'))
+                      for r in (5, 6)]
+        add_components(self.customer.id, {self.comps[0].id: 30, self.comps[1].id: 10})
+        self.url = '/customer/inventory/{}'.format(self.customer.id)
+
+    def get(self, etag=None):
+        return self.client.get(self.url, **({'HTTP_IF_NONE_MATCH': etag} if etag else {}))
+
+    def test_snapshot(self):
+        with self.assertNumQueries(5):
+            response = self.get()
+        with self.assertNumQueries(3):
+            self.get()
+        data = response.json()
+        pk = self.customer.id
+        self.assertEqual(data['coins'], 500)
+        self.assertEqual(data['ownerships'], self.client.get('/customer/owns/components/{}'.format(pk)).json())
+        self.assertEqual(data['components'], self.client.get('/customer/components/{}'.format(pk)).json())
+        self.assertEqual(data['discounts'], self.client.get('/customer/discounts/{}'.format(pk)).json())
+        self.assertEqual(self.client.get('/customer/inventory/alice').content, response.content)
+        self.assertEqual(self.client.get('/customer/inventory/0').status_code, 404)
+
+    def test_etag(self):
+        etag = self.get()['ETag']
+        with self.assertNumQueries(1):
+            self.assertEqual(self.get(etag).status_code, 304)
+
+        # changes of other customers keep the etag, any change of the customer's inventory changes it
+        add_components(self.other.id, {self.comps[0].id: 10})
+        self.assertEqual(self.get(etag).status_code, 304)
+        changes = [
+            lambda: add_components(self.customer.id, {self.comps[0].id: 10}),
+            lambda: take_components(self.customer.id, {self.comps[0].id: 10}),
+            lambda: self.client.post('/customer/exchange/{}'.format(self.customer.id),
+                                     {'components': [{'component': self.comps[1].id, 'qty': 10}]},
+                                     content_type='application/json'),
+            lambda: list_lot(self.customer.id, {self.comps[0].id: 10}, 100),
+            lambda: buy_lot(list_lot(self.other.id, {self.comps[0].id: 10}, 100).id, self.customer.id),
+        ]
+        for change in changes:
+            change()
+            response = self.get(etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+            etag = response['ETag']
+        self.assertEqual(response.json()['coins'], 400)
+
+    def test_etag_follows_orm_changes(self):
+        etag = self.get()['ETag']
+        ownership = ComponentOwnership.objects.get(owner=self.customer, component=self.comps[0])
+        discount = DiscountOwnership.objects.get(owner=self.customer, rarity=1)
+        customer = Customer.objects.get(id=self.customer.id)
+
+        def save(obj, update_fields=None, **fields):
+            for name, value in fields.items():
+                setattr(obj, name, value)
+            obj.save(update_fields=update_fields)
+
+        def add_then_save():
+            # the loaded customer doesn't know the version was bumped since then
+            add_components(self.customer.id, {self.comps[1].id: 1})
+            save(customer, coins=100)
+
+        changes = [
+            lambda: save(ownership, qty=5),
+            lambda: save(discount, qty=2),
+            lambda: save(customer, coins=300),
+            lambda: save(customer, ['coins'], coins=200),
+            add_then_save,
+            ownership.delete,
+        ]
+        # an etag seen before would make clients holding it skip the change
+        seen = {etag}
+        for change in changes:
+            change()
+            response = self.get(etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn(response['ETag'], seen)
+            etag = response['ETag']
+            seen.add(etag)
+        data = response.json()
+        self.assertEqual(data['coins'], 100)
+        self.assertEqual([o['component'] for o in data['ownerships']], [self.comps[1].id])
+        self.assertEqual(data['discounts'][0]['qty'], 2)
+
+    def test_customer_is_locked_first(self):
+        add_components(self.other.id, {self.comps[0].id: 10})
+        lot = list_lot(self.other.id, {self.comps[0].id: 10}, 100)
+        recipe = Recipe.objects.create(author_comm=Comment.objects.create(author=self.customer),
+                                       stat=Stat.objects.create(), is_private=False)
+        writers = [
+            lambda: add_components(self.customer.id, {self.comps[0].id: 10}),
+            lambda: take_components(self.customer.id, {self.comps[0].id: 10}),
+            lambda: exchange(self.customer.id, {self.comps[1].id: 1}),
+            lambda: list_lot(self.customer.id, {self.comps[0].id: 10}, 100),
+            lambda: buy_lot(lot.id, self.customer.id),
+            lambda: checkout(self.customer.id, [(recipe.id, 1)]),
+        ]
+        # lots are claimed before customers, new comments, stats and lots can't be locked by others
+        skipped = {Comment._meta.db_table, Stat._meta.db_table, Lot._meta.db_table}
+        for writer in writers:
+            with CaptureQueriesContext(connection) as ctx:
+                writer()
+            tables = [match.group(1) for match in
+                      (re.match(r'(?:INSERT INTO|UPDATE|DELETE FROM) "(\w+)"', q['sql'])
+                       for q in ctx.captured_queries) if match]
+            self.assertEqual([t for t in tables if t not in skipped][0], Customer._meta.db_table)
+
+
+# every query made by views must find its rows through indexes
+# in-process caches (catalog, leaderboards, search index, ...) read whole tables once by design,
+# so they are warmed up before queries are captured
+class QueryPlanTest(TestCase):
+    # rows of the recursive CTE of load_branch
+    cte_names = {'b'}
+
+    def setUp(self):
+        reset_caches()
+        call_command('seed', customers=30, components=10, ownerships=100, lots=30, recipes=20, reactions=40,
+                     replies=30, stdout=StringIO())
+        reset_caches()
+        leaderboards.invalidate()
+        recipe_index.invalidate()
+
+    # caches warmed up with seeded rows mustn't leak into other tests
+    def tearDown(self):
+        reset_caches()
+        leaderboards.invalidate()
+        recipe_index.invalidate()
+
+    def full_scans(self, queries):
+        scans = set()
+        with connection.cursor() as cursor:
+            for query in queries:
+                if query['sql'].startswith(('SAVEPOINT', 'RELEASE', 'ROLLBACK')):
+                    continue
+                cursor.execute('EXPLAIN QUERY PLAN ' + query['sql'])
+                for row in cursor.fetchall():
+                    match = re.match(r'SCAN (\w+)$', row[-1])
+                    if match and match.group(1) not in self.cte_names:
+                        scans.add('{}: {}'.format(row[-1], query['sql']))
+        return scans
+
+    def test_views_use_indexes(self):
+        customer = ComponentOwnership.objects.values_list('owner_id', flat=True).first()
+        samples = {
+            ('customer', 'pk'): customer,
+            'username': Customer.objects.get(id=customer).username,
+            ('lot', 'pk'): Lot.objects.filter(purchaser=None).values_list('id', flat=True).first(),
+            ('recipe', 'pk'): Recipe.objects.filter(is_private=False).values_list('id', flat=True).first(),
+            ('comment', 'pk'): Comment.objects.filter(reply_to=None).values_list('id', flat=True).first(),
+            'taste': 'swt',
+        }
+        paths = endpoint_paths(urls.urlpatterns, samples, {'recipes/search': '?any=1,2', 'lots/': '?page=2'})
+        for route, path in paths:
+            self.client.get(path)
+        cursor = self.client.get('/lots/cursor').json()['next'].split('cursor=')[1]
+        lot = Lot.objects.filter(purchaser=None).exclude(seller_comm__author_id=customer).first()
+        Customer.objects.filter(id=customer).update(coins=10 ** 6)
+        comp = ComponentOwnership.objects.filter(owner_id=customer, qty__gt=0) \
+            .values_list('component_id', flat=True).first()
+        reaction = Reaction.objects.values_list('id', flat=True).first()
+
+        with CaptureQueriesContext(connection) as queries:
+            for route, path in paths:
+                self.assertLess(self.client.get(path).status_code, 400, path)
+            self.client.get('/lots/cursor?cursor={}'.format(cursor))
+            buy_lot(lot.id, customer)
+            exchange(customer, {comp: 1})
+            checkout(customer, [(samples['recipe', 'pk'], 1)])
+            votes.vote_lot(lot.id, customer, 'up')
+            votes.react_to_recipe(samples['recipe', 'pk'], customer, reaction)
+            votes.flush()
+        self.assertEqual(self.full_scans(queries.captured_queries), set())
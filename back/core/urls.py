@@ -1,5 +1,6 @@
 from django.urls import path
 from .views import *
+from . import async_views
 
 
 urlpatterns = [
@@ -22,12 +23,63 @@ urlpatterns = [
     path('customer/discounts/<int:pk>', DiscountsList.as_view()),
     path('customer/discounts/<str:username>', DiscountsList.as_view()),
 
+    # everything of the above and coins in one response with etag of customer's inventory version
+    path('customer/inventory/<int:pk>', CustomerInventory.as_view()),
+    path('customer/inventory/<str:username>', CustomerInventory.as_view()),
+
+    # exchanging components for discounts of their rarities
+    path('customer/exchange/<int:pk>', Exchange.as_view()),
+    path('customer/exchange/<str:username>', Exchange.as_view()),
+
+    # creating order of recipes paid with coins and optional discount
+    path('customer/checkout/<int:pk>', Checkout.as_view()),
+    path('customer/checkout/<str:username>', Checkout.as_view()),
+
     # open lots (without specified purchaser) in brief form with paginator
     path('lots/', LotsList.as_view()),
+    # the same lots with cursor instead of page number (no total count, fast deep pages)
+    path('lots/cursor', LotsCursorList.as_view()),
     # lot details like purchaser, stat
     path('lot/<int:pk>', LotDetail.as_view()),
+    # listing customer's components as a lot
+    path('customer/lot/<int:pk>', LotCreate.as_view()),
+    path('customer/lot/<str:username>', LotCreate.as_view()),
+    # buying the lot
+    path('lot/buy/<int:pk>', LotBuy.as_view()),
+    # up/down vote for lot or taking the vote back
+    path('lot/vote/<int:pk>', LotVote.as_view()),
+
+    # customer's reaction to recipe or taking the reaction back
+    path('recipe/react/<int:pk>', RecipeReact.as_view()),
+
+    # checking recipe composition: component types compatibility and quantities
+    path('recipe/validate', RecipeValidation.as_view()),
+
+    # public recipes by components: ?all=<ids>&any=<ids>&none=<ids>, ranked by rating
+    path('recipes/search', RecipesSearch.as_view()),
+    # public recipes with the most components in common with the recipe
+    path('recipe/similar/<int:pk>', SimilarRecipes.as_view()),
+
+    # leaderboards of public recipes by rating or by taste reactions (e.g. recipes/top/swt)
+    path('recipes/top', RecipesTop.as_view()),
+    path('recipes/top/<str:taste>', RecipesTop.as_view()),
+    path('recipe/rank/<int:pk>', RecipeRank.as_view()),
+    path('recipe/rank/<int:pk>/<str:taste>', RecipeRank.as_view()),
 
     # branch corresponds to comment with pk:
-    # replies, replies to replies, etc
-    path('comment/branch/<int:pk>', CommentBranch.as_view())
+    # replies, replies to replies, etc in depth-first order
+    # optional ?depth=<max nesting level>&limit=<max comments>
+    path('comment/branch/<int:pk>', CommentBranch.as_view()),
+
+    # per-view latency histograms and query counts of this process for Prometheus
+    path('metrics', MetricsExport.as_view()),
+
+    # async variants of read endpoints for ASGI servers (see async_views.py)
+    path('async/components', async_views.components),
+    path('async/customer/owns/components/<int:pk>', async_views.ownerships),
+    path('async/customer/components/<int:pk>', async_views.available_components),
+    path('async/customer/discounts/<int:pk>', async_views.discounts),
+    path('async/lots/', async_views.lots),
+    path('async/lot/<int:pk>', async_views.lot_detail),
+    path('async/comment/branch/<int:pk>', async_views.comment_branch),
 ]
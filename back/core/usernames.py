@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+from django.conf import settings
+from django.db import transaction
+from rest_framework.exceptions import NotFound
+
+from .models import Customer
+
+
+# per-process bounded LRU cache username -> customer id used by all <str:username> routes
+# entries are dropped when the customer is saved or deleted in this process (see signals.py)
+# and expire after ttl seconds to pick up renames made by other processes
+class UsernameResolver:
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = Lock()
+        self._version = 0
+        # username: (customer_id, expires_at) from the least to the most recently used, customer_id: username
+        self._ids = OrderedDict()
+        self._names = {}
+
+    def _drop(self, customer_id):
+        username = self._names.pop(customer_id, None)
+        if username is not None:
+            self._ids.pop(username, None)
+
+    def forget(self, customer_id):
+        with self._lock:
+            self._version += 1
+            self._drop(customer_id)
+
+    def clear(self):
+        with self._lock:
+            self._version += 1
+            self._ids.clear()
+            self._names.clear()
+
+    # raises NotFound if there is no such customer, unknown usernames aren't cached
+    def resolve(self, username):
+        now = monotonic()
+        with self._lock:
+            entry = self._ids.get(username)
+            if entry is not None and entry[1] > now:
+                self._ids.move_to_end(username)
+                return entry[0]
+            version = self._version
+
+        customer_id = Customer.objects.filter(username=username).values_list('id', flat=True).first()
+        if customer_id is None:
+            raise NotFound('there is no customer {}'.format(username))
+
+        with self._lock:
+            # the customer could be renamed while it was being read
+            if version == self._version:
+                self._drop(customer_id)
+                self._ids[username] = (customer_id, now + self.ttl)
+                self._names[customer_id] = username
+                while len(self._ids) > self.maxsize:
+                    _, (evicted, _) = self._ids.popitem(last=False)
+                    del self._names[evicted]
+        return customer_id
+
+
+usernames = UsernameResolver(getattr(settings, 'USERNAME_CACHE_SIZE', 10000),
+                             getattr(settings, 'USERNAME_CACHE_TTL', 60))
+
+
+# id of the customer of the url: either pk or username
+def customer_pk(kwargs):
+    return kwargs['pk'] if 'pk' in kwargs else usernames.resolve(kwargs['username'])
+
+
+def forget_username(sender, instance, **kwargs):
+    customer_id = instance.id
+    transaction.on_commit(lambda: usernames.forget(customer_id))
@@ -0,0 +1,74 @@
+from threading import Lock
+
+from .models import Component, ComponentType
+from .catalog import catalog
+
+
+# compatibility matrix of component types and quantity bounds of components built from the catalog
+# and rebuilt when the catalog version changes (see catalog.py) so recipes are validated without queries
+class RecipeRules:
+    def __init__(self, version):
+        self.version = version
+        types = list(ComponentType.objects.prefetch_related('compability').order_by('id'))
+        bit = {t.id: 1 << i for i, t in enumerate(types)}
+        # {type_id: bitset of types that may be mixed with it}, the type is compatible with itself
+        self.compatible = {t.id: bit[t.id] | sum(bit[c.id] for c in t.compability.all()) for t in types}
+        self.bit = bit
+        # {component_id: (type_id, min_qty, max_qty, qty_step)}
+        self.bounds = {comp_id: bounds for comp_id, *bounds in Component.objects.values_list(
+            'id', 'type_id', 'min_qty', 'max_qty', 'qty_step')}
+        self.names = {t.id: t.name for t in types}
+
+    # composition is an iterable of (component_id, qty), returns list of errors (empty if valid)
+    def check(self, composition):
+        errors = []
+        seen, present = set(), 0
+        for comp_id, qty in composition:
+            if comp_id not in self.bounds:
+                errors.append('there is no component {}'.format(comp_id))
+                continue
+            if comp_id in seen:
+                errors.append('component {} is repeated'.format(comp_id))
+            seen.add(comp_id)
+
+            type_id, min_qty, max_qty, step = self.bounds[comp_id]
+            if not min_qty <= qty <= max_qty:
+                errors.append('qty of component {} must be in range [{}, {}]'
+                              .format(comp_id, min_qty, max_qty))
+            elif step and (qty - min_qty) % step:
+                errors.append('qty of component {} must be {} + k * {}'.format(comp_id, min_qty, step))
+            if type_id is not None:
+                present |= self.bit[type_id]
+
+        # every present type must be compatible with all other present types
+        for type_id, bit in self.bit.items():
+            if present & bit and present & ~self.compatible[type_id]:
+                conflicts = [self.names[t] for t, b in self.bit.items()
+                             if present & b & ~self.compatible[type_id]]
+                errors.append('{} can not be mixed with {}'.format(self.names[type_id], ', '.join(conflicts)))
+        return errors
+
+
+class RulesCache:
+    def __init__(self):
+        self._lock = Lock()
+        self._rules = None
+
+    def get(self):
+        version = catalog.version()
+        rules = self._rules
+        if rules is None or rules.version != version:
+            with self._lock:
+                rules = self._rules
+                if rules is None or rules.version != version:
+                    rules = self._rules = RecipeRules(version)
+        return rules
+
+
+rules = RulesCache()
+
+
+# returns list of errors of each composition, compositions are iterables of (component_id, qty)
+def validate_recipes(compositions):
+    current = rules.get()
+    return [current.check(composition) for composition in compositions]
@@ -0,0 +1,49 @@
+from threading import Lock
+from time import time
+
+from django.conf import settings
+from django.db import transaction
+
+from .models import Stat
+from .buffers import CounterBuffer, update_counters
+
+
+# Stat.views is shared by all viewers of lot or recipe so it's not incremented on every view:
+# views are buffered in process memory and flushed as UPDATE ... SET views = views + n batches
+
+def flush_views(pending):
+    update_counters(Stat, pending)
+
+
+views = CounterBuffer(flush_views,
+                      getattr(settings, 'STAT_VIEWS_FLUSH_INTERVAL', 5.0),
+                      getattr(settings, 'STAT_VIEWS_MAX_PENDING', 10000))
+
+
+# remembers (stat, customer) pairs seen during the current time window
+class ViewDedup:
+    def __init__(self, window):
+        self.window = window
+        self._lock = Lock()
+        self._current = None
+        self._seen = set()
+
+    # returns True only for the first view of the customer during the window
+    def first_view(self, stat_id, customer_id):
+        current = int(time() // self.window)
+        with self._lock:
+            if current != self._current:
+                self._current, self._seen = current, set()
+            if (stat_id, customer_id) in self._seen:
+                return False
+            self._seen.add((stat_id, customer_id))
+            return True
+
+
+dedup = ViewDedup(getattr(settings, 'STAT_VIEWS_DEDUP_WINDOW', 60))
+
+
+# counts view of the lot or recipe stat by customer (once per dedup window)
+def count_view(stat_id, customer_id):
+    if dedup.first_view(stat_id, customer_id):
+        transaction.on_commit(lambda: views.add(stat_id, views=1))
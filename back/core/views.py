@@ -1,88 +1,101 @@
-from random import randrange, choice as randchoice
-from bisect import bisect
+import re
+from base64 import b64decode, b64encode
+from collections import Counter
 
+from django.db import IntegrityError
+from django.http import HttpResponse
 from rest_framework import generics
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound, ValidationError
+from rest_framework.utils.urls import replace_query_param
 
 from .models import *
 from .serializers import *
 from .paginators import *
-
-
+from .roulette import sampler, max_spins
+from .inventory import add_components
+from .catalog import catalog, conditional_json, make_etag
+from .discounts import customer_discounts, discount_table
+from .votes import vote_lot, react_to_recipe
+from .viewcount import count_view
+from .leaderboard import leaderboards
+from .validation import validate_recipes
+from .search import recipe_index
+from .checkout import checkout
+from .market import list_lot, buy_lot
+from .exchange import exchange
+from .metrics import registry
+from .renderers import fast_renderer
+from .usernames import customer_pk
+
+
+# served from the pre-rendered catalog snapshot (see catalog.py)
 class AllComponentsList(generics.ListAPIView):
-    queryset = Component.objects.all()
+    queryset = Component.objects.select_related('type')
     serializer_class = BriefComponentSr
 
+    def list(self, request, *args, **kwargs):
+        snapshot = catalog.get()
+        return conditional_json(request, snapshot.etag, snapshot.brief)
+
 
+# rows are built from values() without ComponentOwnershipSr (see serializers.py)
 class ComponentOwnershipList(generics.ListAPIView):
     queryset = ComponentOwnership.objects.all()
     serializer_class = ComponentOwnershipSr
 
     # select only ownerships corresponded to the specified customer
     def list(self, request, *args, **kwargs):
-        if 'username' in kwargs:
-            ownership = ComponentOwnership.objects.filter(owner_username=kwargs['username'])
-        else:
-            ownership = ComponentOwnership.objects.filter(owner_id=kwargs['pk'])
-        serializer = ComponentOwnershipSr(ownership, many=True)
-        return Response(serializer.data)
+        ownership = self.get_queryset().filter(owner_id=customer_pk(kwargs))
+        return Response(component_ownerships(ownership))
 
 
 class AvailableComponentsList(generics.ListAPIView):
-    queryset = Component.objects.all()
+    queryset = ComponentOwnership.objects.all()
     serializer_class = DetailComponentSr
 
     # select only components in ownership of the specified customer applying another serializer
     def list(self, request, *args, **kwargs):
-        if 'username' in kwargs:
-            ownership = ComponentOwnership.objects.filter(owner_username=kwargs['username'])
-        else:
-            ownership = ComponentOwnership.objects.filter(owner_id=kwargs['pk'])
-        comp_ids = [o.component.id for o in ownership]
-        available_comps = Component.objects.filter(id__in=comp_ids)
-        serializer = DetailComponentSr(available_comps, many=True)
-        return Response(serializer.data)
+        ownership = self.get_queryset().filter(owner_id=customer_pk(kwargs))
+        comp_ids = sorted(set(ownership.values_list('component_id', flat=True)))
 
-
-# returns id of component to get from roulette
-def pick_component():
-    # picking the rarity
-    entry = randrange(100)              # [0,0] legendary   # [26,55] especial
-    prob = [0, 1, 6, 26, 56, 100]       # [1,5] mythical    # [56,99] rare
-    rarity = bisect(prob, entry)        # [6,25] epic
-
-    # todo: remove when there are at least one component with each rarity
-    rarity = 6
-    # picking the component
-    to_pick = [comp.id for comp in Component.objects.filter(rarity=rarity)]
-    return randchoice(to_pick)
+        # components are taken from the pre-rendered catalog snapshot (see catalog.py)
+        snapshot = catalog.get()
+        etag = make_etag(snapshot.version, comp_ids)
+        return conditional_json(request, etag, lambda: b'[' + b','.join(
+            snapshot.detail[comp_id] for comp_id in comp_ids if comp_id in snapshot.detail) + b']')
 
 
 # implementation of picking component from roulette
+# optional query param n - number of spins made at once (see roulette.max_spins)
 class Roulette(generics.RetrieveAPIView):
-    queryset = Component.objects.all()
+    queryset = Component.objects.select_related('type')
     serializer_class = BriefComponentSr
 
     def retrieve(self, request, *args, **kwargs):
-        # picking random component
-        comp_id = pick_component()
-
-        # increasing qty in ComponentOwnership by 1 or creating a new row with qty=1
-        if 'username' in kwargs:
-            pk = Customer.objects.get(username=kwargs['username']).id
-        else:
-            pk = kwargs['pk']
-
+        n = request.query_params.get('n')
         try:
-            ownership = ComponentOwnership.objects.get(owner_id=pk, component_id=comp_id)
-            ownership.qty += 1
-            ownership.save()
-        except ComponentOwnership.DoesNotExist:
-            ComponentOwnership.objects.create(owner_id=pk, component_id=comp_id, qty=1)
-
-        # returning picked component
-        component = Component.objects.get(id=comp_id)
-        serializer = BriefComponentSr(component)
+            spins = int(n) if n is not None else 1
+        except ValueError:
+            raise ValidationError('n must be an integer')
+        if not 1 <= spins <= max_spins:
+            raise ValidationError('n must be in range [1, {}]'.format(max_spins))
+
+        # picking random components
+        comp_ids = sampler.pick(spins)
+        if not comp_ids:
+            raise NotFound('there are no components in roulette')
+
+        pk = customer_pk(kwargs)
+
+        # increasing qty in ComponentOwnership by number of drops or creating new rows
+        add_components(pk, Counter(comp_ids))
+
+        # returning picked components
+        components = self.get_queryset().in_bulk(set(comp_ids))
+        if n is None:
+            return Response(BriefComponentSr(components[comp_ids[0]]).data)
+        serializer = BriefComponentSr([components[comp_id] for comp_id in comp_ids], many=True)
         return Response(serializer.data)
 
 
@@ -90,62 +103,358 @@ class Roulette(generics.RetrieveAPIView):
 # SELECT rarity, percents, qty
 # FROM Discount LEFT JOIN DiscountOwnership USING(rarity)
 # WHERE DiscountOwnership.owner=pk
+# percents are taken from the in-process Discount table (see discounts.py)
 class DiscountsList(generics.ListAPIView):
-    queryset = DiscountOwnership.objects.all()
+    queryset = DiscountOwnership.objects.select_related('rarity')
     serializer_class = DiscountSr
 
     def list(self, request, *args, **kwargs):
-        if 'username' in kwargs:
-            pk = Customer.objects.get(username=kwargs['username']).id
-        else:
-            pk = kwargs['pk']
-        existing_discounts = DiscountOwnership.objects.filter(owner_id=pk)
-
-        # adding such discounts to ownership that are not in ownership yet with qty=0
-        if len(existing_discounts) < Discount.objects.count():
-            all_rarities = set([d.rarity for d in Discount.objects.all()])
-            existing_rarities = set([d.rarity.rarity for d in existing_discounts])
-            for rarity in all_rarities - existing_rarities:
-                d = Discount.objects.get(rarity=rarity)
-                DiscountOwnership.objects.create(owner_id=pk, rarity=d, qty=0)
-
-        existing_discounts = DiscountOwnership.objects.filter(owner_id=pk)
-        serializer = DiscountSr(existing_discounts, many=True)
-        return Response(serializer.data)
+        return Response(customer_discounts(customer_pk(kwargs)))
+
+
+# coins, ownerships, owned components in detail (like 'customer/components') and discounts of the customer
+# in 3 queries, the etag follows customer's inventory_version so an unchanged profile costs 1 query and 304
+# content is read after the version, at worst it's newer than the etag and is refetched next time
+class CustomerInventory(generics.GenericAPIView):
+    queryset = Customer.objects.all()
+
+    def get(self, request, *args, **kwargs):
+        pk = customer_pk(kwargs)
+        customer = self.get_queryset().filter(id=pk).values_list('coins', 'inventory_version').first()
+        if customer is None:
+            raise NotFound()
+        coins, version = customer
+        snapshot = catalog.get()
+        percents = discount_table.get()
+        etag = make_etag(snapshot.version, sorted(percents.items()), pk, version)
+
+        def content():
+            ownerships = component_ownerships(ComponentOwnership.objects.filter(owner_id=pk))
+            comp_ids = sorted({ownership['component'] for ownership in ownerships})
+            components = b','.join(snapshot.detail[comp_id] for comp_id in comp_ids if comp_id in snapshot.detail)
+            return b'{"coins":%d,"ownerships":%s,"components":[%s],"discounts":%s}' % (
+                coins, fast_renderer.render(ownerships), components, fast_renderer.render(customer_discounts(pk)))
+
+        return conditional_json(request, etag, content)
 
 
 # all lots briefly, 20 items per page
+# lots of the page are rendered like BriefLotSr by brief_lots with one more query (see serializers.py)
 class LotsList(generics.ListAPIView):
-    queryset = Lot.objects.filter(purchaser=None)
+    queryset = Lot.objects.filter(purchaser=None).only('id', 'price', 'rating')
     serializer_class = BriefLotSr
     pagination_class = LotsPg
 
+    def list(self, request, *args, **kwargs):
+        page = self.paginate_queryset(self.get_queryset())
+        return self.get_paginated_response(brief_lots(page))
+
 
+# the same lots with keyset pagination: no total count, pages are moved by next/previous links
+class LotsCursorList(LotsList):
+    pagination_class = LotsCursorPg
+
+
+# optional query param customer - id of the viewer whose view is counted in lot stat
+# todo: take the viewer from authorization when ready
 class LotDetail(generics.RetrieveAPIView):
-    queryset = Lot.objects.all()
+    queryset = Lot.objects.select_related('stat')
     serializer_class = DetailLotSr
 
     def retrieve(self, request, *args, **kwargs):
-        lot = Lot.objects.get(pk=kwargs['pk'])
+        lot = self.get_object()
+        customer = request.query_params.get('customer')
+        if customer is not None:
+            if not customer.isdigit():
+                raise ValidationError('customer must be an id')
+            count_view(lot.stat_id, int(customer))
         serializer = DetailLotSr(lot)
         return Response(serializer.data)
 
 
-# recursively loads all comments corresponds to specified comment:
-# replies, replies to replies, etc
-def load_replies(comm_id):
-    branch = Comment.objects.filter(pk=comm_id)
-    replies = branch.first().self_replies.all()
-    for reply in replies:
-        branch = branch | load_replies(reply.id)
-    return branch
+# POST {components: [{component: id, qty: n}, ...], price: coins, text: seller comment}
+# creates lot of customer's components (see market.py)
+class LotCreate(generics.GenericAPIView):
+    queryset = Lot.objects.all()
 
+    def post(self, request, *args, **kwargs):
+        try:
+            components = Counter()
+            for item in request.data['components']:
+                components[int(item['component'])] += int(item['qty'])
+            price = int(request.data['price'])
+            text = str(request.data.get('text', ''))
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValidationError('components must be a list of {component, qty} and price an integer')
+        if price < 0:
+            raise ValidationError('price must not be negative')
+        lot = list_lot(customer_pk(kwargs), components, price, text)
+        return Response({'lot': lot.id}, status=201)
+
+
+# POST {customer: id}
+# buys the lot, responds 409 if it's already sold or another customer is buying it right now
+class LotBuy(generics.GenericAPIView):
+    queryset = Lot.objects.all()
 
+    def post(self, request, *args, **kwargs):
+        try:
+            customer = int(request.data['customer'])
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError('customer id is required')
+        buy_lot(kwargs['pk'], customer)
+        return Response({'lot': kwargs['pk'], 'purchaser': customer})
+
+
+# POST {components: [{component: id, qty: n}, ...]}
+# exchanges customer's components for discounts of their rarities (see exchange.py)
+class Exchange(generics.GenericAPIView):
+    queryset = ComponentOwnership.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        try:
+            components = Counter()
+            for item in request.data['components']:
+                components[int(item['component'])] += int(item['qty'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValidationError('components must be a list of {component, qty}')
+        gained = exchange(customer_pk(kwargs), components)
+        return Response([{'rarity': rarity, 'qty': qty} for rarity, qty in sorted(gained.items())])
+
+
+# POST {customer: id, vote: 'up' | 'down' | null}
+# vote is saved at once, lot counters and rating are updated in batches (see votes.py)
+class LotVote(generics.GenericAPIView):
+    queryset = Lot.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        try:
+            vote = request.data.get('vote')
+            customer = int(request.data['customer'])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValidationError('customer id is required')
+        if vote not in ('up', 'down', None):
+            raise ValidationError('vote must be up, down or null')
+        try:
+            deltas = vote_lot(kwargs['pk'], customer, vote)
+        except IntegrityError:
+            raise NotFound('there is no such lot or customer')
+        return Response({'vote': vote, 'changed': any(deltas.values())})
+
+
+# POST {customer: id, reaction: id | null}
+# reaction is saved at once, reaction counters are updated in batches (see votes.py)
+class RecipeReact(generics.GenericAPIView):
+    queryset = Recipe.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        try:
+            reaction = request.data.get('reaction')
+            reaction = int(reaction) if reaction is not None else None
+            deltas = react_to_recipe(kwargs['pk'], int(request.data['customer']), reaction)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValidationError('customer id is required and reaction must be an id or null')
+        except IntegrityError:
+            raise NotFound('there is no such recipe, customer or reaction')
+        return Response({'reaction': reaction, 'changed': bool(deltas)})
+
+
+# best public recipes by rating or by count of reactions with the taste (see leaderboard.py)
+# optional query params: n - number of recipes (up to 100), offset
+class RecipesTop(generics.GenericAPIView):
+    queryset = Recipe.objects.filter(is_private=False)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            n = min(int(request.query_params.get('n', 10)), 100)
+            offset = int(request.query_params.get('offset', 0))
+        except ValueError:
+            raise ValidationError('n and offset must be integers')
+        top = leaderboards.top(kwargs.get('taste', leaderboards.rating), max(n, 0), max(offset, 0))
+        if top is None:
+            raise NotFound('there is no such taste')
+        return Response([{'id': recipe_id, 'score': score} for recipe_id, score in top])
+
+
+# position of public recipe in leaderboard by rating or by taste
+class RecipeRank(generics.GenericAPIView):
+    queryset = Recipe.objects.filter(is_private=False)
+
+    def get(self, request, *args, **kwargs):
+        ranked = leaderboards.rank(kwargs.get('taste', leaderboards.rating), kwargs['pk'])
+        if ranked is None:
+            raise NotFound('there is no such taste')
+        rank, score = ranked
+        if rank is None:
+            raise NotFound('there is no such public recipe')
+        return Response({'id': kwargs['pk'], 'rank': rank, 'score': score})
+
+
+# POST {composition: [{component: id, qty: n}, ...]} or list of such recipes
+# responds with {valid, errors} for each recipe, checked without DB queries (see validation.py)
+class RecipeValidation(generics.GenericAPIView):
+    queryset = Recipe.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        batch = isinstance(request.data, list)
+        recipes = request.data if batch else [request.data]
+        try:
+            compositions = [[(int(item['component']), int(item['qty'])) for item in recipe['composition']]
+                            for recipe in recipes]
+        except (KeyError, TypeError, ValueError):
+            raise ValidationError('each recipe must have composition of {component, qty} items')
+        results = [{'valid': not errors, 'errors': errors} for errors in validate_recipes(compositions)]
+        return Response(results if batch else results[0])
+
+
+def component_ids(request, param):
+    value = request.query_params.get(param, '')
+    try:
+        return [int(comp_id) for comp_id in value.split(',') if comp_id]
+    except ValueError:
+        raise ValidationError('{} must be comma separated component ids'.format(param))
+
+
+# public recipes by components, e.g. ?all=1,2&none=3 - with 1 and 2 but without 3 (see search.py)
+# query params: all, any, none - component ids, cursor - from next link of the previous page
+class RecipesSearch(generics.GenericAPIView):
+    queryset = Recipe.objects.filter(is_private=False)
+    page_size = 20
+
+    def get(self, request, *args, **kwargs):
+        after = None
+        if 'cursor' in request.query_params:
+            try:
+                rating, recipe_id = b64decode(request.query_params['cursor']).decode('ascii').split(':')
+                after = int(rating), int(recipe_id)
+            except (TypeError, ValueError, UnicodeError):
+                raise NotFound('Invalid cursor')
+
+        found = recipe_index.search(component_ids(request, 'all'), component_ids(request, 'any'),
+                                    component_ids(request, 'none'), after, self.page_size + 1)
+        next_url = None
+        if len(found) > self.page_size:
+            found = found[:self.page_size]
+            recipe_id, rating = found[-1]
+            cursor = b64encode('{}:{}'.format(rating, recipe_id).encode('ascii')).decode('ascii')
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', cursor)
+        return Response({'next': next_url,
+                         'results': [{'id': recipe_id, 'rating': rating} for recipe_id, rating in found]})
+
+
+# public recipes with the most components in common with the recipe
+# optional query param n - number of recipes (up to 100)
+class SimilarRecipes(generics.GenericAPIView):
+    queryset = Recipe.objects.filter(is_private=False)
+
+    def get(self, request, *args, **kwargs):
+        try:
+            n = min(int(request.query_params.get('n', 10)), 100)
+        except ValueError:
+            raise ValidationError('n must be an integer')
+        similar = recipe_index.similar(kwargs['pk'], max(n, 0))
+        return Response([{'id': recipe_id, 'common': common} for recipe_id, common in similar])
+
+
+# POST {recipes: [{recipe: id, qty: n}, ...], discount: rarity | null}
+# creates order paid with customer's coins (see checkout.py)
+class Checkout(generics.GenericAPIView):
+    queryset = Order.objects.all()
+
+    def post(self, request, *args, **kwargs):
+        try:
+            basket = [(int(item['recipe']), int(item.get('qty', 1))) for item in request.data['recipes']]
+            discount = request.data.get('discount')
+            discount = int(discount) if discount is not None else None
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise ValidationError('recipes must be a list of {recipe, qty} and discount a rarity or null')
+        order = checkout(customer_pk(kwargs), basket, discount)
+        return Response({'order': order.id, 'price': order.price}, status=201)
+
+
+# loads the branch of specified comment with one recursive query:
+# the comment itself, replies, replies to replies, etc ordered depth-first like it's displayed:
+# each comment followed by its replies ordered by id
+# the order comes from path - concatenated ids of the comment's ancestors and its own, each of them
+# padded to the same width by adding 10^12, so sorting paths as strings sorts the tree depth-first
+# max_depth limits nesting level counted from the root comment (root has depth 0),
+# after is the path of the last comment of the previous page: subtrees before it aren't walked at all,
+# but the rest of the branch is still built and sorted before limit rows of it are taken
+def load_branch(comm_id, max_depth=None, limit=None, after=None):
+    table = Comment._meta.db_table
+    path = 'b.path || CAST(1000000000000 + c.id AS TEXT)'
+    walk, params = [], [comm_id]
+    if max_depth is not None:
+        walk.append('b.depth < %s')
+        params.append(max_depth)
+    if after is not None:
+        # ancestors of the last comment are walked to reach the replies after it
+        walk.append('({p} > %s OR substr(%s, 1, length({p})) = {p})'.format(p=path))
+        params += [after, after, after]
+    if limit is not None:
+        params.append(limit)
+    return list(Comment.objects.raw(
+        'WITH RECURSIVE branch(id, depth, path) AS ('
+        '   SELECT id, 0, CAST(1000000000000 + id AS TEXT) FROM {t} WHERE id = %s'
+        '   UNION ALL'
+        '   SELECT c.id, b.depth + 1, {p}'
+        '   FROM {t} c JOIN branch b ON c.reply_to_id = b.id {walk}'
+        ') '
+        'SELECT c.id, c.author_id, c.text, c.reply_to_id, b.depth, b.path '
+        'FROM {t} c JOIN branch b ON c.id = b.id {after} ORDER BY b.path {top}'
+        .format(t=table, p=path, walk='WHERE ' + ' AND '.join(walk) if walk else '',
+                after='WHERE b.path > %s' if after is not None else '',
+                top='LIMIT %s' if limit is not None else ''),
+        params))
+
+
+# parses optional query params of branch requests: non-negative integers depth and limit
+# (limit of at least one comment since the root comment is always included) and after - path from
+# the next link of the previous page
+def branch_params(query_params):
+    try:
+        depth = int(query_params['depth']) if 'depth' in query_params else None
+        limit = int(query_params['limit']) if 'limit' in query_params else None
+    except ValueError:
+        raise ValidationError('depth and limit must be integers')
+    if depth is not None and depth < 0:
+        raise ValidationError('depth must not be negative')
+    if limit is not None and limit < 1:
+        raise ValidationError('limit must be positive')
+    after = query_params.get('after')
+    if after is not None and not re.fullmatch(r'(1\d{12})+', after):
+        raise ValidationError('after must be taken from the next link')
+    return depth, limit, after
+
+
+# page of the branch and url of the next page (None for the last one), the page is a whole branch
+# without limit, with limit one more comment is loaded to know whether there is the next page
+def branch_page(request, pk):
+    depth, limit, after = branch_params(request.GET)
+    branch = load_branch(pk, depth, limit + 1 if limit is not None else None, after)
+    if not branch and after is None:
+        raise NotFound()
+    next_url = None
+    if limit is not None and len(branch) > limit:
+        branch = branch[:limit]
+        next_url = replace_query_param(request.build_absolute_uri(), 'after', branch[-1].path)
+    return branch, next_url
+
+
+# optional query params:
+# depth - max nesting level of replies, limit - max number of comments in response,
+# after - continues the branch, the next page is linked by Link: <url>; rel="next" header
 class CommentBranch(generics.ListAPIView):
     queryset = Comment.objects.all()
     serializer_class = CommentSr
 
     def list(self, request, *args, **kwargs):
-        branch = load_replies(kwargs['pk'])
+        branch, next_url = branch_page(request, kwargs['pk'])
         serializer = CommentSr(branch, many=True)
-        return Response(serializer.data)
+        return Response(serializer.data, headers={'Link': '<{}>; rel="next"'.format(next_url)} if next_url else None)
+
+
+# request metrics of this process in Prometheus text format (see PerformanceMiddleware)
+class MetricsExport(generics.GenericAPIView):
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
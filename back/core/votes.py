@@ -0,0 +1,120 @@
+from django.conf import settings
+from django.db import connection, transaction, IntegrityError
+from django.db.models import Q, F, Case, When, Value
+
+from .models import Lot, CustomersReactToRecipes, RecipeReactionsCount
+from .buffers import CounterBuffer, update_counters
+from .leaderboard import leaderboards
+
+
+# votes and reactions are recorded in their relations right away and idempotently,
+# while denormalized counters (Lot.upvotes_count, downvotes_count, rating and
+# RecipeReactionsCount.qty) are buffered and flushed in batches so a popular lot
+# or recipe row isn't updated on every vote
+
+upvotes = Lot.upvotes.through
+downvotes = Lot.downvotes.through
+
+
+# one UPDATE for all buffered lots
+def flush_lot_counters(pending):
+    update_counters(Lot, pending)
+
+
+# one INSERT ... ON CONFLICT for all buffered (recipe, reaction) pairs gaining reactions
+# and one UPDATE for the ones losing them: CHECK (qty >= 0) is checked on the proposed row before
+# the conflict is resolved, so a negative delta can't go through the upsert (its row already exists anyway)
+def flush_reaction_counters(pending):
+    gained = [(recipe_id, reaction_id, deltas['qty'])
+              for (recipe_id, reaction_id), deltas in pending.items() if deltas['qty'] > 0]
+    lost = {key: deltas['qty'] for key, deltas in pending.items() if deltas['qty'] < 0}
+    if not gained and not lost:
+        return
+    table = connection.ops.quote_name(RecipeReactionsCount._meta.db_table)
+    with transaction.atomic(), connection.cursor() as cursor:
+        if gained:
+            cursor.execute(
+                'INSERT INTO {t} (recipe_id, reaction_id, qty) VALUES {values} '
+                'ON CONFLICT (recipe_id, reaction_id) DO UPDATE SET qty = {t}.qty + excluded.qty'
+                .format(t=table, values=', '.join(['(%s, %s, %s)'] * len(gained))),
+                [param for row in gained for param in row])
+        if lost:
+            pairs = Q()
+            for recipe_id, reaction_id in lost:
+                pairs |= Q(recipe_id=recipe_id, reaction_id=reaction_id)
+            RecipeReactionsCount.objects.filter(pairs).update(qty=F('qty') + Case(
+                *[When(recipe_id=recipe_id, reaction_id=reaction_id, then=Value(delta))
+                  for (recipe_id, reaction_id), delta in lost.items()], default=Value(0)))
+
+
+lot_counters = CounterBuffer(flush_lot_counters,
+                             getattr(settings, 'COUNTERS_FLUSH_INTERVAL', 1.0),
+                             getattr(settings, 'COUNTERS_MAX_PENDING', 1000))
+reaction_counters = CounterBuffer(flush_reaction_counters,
+                                  getattr(settings, 'COUNTERS_FLUSH_INTERVAL', 1.0),
+                                  getattr(settings, 'COUNTERS_MAX_PENDING', 1000))
+
+
+# makes (obj, customer) row present or absent in relation
+# returns 1 if the row was created, -1 if it was deleted and 0 if nothing was changed
+def _set_vote(relation, present, **row):
+    if not present:
+        return -relation.objects.filter(**row).delete()[0]
+    try:
+        with transaction.atomic():
+            relation.objects.create(**row)
+        return 1
+    except IntegrityError:
+        return 0
+
+
+# vote is 'up', 'down' or None to take back the vote
+# repeated votes don't change anything, switching the vote moves it from one counter to another
+def vote_lot(lot_id, customer_id, vote):
+    with transaction.atomic():
+        up = _set_vote(upvotes, vote == 'up', lot_id=lot_id, customer_id=customer_id)
+        down = _set_vote(downvotes, vote == 'down', lot_id=lot_id, customer_id=customer_id)
+    deltas = {'upvotes_count': up, 'downvotes_count': down, 'rating': up - down}
+    if up or down:
+        transaction.on_commit(lambda: lot_counters.add(lot_id, **deltas))
+    return deltas
+
+
+# reaction_id is id of Reaction or None to take back the reaction, one reaction per customer
+# returns {reaction_id: delta} of changed counters
+def react_to_recipe(recipe_id, customer_id, reaction_id):
+    row = CustomersReactToRecipes.objects.filter(recipe_id=recipe_id, customer_id=customer_id)
+    deltas = {}
+    with transaction.atomic():
+        for _ in range(2):
+            # the no-op update is the first statement so sqlite takes the write lock before the
+            # reaction is read (reading first fails with 'database is locked' under concurrent
+            # reactions) and other databases lock the row until the transaction ends
+            if row.update(reaction_id=F('reaction_id')):
+                old = row.values_list('reaction_id', flat=True).get()
+                if old != reaction_id and reaction_id is None:
+                    row.delete()
+                    deltas = {old: -1}
+                elif old != reaction_id:
+                    row.update(reaction_id=reaction_id)
+                    deltas = {old: -1, reaction_id: 1}
+                break
+            if reaction_id is None:
+                break
+            if _set_vote(CustomersReactToRecipes, True, recipe_id=recipe_id,
+                         customer_id=customer_id, reaction_id=reaction_id):
+                deltas = {reaction_id: 1}
+                break
+            # a concurrent reaction has just inserted the row, lock and read it
+
+    def buffer():
+        for reaction, delta in deltas.items():
+            reaction_counters.add((recipe_id, reaction), qty=delta)
+            leaderboards.react(recipe_id, reaction, delta)
+    transaction.on_commit(buffer)
+    return deltas
+
+
+def flush():
+    lot_counters.flush()
+    reaction_counters.flush()